@@ -1,19 +1,41 @@
 import argparse
 import uuid
 import datetime
+import hashlib
+import time
+from array import array
+from contextlib import contextmanager
 from block import Block
-from blockchain import Blockchain
+from blockchain import open_blockchain
+from snapshots import item_states
+from item_bitmap import open_bitmap
+import ciphers
 import os
 import sys
 from utils import get_role_passwords, validate_password, get_owner
+from profiling import timed
+
+# Rows of an --from-file intake validated and encrypted together
+CHUNK_ROWS = 4096
+# Rows read between progress reports
+PROGRESS_ROWS = 20000
 
 def parse_add_args(args):
     parser = argparse.ArgumentParser(description='Add evidence items to the blockchain')
-    parser.add_argument('-c', '--case_id', required=True, help='Case identifier (UUID)')
-    parser.add_argument('-i', '--item_ids', required=True, action='append', help='Evidence item identifier(s)')
-    parser.add_argument('-g', '--creator', required=True, help='Creator of the evidence item')
+    parser.add_argument('-c', '--case_id', help='Case identifier (UUID)')
+    parser.add_argument('-i', '--item_ids', action='append', help='Evidence item identifier(s)')
+    parser.add_argument('-g', '--creator', help='Creator of the evidence item')
     parser.add_argument('-p', '--password', required=True, help='Password for the creator')
-    return parser.parse_args(args)
+    parser.add_argument('--from-file', help='CSV or JSONL file of case_id, item_id and creator fields to add '
+                                            '(-c and -g give defaults for missing fields)')
+    parser.add_argument('--format', choices=['jsonl', 'csv'], help='Format of --from-file (default: from the file extension)')
+    args = parser.parse_args(args)
+    if args.from_file is None:
+        missing = [name for name, value in (('-c/--case_id', args.case_id), ('-i/--item_ids', args.item_ids),
+                                             ('-g/--creator', args.creator)) if value is None]
+        if missing:
+            parser.error(f"the following arguments are required: {', '.join(missing)}")
+    return args
 
 def validate_case_id(case_id):
     try:
@@ -22,99 +44,241 @@ def validate_case_id(case_id):
         print("Error: Invalid case ID format")
         exit(1)
 
+@contextmanager
+def existing_items(blockchain):
+    """Yield a function telling whether an item ID is already in the
+    chain: a lookup in the item bitmap, unmapped on exit, or in the latest
+    item states when the bitmap cannot be written"""
+    try:
+        bitmap = open_bitmap(blockchain)
+    except OSError:
+        # The newest snapshot plus the blocks after it, keyed by the
+        # encrypted ID as stored in the chain
+        existing_ids = item_states(blockchain)
+        yield lambda item_id: Block.encrypt_evidence_id(item_id) in existing_ids
+        return
+    try:
+        yield bitmap.__contains__
+    finally:
+        bitmap.close()
+
+@timed('add.validate')
 def validate_evidence_ids(blockchain, evidence_ids):
-    creator_password = get_role_passwords()['creator']
-    existing_ids = set()
-    
-    # Skip the initial block (genesis block)
-    for block in blockchain.blocks[1:]:
-        decrypted_values = block.get_decrypted_values(creator_password)
-        existing_id = decrypted_values.get('evidence_id')
-        
-        if existing_id is not None:
-            existing_ids.add(existing_id)
-    
-    # Check for duplicates in new IDs
-    for new_id in evidence_ids:
-        if int(new_id) in existing_ids:  # Convert new_id to int for comparison
-            print(f"Error: Evidence ID {new_id} already exists in the blockchain", 
-                  file=sys.stderr)
+    with existing_items(blockchain) as exists:
+        # Check for duplicates in new IDs
+        for new_id in evidence_ids:
+            if exists(int(new_id)):
+                print(f"Error: Evidence ID {new_id} already exists in the blockchain", 
+                      file=sys.stderr)
+                sys.exit(1)
+
+def check_creator_password(password):
+    if not validate_password(password):
+        print("Error: Invalid password", file=sys.stderr)
+        sys.exit(1)
+    if password != get_role_passwords()['creator']:
+        print("Error: Must use creator password for adding items", file=sys.stderr)
+        sys.exit(1)
+
+def parse_item_row(fields, case_id=None, creator=None):
+    """Check one intake row.
+
+    Returns (case UUID bytes, item ID, creator bytes), or an error string.
+    """
+    case = fields.get('case_id', fields.get('case')) or case_id
+    item = fields.get('item_id', fields.get('item'))
+    creator = fields.get('creator') or creator
+    if not case:
+        return "Missing case ID"
+    try:
+        case_bytes = uuid.UUID(str(case)).bytes
+    except ValueError:
+        return f"Invalid case ID: {case}"
+    try:
+        item_id = int(item)
+    except (TypeError, ValueError):
+        return f"Item ID {item} must be a valid integer"
+    if item_id < 0 or item_id > 0xFFFFFFFF:
+        return f"Item ID {item} must be a 32-bit unsigned integer"
+    if not creator:
+        return "Missing creator"
+    return case_bytes, item_id, str(creator).encode()
+
+def _chunks(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _link_records(records, prev_hash):
+    """Stamp the records laid end to end in records and link each one to
+    the one before it, in place. Returns blocks over the records."""
+    blocks = []
+    for offset in range(0, len(records), Block.FIXED_SIZE):
+        records[offset:offset + 32] = prev_hash
+        Block.TIMESTAMP.pack_into(records, offset + Block.TIMESTAMP_OFFSET, time.time())
+        prev_hash = hashlib.sha256(records[offset:offset + Block.FIXED_SIZE]).digest()
+        blocks.append(Block.from_buffer(records, offset))
+    return blocks
+
+@timed('add.from_file')
+def add_from_file(blockchain_file, args):
+    """Add every item of an intake file in one commit.
+
+    The file is streamed in chunks: each chunk's rows are validated and its
+    case and item IDs encrypted with one cipher call each. Valid rows are
+    serialized straight into the records of the commit, so memory grows
+    by about 160 bytes per row rather than by a Block per row. The
+    duplicate check against the chain is done once, under the write lock,
+    and if any row fails nothing is added.
+    """
+    from batch import read_actions
+
+    if not os.path.exists(args.from_file):
+        print(f"Error: intake file {args.from_file} not found", file=sys.stderr)
+        sys.exit(1)
+    check_creator_password(args.password)
+    owner = get_owner(args.password)
+    default_case = args.case_id
+    if default_case is not None:
+        default_case = validate_case_id(default_case)
+
+    started = time.perf_counter()
+    errors = []
+    # Records of the valid rows, in file order; their timestamp and
+    # prev_hash are filled in under the write lock
+    records = bytearray()
+    # Item ID and line number of each record
+    item_ids = array('I')
+    item_lines = array('I')
+    # Line of each item ID in the file
+    lines = {}
+    cases = set()
+    rows = 0
+    reported = 0
+    for chunk in _chunks(read_actions(args.from_file, args.format), CHUNK_ROWS):
+        valid = []
+        for line_number, fields in chunk:
+            row = fields if isinstance(fields, str) else parse_item_row(fields, default_case, args.creator)
+            if isinstance(row, str):
+                errors.append((line_number, row))
+            else:
+                valid.append((line_number, row))
+        case_ids = ciphers.encrypt_column([row[0] for _, row in valid])
+        evidence_ids = ciphers.encrypt_column([row[1].to_bytes(16, byteorder='big') for _, row in valid])
+        for (line_number, (_, item_id, creator)), case_id, evidence_id in zip(valid, case_ids, evidence_ids):
+            if item_id in lines:
+                errors.append((line_number, f"Evidence ID {item_id} is also on line {lines[item_id]}"))
+                continue
+            lines[item_id] = line_number
+            cases.add(case_id)
+            item_ids.append(item_id)
+            item_lines.append(line_number)
+            records += Block.STRUCT.pack(bytes(32), 0.0, case_id, evidence_id, b"CHECKEDIN", creator, owner, 0)
+
+        rows += len(chunk)
+        if rows - reported >= PROGRESS_ROWS:
+            reported = rows
+            elapsed = time.perf_counter() - started
+            print(f"Read {rows:,} rows ({rows / elapsed:,.0f} rows/s)", flush=True)
+
+    if not rows:
+        print(f"Error: no items in {args.from_file}", file=sys.stderr)
+        sys.exit(1)
+
+    blockchain = open_blockchain(blockchain_file)
+    # Hold the write lock from the duplicate check to the commit
+    with blockchain.transaction():
+        if os.path.exists(blockchain_file) and blockchain.blocks:
+            with existing_items(blockchain) as exists:
+                for line_number, item_id in zip(item_lines, item_ids):
+                    if exists(item_id):
+                        errors.append((line_number, f"Evidence ID {item_id} already exists in the blockchain"))
+
+        if errors:
+            errors.sort()
+            for line_number, error in errors:
+                print(f"Line {line_number}: Error: {error}")
+            print(f"Error: {len(errors)} of {rows} rows failed, nothing was added", file=sys.stderr)
             sys.exit(1)
 
+        if not os.path.exists(blockchain_file) or len(blockchain.blocks) == 0:
+            blockchain.init_blockchain()
+        # Stamp the blocks under the lock, so their times follow the tip's
+        blocks = _link_records(records, blockchain.blocks[-1].calculate_hash())
+        blockchain.add_blocks(blocks)
+
+    elapsed = time.perf_counter() - started
+    print(f"Added {len(blocks):,} items in {len(cases):,} cases from {args.from_file} "
+          f"in {elapsed:.2f} s ({len(blocks) / elapsed:,.0f} items/s)")
+
+@timed('add.run')
 def run():
     # Get blockchain file path from environment variable
     blockchain_file = os.getenv('BCHOC_FILE_PATH', 'blockchain.bin')
     
     # Parse command line arguments
     args = parse_add_args(sys.argv[2:])
+
+    if args.from_file is not None:
+        add_from_file(blockchain_file, args)
+        return
     
     # Validate case ID format
     case_id = validate_case_id(args.case_id)
     
     # Create or load blockchain
-    blockchain = Blockchain(blockchain_file)
+    blockchain = open_blockchain(blockchain_file)
     
-    # Initialize blockchain if it doesn't exist
-    if not os.path.exists(blockchain_file) or len(blockchain.blocks) == 0:
-        blockchain.init_blockchain()
+    # Hold the write lock from the duplicate check to the commit
+    with blockchain.transaction():
+        # Initialize blockchain if it doesn't exist
+        if not os.path.exists(blockchain_file) or len(blockchain.blocks) == 0:
+            blockchain.init_blockchain()
     
-    # Convert evidence IDs to integers and validate
-    evidence_ids = []
-    print(args.item_ids)
-    for item_id in args.item_ids:
-        try:
-            item_id_int = int(item_id)
-            if item_id_int < 0 or item_id_int > 0xFFFFFFFF:
-                print(f"Error: Item ID {item_id} must be a 32-bit unsigned integer")
+        # Convert evidence IDs to integers and validate
+        evidence_ids = []
+        for item_id in args.item_ids:
+            try:
+                item_id_int = int(item_id)
+                if item_id_int < 0 or item_id_int > 0xFFFFFFFF:
+                    print(f"Error: Item ID {item_id} must be a 32-bit unsigned integer")
+                    exit(1)
+                evidence_ids.append(item_id_int)
+            except ValueError:
+                print(f"Error: Item ID {item_id} must be a valid integer")
                 exit(1)
-            evidence_ids.append(item_id_int)
-            print(item_id_int)
-        except ValueError:
-            print(f"Error: Item ID {item_id} must be a valid integer")
-            exit(1)
     
-    # Validate evidence IDs (check for duplicates)
-    validate_evidence_ids(blockchain, evidence_ids)
+        # Validate evidence IDs (check for duplicates)
+        validate_evidence_ids(blockchain, evidence_ids)
     
-    # Validate creator password
-    if not validate_password(args.password):
-        print("Error: Invalid password", file=sys.stderr)
-        sys.exit(1)
-    
-    # Make sure we're using the creator password
-    if args.password != get_role_passwords()['creator']:
-        print("Error: Must use creator password for adding items", file=sys.stderr)
-        sys.exit(1)
+        # Validate creator password
+        check_creator_password(args.password)
 
-    # get owner
-    owner = get_owner(args.password)
+        # get owner
+        owner = get_owner(args.password)
+
+        # Build a block for each evidence item
+        blocks = []
+        for item_id in evidence_ids:
+            block = Block(
+                case_id=case_id,
+                evidence_id=item_id,
+                state=b"CHECKEDIN",
+                creator=args.creator.encode(),
+                owner=owner,
+                data=b""
+            )
+            blocks.append(block)
+
+        # Append all items in a single commit
+        blockchain.add_blocks(blocks)
 
-    # Add each evidence item
     for item_id in evidence_ids:
-        block = Block(
-            case_id=case_id,
-            evidence_id=item_id,
-            state=b"CHECKEDIN",
-            creator=args.creator.encode(),
-            owner=owner,
-            data=b""
-        )
-        
-        print("\nBlock Values:")
-        print(f"case_id=b'{block.case_id}'")
-        print(f"evidence_id=b'{block.evidence_id}'")
-        
-        # Add debug print for decrypted values
-        decrypted = block.get_decrypted_values(args.password)
-        print(f"\nDecrypted Values:")
-        print(f"case_id: {decrypted['case_id']}")
-        print(f"evidence_id: {decrypted['evidence_id']}")
-        
-        blockchain.add_block(block)
-        
-        chain_block = blockchain.blocks[-1]
-        print(f"\nActual chain value for case_id: {chain_block.case_id}")
-        
         timestamp = datetime.datetime.now().isoformat() + "Z"
         
         print(f"\nAdded item: {item_id}")
@@ -0,0 +1,231 @@
+import argparse
+import hashlib
+import os
+import struct
+import sys
+import time
+import zlib
+from bisect import bisect_right
+from functools import lru_cache
+from blockchain import open_blockchain, ARCHIVE_SUFFIX, FOOTER, pack_footer, unpack_footer
+from block import Block
+from profiling import timed
+
+# Compressed archives of sealed chain segments, written by `bchoc archive`
+# as <chain>.seg.<first block>.arc in place of the segment.
+#
+# The records are cut into frames of a fixed number of blocks and each
+# frame is compressed on its own, so reading a block only decompresses its
+# frame. A frame table maps record positions (and block indexes) to frames;
+# it is what makes random access, hash_at() and verify work on an archive
+# without decompressing the rest of it.
+#
+# File layout: the compressed frames, the frame table, the footer of the
+# segment as it was sealed, then a trailer locating the table.
+
+MAGIC = b'BCAR'
+VERSION = 1
+CODECS = {'zlib': 1, 'lzma': 2}
+# Blocks per frame
+FRAME_BLOCKS = 256
+# Decompressed frames kept per archive
+FRAME_CACHE = 8
+# index of the frame's first block, position of its records in the segment,
+# position of the compressed frame in the file, compressed and raw length,
+# CRC-32 of the raw records
+FRAME = struct.Struct('<QQQIII')
+# position of the frame table, number of frames, codec, version, magic
+TRAILER = struct.Struct('<QQII4s')
+
+def parse_archive_args(args):
+    parser = argparse.ArgumentParser(description='Compress the sealed segments of the blockchain')
+    parser.add_argument('--codec', choices=sorted(CODECS), default='zlib', help='Compression codec (default: zlib)')
+    parser.add_argument('--level', type=int, default=6, help='Compression level, or lzma preset (default: 6)')
+    parser.add_argument('--frame-blocks', type=int, default=FRAME_BLOCKS,
+                        help=f'Blocks per independently compressed frame (default: {FRAME_BLOCKS})')
+    parser.add_argument('--keep', type=int, default=0, help='Leave this many of the newest sealed segments as they are')
+    parser.add_argument('--seal', action='store_true', help='Seal the chain file as a segment first')
+    return parser.parse_args(args)
+
+def _compress(codec, level):
+    if codec == 'lzma':
+        import lzma
+        return lambda data: lzma.compress(data, preset=level)
+    return lambda data: zlib.compress(data, level)
+
+def _decompress(codec_id):
+    if codec_id == CODECS['lzma']:
+        import lzma
+        return lzma.decompress
+    if codec_id == CODECS['zlib']:
+        return zlib.decompress
+    raise ValueError(f"Unknown archive codec {codec_id}")
+
+def _read_trailer(fd, size):
+    if size < FOOTER.size + TRAILER.size:
+        return None
+    table_offset, frames, codec_id, version, magic = TRAILER.unpack(os.pread(fd, TRAILER.size, size - TRAILER.size))
+    if magic != MAGIC or version != VERSION or table_offset + frames * FRAME.size + FOOTER.size + TRAILER.size != size:
+        return None
+    footer = unpack_footer(os.pread(fd, FOOTER.size, size - TRAILER.size - FOOTER.size))
+    if footer is None:
+        return None
+    return footer, table_offset, frames, codec_id
+
+def read_archive_footer(path):
+    """Return the footer of the segment archived in path, or None"""
+    with open(path, 'rb') as f:
+        trailer = _read_trailer(f.fileno(), os.fstat(f.fileno()).st_size)
+    return trailer and trailer[0]
+
+class ArchivedRecords:
+    """Records of an archived segment, decompressed a frame at a time.
+
+    Same interface as blockchain.MappedRecords: positions are relative to
+    the first record of the segment, and each frame is handed out as a
+    buffer of its own.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        fd = self._file.fileno()
+        trailer = _read_trailer(fd, os.fstat(fd).st_size)
+        if trailer is None:
+            self._file.close()
+            raise ValueError(f"Invalid chain archive {path}")
+        footer, table_offset, frames, codec_id = trailer
+        self.length = footer[4]
+        self.frames = list(FRAME.iter_unpack(os.pread(fd, frames * FRAME.size, table_offset)))
+        self.starts = [frame[1] for frame in self.frames]
+        self._decompress = _decompress(codec_id)
+        self.frame = lru_cache(maxsize=FRAME_CACHE)(self._frame)
+
+    def _frame(self, i):
+        _, _, offset, compressed_length, raw_length, crc = self.frames[i]
+        try:
+            data = self._decompress(os.pread(self._file.fileno(), compressed_length, offset))
+        except Exception:
+            data = None
+        if data is None or len(data) != raw_length or zlib.crc32(data) != crc:
+            raise ValueError(f"Corrupt frame {i} in {self.path}")
+        return data
+
+    def view(self, position):
+        i = bisect_right(self.starts, position) - 1
+        return self.frame(i), position - self.starts[i]
+
+    def pieces(self, position):
+        for i in range(max(0, bisect_right(self.starts, position) - 1), len(self.frames)):
+            start, raw_length = self.frames[i][1], self.frames[i][4]
+            yield self.frame(i), start, start + raw_length
+
+    def close(self):
+        """Close the archive; frames already handed out stay readable"""
+        self.frame.cache_clear()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def _frames(segment, frame_blocks):
+    """Yield (first block, position, records) of each frame of a segment"""
+    index = segment.first
+    records = []
+    frame_first = index
+    frame_start = 0
+    for buffer, base, end in segment.pieces(segment.base):
+        offset = base
+        while offset < end:
+            position = offset - base
+            length = Block.FIXED_SIZE + Block.DATA_LENGTH.unpack_from(buffer, position + Block.DATA_LENGTH_OFFSET)[0]
+            records.append(buffer[position:position + length])
+            offset += length
+            index += 1
+            if len(records) == frame_blocks:
+                data = b"".join(records)
+                yield frame_first, frame_start, data
+                frame_first, frame_start, records = index, frame_start + len(data), []
+    if records:
+        yield frame_first, frame_start, b"".join(records)
+
+@timed('archive.segment')
+def archive_segment(segment, codec, level, frame_blocks):
+    """Write the archive of a sealed segment, check it and replace the
+    segment with it. Returns the archive's size in bytes."""
+    path = segment.path + ARCHIVE_SUFFIX
+    tmp_path = path + '.tmp'
+    compress = _compress(codec, level)
+    table = []
+    digest = hashlib.sha256()
+    with open(tmp_path, 'wb') as f:
+        offset = 0
+        for first, start, data in _frames(segment, frame_blocks):
+            digest.update(data)
+            compressed = compress(data)
+            table.append(FRAME.pack(first, start, offset, len(compressed), len(data), zlib.crc32(data)))
+            f.write(compressed)
+            offset += len(compressed)
+        f.write(b"".join(table))
+        f.write(pack_footer(segment.footer))
+        f.write(TRAILER.pack(offset, len(table), CODECS[codec], VERSION, MAGIC))
+        f.flush()
+        os.fsync(f.fileno())
+
+    # Read the archive back before the segment is removed
+    check = hashlib.sha256()
+    with ArchivedRecords(tmp_path) as archived:
+        for data, start, end in archived.pieces(0):
+            check.update(data)
+    if check.digest() != digest.digest() or archived.length != segment.length:
+        os.unlink(tmp_path)
+        raise ValueError(f"Archive of {segment.path} does not read back as the segment")
+    size = os.path.getsize(tmp_path)
+    os.replace(tmp_path, path)
+    # Readers that listed the segment before it was archived open the
+    # archive instead when they find the segment gone
+    try:
+        os.unlink(segment.path)
+    except FileNotFoundError:
+        pass
+    return size
+
+def run():
+    args = parse_archive_args(sys.argv[2:])
+    if args.frame_blocks < 1 or args.keep < 0:
+        print("Error: --frame-blocks must be positive and --keep not negative")
+        exit(1)
+    blockchain_file = os.getenv('BCHOC_FILE_PATH', 'blockchain.bin')
+    if not os.path.exists(blockchain_file):
+        print("Error: blockchain file not found")
+        exit(1)
+
+    blockchain = open_blockchain(blockchain_file)
+    if args.seal and blockchain.seal():
+        print(f"Sealed the chain file as a segment at block {blockchain.segments[-1].first}")
+
+    # A chain file sealed by an interrupted rollover is not archived until
+    # the next writer has linked it as a segment
+    sealed = [segment for segment in blockchain.segments if segment.path != blockchain.filename]
+    pending = [segment for segment in sealed[:len(sealed) - args.keep] if not segment.archived]
+    if not pending:
+        print("No sealed segments to archive")
+        return
+
+    raw_total = archived_total = 0
+    for segment in pending:
+        started = time.perf_counter()
+        size = archive_segment(segment, args.codec, args.level, args.frame_blocks)
+        elapsed = time.perf_counter() - started
+        raw_size = segment.length + FOOTER.size
+        raw_total += raw_size
+        archived_total += size
+        print(f"Archived {os.path.basename(segment.path)}: {segment.count} blocks, "
+              f"{raw_size:,} -> {size:,} bytes ({raw_size / size:.2f}x) in {elapsed:.2f} s")
+    print(f"Archived {len(pending)} segments with {args.codec}: {raw_total:,} -> {archived_total:,} bytes "
+          f"({raw_total / archived_total:.2f}x)")
+
+if __name__ == "__main__":
+    run()
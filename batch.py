@@ -0,0 +1,156 @@
+import argparse
+import csv
+import json
+import os
+import sys
+from blockchain import open_blockchain
+from evidence_index import EvidenceIndex
+from checkin import checkin_error, checkin_block
+from checkout import checkout_error, checkout_block
+from remove import remove_error, remove_block
+from profiling import timed
+
+# Applies a file of custody actions in one pass: the chain and its index are
+# loaded once, every action is checked with the same rules as the checkin,
+# checkout and remove commands against the latest state of its item
+# (including the blocks of earlier actions in the file), and the resulting
+# blocks are committed with a single write. If any action fails nothing is
+# written.
+
+ACTIONS = ['checkin', 'checkout', 'remove']
+
+def parse_batch_args(args):
+    parser = argparse.ArgumentParser(description='Apply a file of custody actions to the blockchain')
+    parser.add_argument('file', help='JSONL or CSV file with item, action, password and reason fields')
+    parser.add_argument('--format', choices=['jsonl', 'csv'], help='File format (default: from the file extension)')
+    return parser.parse_args(args)
+
+def read_actions(path, file_format=None):
+    """Yield (line number, action fields) from a JSONL or CSV file.
+
+    CSV files need a header row. Fields that cannot be parsed are yielded
+    as an error string instead of a dict.
+    """
+    if file_format is None:
+        file_format = 'csv' if path.lower().endswith('.csv') else 'jsonl'
+    with open(path, newline='') as f:
+        if file_format == 'csv':
+            reader = csv.DictReader(f)
+            for row in reader:
+                yield reader.line_num, row
+        else:
+            for line_number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    fields = json.loads(line)
+                except ValueError as e:
+                    yield line_number, f"Invalid JSON: {e}"
+                    continue
+                if not isinstance(fields, dict):
+                    yield line_number, "Invalid JSON: expected an object"
+                    continue
+                yield line_number, fields
+
+def apply_action(fields, latest_block):
+    """Check one action and build its block.
+
+    latest_block(item_id) returns the item's current latest block. Returns
+    (item_id, action, block, error); block is None when error is set.
+    """
+    action = str(fields.get('action') or '').lower()
+    item = fields.get('item', fields.get('item_id'))
+    password = str(fields.get('password') or '')
+    reason = str(fields.get('reason', fields.get('why')) or '')
+    if item in (None, ''):
+        return None, action, None, "Missing item ID"
+    try:
+        item_id = int(item)
+    except (TypeError, ValueError):
+        return item, action, None, f"Invalid item ID: {item}"
+    if not action:
+        return item_id, action, None, "Missing action"
+    if action not in ACTIONS:
+        return item_id, action, None, f"Unknown action: {action}"
+
+    existing_block = latest_block(item_id)
+    if action == 'checkin':
+        error = checkin_error(existing_block, item_id, password)
+        if not error:
+            block, case_id = checkin_block(existing_block, item_id, password)
+    elif action == 'checkout':
+        error = checkout_error(existing_block, item_id, password)
+        if not error:
+            block, case_id = checkout_block(existing_block, item_id, password)
+    else:
+        error = remove_error(existing_block, item_id, reason, password)
+        if not error:
+            block, case_id = remove_block(existing_block, item_id, reason)
+    if error:
+        return item_id, action, None, error
+    return item_id, action, block, None
+
+@timed('batch.run')
+def run():
+    blockchain_file = os.getenv('BCHOC_FILE_PATH', 'blockchain.bin')
+    args = parse_batch_args(sys.argv[2:])
+
+    if not os.path.exists(args.file):
+        print(f"Error: batch file {args.file} not found", file=sys.stderr)
+        sys.exit(1)
+
+    # Load blockchain
+    blockchain = open_blockchain(blockchain_file)
+    if not blockchain.blocks:
+        print("Error: Blockchain is empty", file=sys.stderr)
+        sys.exit(1)
+
+    # Check and commit under the write lock, against the real latest states
+    with blockchain.transaction():
+        # Latest block of every item touched by the batch so far
+        pending = {}
+        blocks = []
+        results = []
+        with EvidenceIndex.open(blockchain) as index:
+            def latest_block(item_id):
+                if item_id in pending:
+                    return pending[item_id]
+                entry = index.lookup(item_id)
+                if entry is None:
+                    return None
+                return blockchain.block_at(entry[2])
+
+            for line_number, fields in read_actions(args.file, args.format):
+                if isinstance(fields, str):
+                    results.append((line_number, '', '', fields))
+                    continue
+                item_id, action, block, error = apply_action(fields, latest_block)
+                if block is not None:
+                    pending[item_id] = block
+                    blocks.append(block)
+                results.append((line_number, action, item_id, error))
+
+        if not results:
+            print(f"Error: batch file {args.file} has no actions", file=sys.stderr)
+            sys.exit(1)
+
+        failed = [result for result in results if result[3]]
+        for line_number, action, item_id, error in results:
+            # Action and item as far as the line has them
+            parts = [str(part) for part in (action, item_id) if part not in ('', None)]
+            label = f"Line {line_number}: {' '.join(parts)}" if parts else f"Line {line_number}"
+            if error:
+                print(f"{label}: Error: {error}")
+            elif failed:
+                print(f"{label}: not applied")
+            else:
+                print(f"{label}: OK")
+
+        if failed:
+            print(f"Error: {len(failed)} of {len(results)} actions failed, nothing was applied", file=sys.stderr)
+            sys.exit(1)
+
+        # All actions are valid: commit their blocks in one write
+        if blocks:
+            blockchain.add_blocks(blocks)
+    print(f"Applied {len(blocks)} actions")
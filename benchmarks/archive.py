@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# Compression ratio and read cost of archived chain segments.
+#
+#   python -m benchmarks.archive -n 200000
+#   python -m benchmarks.archive --chain /data/big.bin --frame-blocks 64 256 1024 -o archive.json
+#
+# A copy of the chain is sealed as one segment and read as it is, then
+# archived with every codec and frame size and read again. Each variant
+# reports the archive size, the time to write it and, read from a freshly
+# loaded chain:
+#   sequential  every record read and hashed in chain order, as verify does
+#   random      hash_at() of random blocks, as the sidecars' tip checks do
+import argparse
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Blocks read by the random access measurement
+RANDOM_READS = 2000
+
+def measure_reads(path, seed):
+    import hashlib
+    from blockchain import Blockchain
+
+    chain = Blockchain(path)
+    started = time.perf_counter()
+    size = 0
+    for _, record in chain.records():
+        hashlib.sha256(record).digest()
+        size += len(record)
+    sequential = time.perf_counter() - started
+
+    chain = Blockchain(path)
+    offsets = chain.offsets
+    picks = random.Random(seed).sample(range(len(offsets)), min(RANDOM_READS, len(offsets)))
+    picks = [offsets[i] for i in picks]
+    times = []
+    for offset in picks:
+        started = time.perf_counter()
+        chain.hash_at(offset)
+        times.append(time.perf_counter() - started)
+    return {
+        'sequential_s': sequential,
+        'sequential_mb_s': size / sequential / 1e6,
+        'random_median_us': statistics.median(times) * 1e6,
+        'random_p99_us': sorted(times)[int(len(times) * 0.99)] * 1e6,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure archived segments against raw ones')
+    parser.add_argument('--chain', help='Chain to measure (default: generate one)')
+    parser.add_argument('-n', '--blocks', type=int, default=200000, help='Blocks of the generated chain')
+    parser.add_argument('--codecs', nargs='+', default=['zlib', 'lzma'], help='Codecs to measure')
+    parser.add_argument('--level', type=int, default=6, help='Compression level')
+    parser.add_argument('--frame-blocks', type=int, nargs='+', default=[64, 256, 1024], help='Frame sizes to measure')
+    parser.add_argument('-o', '--output', help='Also write the results to this JSON file')
+    args = parser.parse_args()
+
+    sys.path.insert(0, REPO)
+    from archive import archive_segment
+    from blockchain import Blockchain, FOOTER
+    from benchmarks.generate import generate, parse_mix, DEFAULT_MIX
+
+    with tempfile.TemporaryDirectory() as tmp:
+        source = args.chain
+        if source is None:
+            source = os.path.join(tmp, 'generated.bin')
+            print(f"Generating {args.blocks:,} blocks...", flush=True)
+            generate(source, args.blocks, 50, 200, parse_mix(DEFAULT_MIX), 60.0, 1)
+
+        results = []
+        variants = [(None, None)] + [(codec, frame_blocks) for codec in args.codecs
+                                     for frame_blocks in args.frame_blocks]
+        for codec, frame_blocks in variants:
+            work = os.path.join(tmp, 'work')
+            os.mkdir(work)
+            chain = os.path.join(work, 'blockchain.bin')
+            shutil.copyfile(source, chain)
+            Blockchain(chain, 'none').seal()
+            segment = Blockchain(chain).segments[0]
+            size = segment.length + FOOTER.size
+            result = {'codec': codec or 'raw', 'frame_blocks': frame_blocks, 'blocks': segment.count,
+                      'raw_bytes': size}
+            if codec:
+                started = time.perf_counter()
+                size = archive_segment(segment, codec, args.level, frame_blocks)
+                result['archive_s'] = time.perf_counter() - started
+            result['bytes'] = size
+            result['ratio'] = result['raw_bytes'] / size
+            result.update(measure_reads(chain, 1))
+            results.append(result)
+            label = f"{codec} x{frame_blocks}" if codec else "raw"
+            print(f"{label:14} {size / 1e6:8.2f} MB  {result['ratio']:5.2f}x  "
+                  f"write {result.get('archive_s', 0):6.2f} s  "
+                  f"sequential {result['sequential_mb_s']:7.1f} MB/s  "
+                  f"random {result['random_median_us']:8.1f} us (p99 {result['random_p99_us']:8.1f})", flush=True)
+            shutil.rmtree(work)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'level': args.level, 'results': results}, f, indent=1)
+        print(f"Results written to {args.output}")
+
+if __name__ == "__main__":
+    main()
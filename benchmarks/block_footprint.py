@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# Per-block memory footprint and parse rate of Blockchain/Block.
+#
+#   python -m benchmarks.block_footprint -n 200000
+#   python -m benchmarks.block_footprint -n 200000 --repo /path/to/other/checkout
+#
+# The chain file is written with struct directly, so the same file can be
+# loaded by any version of the code passed with --repo.
+import argparse
+import gc
+import os
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+
+FORMAT = '32s d 32s 32s 12s 12s 12s I'
+
+def write_chain(filename, num_blocks):
+    record = struct.Struct(FORMAT)
+    with open(filename, 'wb') as f:
+        f.write(record.pack(bytes(32), time.time(), b"0" * 32, b"0" * 32,
+                            b"INITIAL", bytes(12), bytes(12), 14) + b"Initial block\0")
+        now = time.time()
+        for i in range(1, num_blocks):
+            f.write(record.pack(bytes(32), now + i, b"%032x" % (i % 97), b"%032x" % i,
+                                b"CHECKEDIN", b"creator", b"POLICE", 0))
+
+def load(filename, touch):
+    from blockchain import Blockchain
+
+    blocks = list(Blockchain(filename).blocks)
+    if touch:
+        for block in blocks:
+            block.state
+    return blocks
+
+def measure(filename, touch):
+    gc.collect()
+    start = time.perf_counter()
+    blocks = load(filename, touch)
+    elapsed = time.perf_counter() - start
+    del blocks
+
+    # Memory is traced in a separate run, tracing distorts the timing
+    gc.collect()
+    tracemalloc.start()
+    blocks = load(filename, touch)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'blocks': len(blocks),
+        'seconds': elapsed,
+        'blocks_per_second': len(blocks) / elapsed,
+        'bytes_per_block': current / len(blocks),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure Block memory footprint and parse rate')
+    parser.add_argument('-n', '--num_blocks', type=int, default=100000, help='Blocks in the chain')
+    parser.add_argument('--repo', default=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        help='Checkout whose block.py/blockchain.py are measured')
+    args = parser.parse_args()
+
+    sys.path.insert(0, args.repo)
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, 'blockchain.bin')
+        write_chain(filename, args.num_blocks)
+        for touch in (False, True):
+            result = measure(filename, touch)
+            label = 'load + read state' if touch else 'load'
+            print(f"{label:18} {result['blocks']} blocks  "
+                  f"{result['blocks_per_second']:,.0f} blocks/s  "
+                  f"{result['bytes_per_block']:,.0f} bytes/block")
+
+if __name__ == "__main__":
+    main()
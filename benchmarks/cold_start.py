@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# Cold start of the bchoc entry point: wall time of whole `show cases`
+# processes on a small chain, against the bare interpreter.
+#
+#   python -m benchmarks.cold_start -k 21
+#   python -m benchmarks.cold_start --target-ms 150
+#
+# Scripts call bchoc once per action, so for small chains startup is most of
+# the cost of a command. The run fails (exit status 1) when the median is
+# above the target. `bchoc --startup-profile show cases` shows where the
+# time goes.
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+CASE_ID = '11111111-2222-3333-4444-555555555555'
+# Median wall time of `bchoc show cases` on a two-item chain, in ms
+TARGET_MS = 120
+
+def timed_runs(argv, runs, env):
+    times = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run(argv, env=env, stdout=subprocess.DEVNULL, check=True)
+        times.append((time.perf_counter() - started) * 1000)
+    return times
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the startup time of bchoc commands')
+    parser.add_argument('-k', '--runs', type=int, default=21, help='Processes started per measurement')
+    parser.add_argument('--target-ms', type=float, default=TARGET_MS, help='Median to stay under')
+    args = parser.parse_args()
+
+    main_py = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'main.py')
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, BCHOC_FILE_PATH=os.path.join(tmp, 'blockchain.bin'))
+        subprocess.run([sys.executable, main_py, 'init'], env=env, stdout=subprocess.DEVNULL, check=True)
+        subprocess.run([sys.executable, main_py, 'add', '-c', CASE_ID, '-i', '1', '-i', '2', '-g', 'bench',
+                        '-p', 'C67C'], env=env, stdout=subprocess.DEVNULL, check=True)
+
+        interpreter = timed_runs([sys.executable, '-c', 'pass'], args.runs, env)
+        show_cases = timed_runs([sys.executable, main_py, 'show', 'cases'], args.runs, env)
+
+    median = statistics.median(show_cases)
+    print(f"python -c pass   median {statistics.median(interpreter):6.1f} ms  min {min(interpreter):6.1f} ms")
+    print(f"bchoc show cases median {median:6.1f} ms  min {min(show_cases):6.1f} ms  "
+          f"(target {args.target_ms:.0f} ms: {'ok' if median <= args.target_ms else 'MISSED'})")
+    sys.exit(0 if median <= args.target_ms else 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# Commit throughput of N processes appending to one chain at the same time.
+#
+#   python -m benchmarks.concurrent_writers -w 1 2 4 8 -k 200
+#   python -m benchmarks.concurrent_writers --same-item
+#
+# Every writer alternates checkout/checkin the way the CLI commands do:
+# read the item's latest state, check it, append, all in one transaction.
+# With --same-item all writers fight over a single item, so every action
+# depends on the one before it. Afterwards the chain is verified: every
+# block must link to its predecessor and no item may be checked in or out
+# twice in a row.
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+CASE_ID = '11111111-2222-3333-4444-555555555555'
+
+def create_chain(filename, num_items):
+    from block import Block
+    from blockchain import Blockchain
+
+    blockchain = Blockchain(filename)
+    blockchain.init_blockchain()
+    blockchain.add_blocks([Block(case_id=CASE_ID, evidence_id=item_id, state=b"CHECKEDIN",
+                                 creator=b"bench", owner=b"", data=b"")
+                           for item_id in range(1, num_items + 1)])
+
+def writer(filename, item_id, actions, start):
+    from blockchain import open_blockchain
+    from evidence_index import find_evidence_item
+    from checkin import checkin_error, checkin_block
+    from checkout import checkout_error, checkout_block
+
+    start.wait()
+    blockchain = open_blockchain(filename)
+    for _ in range(actions):
+        with blockchain.transaction():
+            existing_block = find_evidence_item(blockchain, item_id)
+            if existing_block.state.rstrip(b'\0') == b"CHECKEDIN":
+                assert not checkout_error(existing_block, item_id, 'P80P')
+                block, _ = checkout_block(existing_block, item_id, 'P80P')
+            else:
+                assert not checkin_error(existing_block, item_id, 'P80P')
+                block, _ = checkin_block(existing_block, item_id, 'P80P')
+            blockchain.add_block(block)
+
+def check(filename):
+    from blockchain import Blockchain
+    from verify import verify_range
+
+    result = verify_range(Blockchain(filename), 0, None, 0, 1, None)
+    return result['count'], result['violations']
+
+def run_writers(num_writers, actions, same_item):
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, 'blockchain.bin')
+        create_chain(filename, num_writers)
+        start = multiprocessing.Barrier(num_writers + 1)
+        processes = [multiprocessing.Process(target=writer, args=(
+            filename, 1 if same_item else i + 1, actions, start)) for i in range(num_writers)]
+        for process in processes:
+            process.start()
+        start.wait()
+        started = time.perf_counter()
+        for process in processes:
+            process.join()
+        elapsed = time.perf_counter() - started
+        if any(process.exitcode for process in processes):
+            raise RuntimeError("a writer failed")
+        count, violations = check(filename)
+        expected = 1 + num_writers + num_writers * actions
+        return {
+            'writers': num_writers,
+            'commits': num_writers * actions,
+            'seconds': elapsed,
+            'commits_per_second': num_writers * actions / elapsed,
+            'chain_ok': count == expected and not violations,
+        }
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure commit throughput of concurrent writers')
+    parser.add_argument('-w', '--writers', type=int, nargs='+', default=[1, 2, 4, 8],
+                        help='Numbers of concurrent writer processes to try')
+    parser.add_argument('-k', '--actions', type=int, default=200, help='Commits per writer')
+    parser.add_argument('--same-item', action='store_true', help='All writers act on one item')
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    for num_writers in args.writers:
+        result = run_writers(num_writers, args.actions, args.same_item)
+        print(f"{result['writers']:3} writers  {result['commits']} commits  "
+              f"{result['commits_per_second']:,.0f} commits/s  "
+              f"chain {'ok' if result['chain_ok'] else 'CORRUPT'}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# Synthetic chain generator for benchmarks.
+#
+#   python -m benchmarks.generate -n 1000000 -o /tmp/bench/blockchain.bin
+#   python -m benchmarks.generate -n 10000 --cases 5 --items-per-case 100 \
+#       --mix checkout=40,checkin=40,remove=20 -o small.bin
+#
+# Writes a valid chain (every block linked to the hash of the one before
+# it, every transition allowed) built from Block records exactly like the
+# commands write them: items are added checked in to their case, then
+# checked out, checked in and removed at random with the given weights.
+# Items are added spread over the whole chain, about one add per
+# blocks/items blocks. Timestamps increase by --interval seconds and end at
+# the current time.
+#
+# Next to the chain, <output>.manifest.json records the parameters, the
+# case IDs and sample items in every final state, for benchmarks.run.
+import argparse
+import hashlib
+import json
+import os
+import random
+import sys
+import time
+import uuid
+
+ROLES = ['POLICE', 'LAWYER', 'ANALYST', 'EXECUTIVE']
+REASONS = ['DESTROYED', 'DISPOSED', 'RELEASED']
+CREATORS = [b'alice', b'bob', b'carol']
+DEFAULT_MIX = 'checkout=45,checkin=45,remove=10'
+# Items per final state listed in the manifest
+SAMPLES = 100
+# Records written per write call
+WRITE_BATCH = 10000
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name not in ('checkout', 'checkin', 'remove'):
+            raise ValueError(f"Unknown transition in mix: {name}")
+        mix[name] = float(weight)
+    return mix
+
+class ChainModel:
+    """Item states of the chain being generated"""
+    def __init__(self, rng, case_ids, items_per_case):
+        self.rng = rng
+        self.case_ids = case_ids
+        self.items_per_case = items_per_case
+        self.added = 0
+        # item -> [case_id, state, creator, owner]
+        self.items = {}
+        # Items that can still change, by state, for picking one at random
+        self.by_state = {'CHECKEDIN': [], 'CHECKEDOUT': []}
+        self.positions = {}
+
+    @property
+    def total_items(self):
+        return len(self.case_ids) * self.items_per_case
+
+    def _move(self, item_id, state):
+        old = self.items[item_id][1]
+        if old in self.by_state:
+            # Swap-remove from the old state's list
+            items = self.by_state[old]
+            i = self.positions.pop(item_id)
+            last = items.pop()
+            if last != item_id:
+                items[i] = last
+                self.positions[last] = i
+        self.items[item_id][1] = state
+        if state in self.by_state:
+            self.positions[item_id] = len(self.by_state[state])
+            self.by_state[state].append(item_id)
+
+    def add(self):
+        """Add the next item; past the configured items, new ones are added
+        to random cases"""
+        case_index = self.added // self.items_per_case
+        if case_index >= len(self.case_ids):
+            case_index = self.rng.randrange(len(self.case_ids))
+        self.added += 1
+        item_id = self.added
+        self.items[item_id] = [self.case_ids[case_index], None, self.rng.choice(CREATORS), b'']
+        self._move(item_id, 'CHECKEDIN')
+        return item_id
+
+    def pick(self, mix):
+        """Choose a transition allowed by the current states, or None"""
+        choices = []
+        if self.by_state['CHECKEDIN']:
+            choices += [('checkout', mix.get('checkout', 0)), ('remove', mix.get('remove', 0))]
+        if self.by_state['CHECKEDOUT']:
+            choices.append(('checkin', mix.get('checkin', 0)))
+        choices = [(name, weight) for name, weight in choices if weight > 0]
+        if not choices:
+            return None
+        return self.rng.choices([name for name, _ in choices], [weight for _, weight in choices])[0]
+
+    def apply(self, action):
+        """Apply a transition to a random item it is allowed for and return
+        the item"""
+        source = 'CHECKEDOUT' if action == 'checkin' else 'CHECKEDIN'
+        item_id = self.rng.choice(self.by_state[source])
+        item = self.items[item_id]
+        if action == 'checkout':
+            item[3] = self.rng.choice(ROLES).encode()
+            state = 'CHECKEDOUT'
+        elif action == 'checkin':
+            item[3] = self.rng.choice(ROLES).encode()
+            state = 'CHECKEDIN'
+        else:
+            state = self.rng.choice(REASONS)
+        self._move(item_id, state)
+        return item_id
+
+def generate(path, num_blocks, num_cases, items_per_case, mix, interval, seed):
+    from block import Block
+
+    rng = random.Random(seed)
+    case_ids = [str(uuid.UUID(int=rng.getrandbits(128), version=4)) for _ in range(num_cases)]
+    model = ChainModel(rng, case_ids, items_per_case)
+    # Chance of an add at each block, so the configured items are spread
+    # over the chain
+    add_rate = min(1.0, model.total_items / max(1, num_blocks - 1))
+    start = time.time() - num_blocks * interval
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        genesis = Block.create_initial_block()
+        genesis.timestamp = start
+        record = genesis.serialize()
+        prev_hash = hashlib.sha256(record).digest()
+        records = [record]
+        for i in range(1, num_blocks):
+            if model.added < model.total_items and rng.random() < add_rate:
+                action = 'add'
+            else:
+                action = model.pick(mix) or 'add'
+            item_id = model.add() if action == 'add' else model.apply(action)
+            case_id, state, creator, owner = model.items[item_id]
+            block = Block(prev_hash=prev_hash, case_id=case_id, evidence_id=item_id, state=state.encode(),
+                          creator=creator, owner=owner, data=b"")
+            block.timestamp = start + i * interval
+            record = block.serialize()
+            prev_hash = hashlib.sha256(record).digest()
+            records.append(record)
+            if len(records) >= WRITE_BATCH:
+                f.write(b"".join(records))
+                records = []
+        f.write(b"".join(records))
+    os.replace(tmp_path, path)
+
+    samples = {}
+    for item_id, (case_id, state, _, _) in model.items.items():
+        items = samples.setdefault(state, [])
+        if len(items) < SAMPLES:
+            items.append({'item': item_id, 'case': case_id})
+    return {
+        'blocks': num_blocks,
+        'cases': case_ids,
+        'items_per_case': items_per_case,
+        'items': len(model.items),
+        'mix': mix,
+        'interval': interval,
+        'seed': seed,
+        'first_timestamp': start,
+        'samples': samples,
+    }
+
+def manifest_path(path):
+    return path + '.manifest.json'
+
+def main():
+    parser = argparse.ArgumentParser(description='Write a valid synthetic chain for benchmarks')
+    parser.add_argument('-o', '--output', required=True, help='Chain file to write (replaced if it exists)')
+    parser.add_argument('-n', '--blocks', type=int, default=100000, help='Number of blocks, genesis included')
+    parser.add_argument('--cases', type=int, default=50, help='Number of cases')
+    parser.add_argument('--items-per-case', type=int, default=200, help='Items added to each case')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f'Transition weights (default {DEFAULT_MIX})')
+    parser.add_argument('--interval', type=float, default=60.0, help='Seconds between block timestamps')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed')
+    args = parser.parse_args()
+
+    if args.blocks < 1 or args.cases < 1 or args.items_per_case < 1:
+        parser.error("--blocks, --cases and --items-per-case must be positive")
+    try:
+        mix = parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    started = time.perf_counter()
+    manifest = generate(args.output, args.blocks, args.cases, args.items_per_case, mix,
+                        args.interval, args.seed)
+    with open(manifest_path(args.output), 'w') as f:
+        json.dump(manifest, f, indent=1)
+    elapsed = time.perf_counter() - started
+    print(f"Wrote {args.blocks:,} blocks, {manifest['items']:,} items in {args.cases} cases "
+          f"to {args.output} in {elapsed:.1f} s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# Timed scenarios of the bchoc commands on a generated chain.
+#
+#   python -m benchmarks.run -n 100000 -o results.json
+#   python -m benchmarks.generate -n 10000000 -o /data/big.bin
+#   python -m benchmarks.run --chain /data/big.bin -k 3 -o big.json
+#   python -m benchmarks.run --chain /data/big.bin --repo /path/to/other/checkout -o other.json
+#
+# Every scenario runs the real command line (main.py of --repo) in its own
+# process against a working copy of the chain. The first run of each
+# scenario is cold: the sidecar files (indexes, snapshots, checkpoints) are
+# deleted before it, so it pays for rebuilding whatever it needs. The
+# other runs are warm. The OS page cache is left alone.
+#
+# Per run the results record wall time, CPU time, peak RSS, page faults
+# and the process's I/O counters from /proc/<pid>/io: rchar/wchar (bytes
+# passed to read/write calls), read_bytes/write_bytes (bytes that reached
+# storage). The chain is read through mmap, which only shows up as page
+# faults.
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Sealed segments of a segmented chain are part of the chain, not sidecars
+SEGMENT_SUFFIX = '.seg.'
+IO_FIELDS = ('rchar', 'wchar', 'read_bytes', 'write_bytes')
+
+def scenarios(manifest, runs):
+    """Return (name, [argv per run]) of every scenario.
+
+    Commands that change the chain get a different item on every run, in
+    a state that allows the action.
+    """
+    case_id = manifest['cases'][0]
+    samples = manifest['samples']
+    checked_in = [sample['item'] for sample in samples.get('CHECKEDIN', [])]
+    checked_out = [sample['item'] for sample in samples.get('CHECKEDOUT', [])]
+    # Checkouts and removals both need checked in items; they take turns
+    to_check_out, to_remove = checked_in[0::2], checked_in[1::2]
+    any_item = (checked_in + checked_out + [1])[0]
+    new_item = manifest['items'] + 1
+
+    def each(make, items):
+        return [make(item) for item in items[:runs]]
+
+    return [
+        ('init', [['init']] * runs),
+        ('add', [['add', '-c', case_id, '-i', str(new_item + i), '-g', 'bench', '-p', 'C67C']
+                 for i in range(runs)]),
+        ('checkout', each(lambda item: ['checkout', '-i', str(item), '-p', 'P80P'], to_check_out)),
+        ('checkin', each(lambda item: ['checkin', '-i', str(item), '-p', 'P80P'], checked_out)),
+        ('remove', each(lambda item: ['remove', '-i', str(item), '-y', 'DISPOSED', '-p', 'C67C'], to_remove)),
+        ('show cases', [['show', 'cases']] * runs),
+        ('show cases --summary', [['show', 'cases', '--summary']] * runs),
+        ('show items', [['show', 'items', '-c', case_id]] * runs),
+        ('show history -n 100', [['show', 'history', '-n', '100']] * runs),
+        ('show history -r -n 10', [['show', 'history', '-r', '-n', '10']] * runs),
+        ('show history -i', [['show', 'history', '-i', str(any_item), '-p', 'P80P']] * runs),
+        ('dump', [['dump', '-i', str(any_item), '-p', 'P80P']] * runs),
+        ('verify', [['verify']] * runs),
+        ('verify --full', [['verify', '--full']] * runs),
+    ]
+
+def run_process(argv, env):
+    """Run a command and return its measurements"""
+    started = time.perf_counter()
+    process = subprocess.Popen(argv, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    stderr = process.stderr.read()
+    # Wait without reaping, so /proc/<pid>/io is still there to be read
+    os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+    elapsed = time.perf_counter() - started
+    io = {}
+    try:
+        with open(f'/proc/{process.pid}/io') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key in IO_FIELDS:
+                    io[key] = int(value)
+    except OSError:
+        pass
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    process.stderr.close()
+    result = {
+        'status': process.returncode,
+        'wall_s': elapsed,
+        'user_s': usage.ru_utime,
+        'sys_s': usage.ru_stime,
+        'max_rss_kb': usage.ru_maxrss,
+        'minor_faults': usage.ru_minflt,
+        'major_faults': usage.ru_majflt,
+    }
+    result.update(io)
+    if process.returncode:
+        result['stderr'] = stderr.decode(errors='replace')[-500:]
+    return result
+
+def clear_sidecars(work_dir, chain_name):
+    for name in os.listdir(work_dir):
+        if name.startswith(chain_name + '.') and not name.startswith(chain_name + SEGMENT_SUFFIX):
+            os.unlink(os.path.join(work_dir, name))
+
+def summarize(runs):
+    warm = runs[1:] or runs
+    return {
+        'cold_wall_s': runs[0]['wall_s'],
+        'warm_median_wall_s': statistics.median(run['wall_s'] for run in warm),
+        'max_rss_kb': max(run['max_rss_kb'] for run in runs),
+        'failed_runs': sum(1 for run in runs if run['status']),
+    }
+
+def git_commit(repo):
+    try:
+        return subprocess.run(['git', '-C', repo, 'rev-parse', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description='Run timed scenarios of the bchoc commands')
+    parser.add_argument('--chain', help='Chain written by benchmarks.generate (default: generate one)')
+    parser.add_argument('-n', '--blocks', type=int, default=100000, help='Blocks of the generated chain')
+    parser.add_argument('--cases', type=int, default=50, help='Cases of the generated chain')
+    parser.add_argument('--items-per-case', type=int, default=200, help='Items per case of the generated chain')
+    parser.add_argument('-k', '--runs', type=int, default=5, help='Runs per scenario, the first one cold')
+    parser.add_argument('--repo', default=REPO, help='Checkout whose main.py is benchmarked')
+    parser.add_argument('--only', nargs='+', help='Run only the scenarios with these names')
+    parser.add_argument('-o', '--output', default='benchmark-results.json', help='JSON file for the results')
+    args = parser.parse_args()
+
+    sys.path.insert(0, REPO)
+    from benchmarks.generate import generate, manifest_path, parse_mix, DEFAULT_MIX
+
+    main_py = os.path.join(os.path.abspath(args.repo), 'main.py')
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.chain:
+            with open(manifest_path(args.chain)) as f:
+                manifest = json.load(f)
+            source = args.chain
+        else:
+            source = os.path.join(tmp, 'generated.bin')
+            print(f"Generating {args.blocks:,} blocks...", flush=True)
+            manifest = generate(source, args.blocks, args.cases, args.items_per_case,
+                                parse_mix(DEFAULT_MIX), 60.0, 1)
+
+        work_dir = os.path.join(tmp, 'work')
+        os.mkdir(work_dir)
+        chain = os.path.join(work_dir, 'blockchain.bin')
+        shutil.copyfile(source, chain)
+        env = dict(os.environ, BCHOC_FILE_PATH=chain,
+                   # Never hand the commands to a resident server
+                   BCHOC_SOCKET=os.path.join(work_dir, 'no-server.sock'))
+
+        results = []
+        for name, argvs in scenarios(manifest, args.runs):
+            if args.only and name not in args.only:
+                continue
+            if name == 'init':
+                # On a new, empty chain
+                run_env = dict(env, BCHOC_FILE_PATH=os.path.join(work_dir, 'init.bin'))
+            else:
+                run_env = env
+            runs = []
+            for i, argv in enumerate(argvs):
+                if i == 0:
+                    clear_sidecars(work_dir, os.path.basename(chain))
+                if name == 'init':
+                    clear_sidecars(work_dir, 'init')
+                    if os.path.exists(run_env['BCHOC_FILE_PATH']):
+                        os.unlink(run_env['BCHOC_FILE_PATH'])
+                run = run_process([sys.executable, main_py] + argv, run_env)
+                run['argv'] = argv
+                runs.append(run)
+            if not runs:
+                continue
+            summary = summarize(runs)
+            results.append({'name': name, 'summary': summary, 'runs': runs})
+            print(f"{name:24} cold {summary['cold_wall_s'] * 1000:9.1f} ms  "
+                  f"warm {summary['warm_median_wall_s'] * 1000:9.1f} ms  "
+                  f"rss {summary['max_rss_kb'] / 1024:7.1f} MB"
+                  + (f"  {summary['failed_runs']} FAILED" if summary['failed_runs'] else ""), flush=True)
+
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'repo': os.path.abspath(args.repo),
+        'commit': git_commit(args.repo),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'chain': dict({key: manifest[key] for key in ('blocks', 'items_per_case', 'items', 'mix', 'seed')},
+                      cases=len(manifest['cases'])),
+        'runs_per_scenario': args.runs,
+        'scenarios': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=1)
+    print(f"Results written to {args.output}")
+
+if __name__ == "__main__":
+    main()
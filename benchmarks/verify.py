@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# Throughput of `bchoc verify` on a large chain.
+#
+#   python -m benchmarks.verify                      # 10,000,000 blocks
+#   python -m benchmarks.verify --chain big.bin --jobs 1 2 4 -o verify.json
+#
+# Every run is a whole `bchoc verify` process: one with --full in-process,
+# one per --jobs value with --full, and one incremental run that resumes
+# from the checkpoint the previous run left after a few more blocks were
+# appended. Each reports its wall time and the blocks verified per second.
+# Runs on a given --chain leave their checkpoints next to it.
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CASE_ID = '11111111-2222-3333-4444-555555555555'
+# Blocks appended before the incremental run
+APPENDED = 100
+
+def timed_verify(env, *args):
+    started = time.perf_counter()
+    result = subprocess.run([sys.executable, os.path.join(REPO, 'main.py'), 'verify', *args],
+                            env=env, capture_output=True, text=True)
+    elapsed = time.perf_counter() - started
+    if result.returncode != 0:
+        sys.exit(f"verify {' '.join(args)} failed: {result.stdout}{result.stderr}")
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the throughput of verify')
+    parser.add_argument('--chain', help='Chain to verify (default: generate one)')
+    parser.add_argument('-n', '--blocks', type=int, default=10_000_000, help='Blocks of the generated chain')
+    parser.add_argument('--jobs', type=int, nargs='+', default=[1, 2, os.cpu_count() or 1],
+                        help='Worker counts to measure')
+    parser.add_argument('-o', '--output', help='Also write the results to this JSON file')
+    args = parser.parse_args()
+    if args.blocks < 1 or min(args.jobs) < 1:
+        parser.error("--blocks and --jobs must be positive")
+
+    sys.path.insert(0, REPO)
+    from blockchain import Blockchain
+    from benchmarks.generate import generate, parse_mix, DEFAULT_MIX
+
+    with tempfile.TemporaryDirectory() as tmp:
+        chain = args.chain
+        if chain is None:
+            chain = os.path.join(tmp, 'generated.bin')
+            print(f"Generating {args.blocks:,} blocks...", flush=True)
+            generate(chain, args.blocks, 50, 200, parse_mix(DEFAULT_MIX), 60.0, 1)
+        blocks = len(Blockchain(chain).offsets)
+        size = os.path.getsize(chain)
+        env = dict(os.environ, BCHOC_FILE_PATH=chain)
+        print(f"{blocks:,} blocks, {size / 1e6:,.0f} MB, {os.cpu_count()} CPUs", flush=True)
+
+        runs = [('full', [])] + [(f'full --jobs {jobs}', ['--jobs', str(jobs)])
+                                 for jobs in sorted(set(args.jobs))]
+        results = []
+        for label, extra in runs:
+            elapsed = timed_verify(env, '--full', *extra)
+            results.append({'run': label, 'blocks': blocks, 'seconds': elapsed, 'blocks_s': blocks / elapsed})
+            print(f"{label:18} {elapsed:8.2f} s  {blocks / elapsed:12,.0f} blocks/s", flush=True)
+
+        intake = os.path.join(tmp, 'intake.csv')
+        with open(intake, 'w') as f:
+            f.write("case_id,item_id,creator\n")
+            f.writelines(f"{CASE_ID},{900_000_000 + i},bench\n" for i in range(APPENDED))
+        subprocess.run([sys.executable, os.path.join(REPO, 'main.py'), 'add', '--from-file', intake, '-p', 'C67C'],
+                       env=env, stdout=subprocess.DEVNULL, check=True)
+        elapsed = timed_verify(env)
+        results.append({'run': 'incremental', 'blocks': APPENDED, 'seconds': elapsed})
+        print(f"{'incremental':18} {elapsed:8.2f} s  ({APPENDED} blocks appended since the checkpoint)")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'cpus': os.cpu_count(), 'results': results}, f, indent=1)
+        print(f"Results written to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -2,21 +2,91 @@ import struct
 import time
 import hashlib
 import uuid
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from cryptography.hazmat.primitives.padding import PKCS7
-from cryptography.hazmat.backends import default_backend
-from Crypto.Cipher import AES
+import ciphers
 from utils import get_role_passwords
+from profiling import timed
 
 
 
+def _field_layout(formats):
+    """Return (Struct, byte offset) of each fixed field of a record"""
+    layout = []
+    for i, field_format in enumerate(formats):
+        end = struct.calcsize(' '.join(formats[:i + 1]))
+        layout.append((struct.Struct(field_format), end - struct.calcsize(field_format)))
+    return layout
+
+_FIELDS = _field_layout(['32s', 'd', '32s', '32s', '12s', '12s', '12s', 'I'])
+
+def _field(index):
+    """Property for one record field.
+
+    Blocks read from the chain only keep a reference to the loaded buffer
+    and the offset of their record, and unpack a field each time it is
+    read, so reading does not grow the block. Setting a field unpacks the
+    record once and detaches the block from the buffer, so serialize() and
+    calculate_hash() see the change.
+    """
+    if index < len(_FIELDS):
+        field_struct, field_offset = _FIELDS[index]
+        def read(buffer, offset):
+            return field_struct.unpack_from(buffer, offset + field_offset)[0]
+    else:
+        def read(buffer, offset):
+            start = offset + Block.FIXED_SIZE
+            data_length = Block.DATA_LENGTH.unpack_from(buffer, offset + Block.DATA_LENGTH_OFFSET)[0]
+            return bytes(buffer[start:start + data_length])
+
+    def get(self):
+        fields = self._fields
+        if fields is None:
+            return read(self._buffer, self._offset)
+        return fields[index]
+
+    def set(self, value):
+        fields = self._fields
+        if fields is None:
+            fields = self._unpack()
+        fields[index] = value
+        self._buffer = None
+
+    return property(get, set)
+
+_new_block = object.__new__
+
 class Block:
     FORMAT = '32s d 32s 32s 12s 12s 12s I'
+    STRUCT = struct.Struct(FORMAT)
+    # Size of the fixed part of a record and byte positions of its fields
+    FIXED_SIZE = struct.calcsize(FORMAT)
+    TIMESTAMP_OFFSET = struct.calcsize('32s')
+    TIMESTAMP = struct.Struct('d')
+    CASE_ID_OFFSET = struct.calcsize('32s d')
+    EVIDENCE_ID_OFFSET = struct.calcsize('32s d 32s')
+    DATA_LENGTH_OFFSET = struct.calcsize('32s d 32s 32s 12s 12s 12s')
+    DATA_LENGTH = struct.Struct('I')
+    ENCRYPTION_KEY = ciphers.ENCRYPTION_KEY
+    encryption_key = ENCRYPTION_KEY
+
+    # _buffer/_offset: where the serialized record lives, _buffer is None
+    # for blocks built in memory or modified after loading
+    # _fields: unpacked field values (FORMAT order, then data), or None
+    __slots__ = ('_buffer', '_offset', '_fields')
+
+    prev_hash = _field(0)
+    timestamp = _field(1)
+    case_id = _field(2)
+    evidence_id = _field(3)
+    state = _field(4)
+    creator = _field(5)
+    owner = _field(6)
+    data_length = _field(7)
+    data = _field(8)
     
     def __init__(self, prev_hash=None, case_id=None, evidence_id=None, 
                  state=None, creator=None, owner=None, data=None, encryption_key=None):
-        # Use a fixed encryption key to match expected values
-        self.encryption_key = b'R0chLi4uLi4uLi4='
+        self._buffer = None
+        self._fields = [None] * 9
         
         # Previous hash should be 0 for new blocks
         self.prev_hash = prev_hash if prev_hash else bytes(32)
@@ -24,24 +94,12 @@ class Block:
         
         # Handle Case ID (UUID)
         if case_id:
-            # Convert case_id to UUID bytes (16 bytes)
-            uuid_obj = uuid.UUID(case_id)
-            case_id_bytes = uuid_obj.bytes
-            # Encrypt using AES-ECB
-            cipher = AES.new(self.encryption_key, AES.MODE_ECB)
-            encrypted_case_id = cipher.encrypt(self._pad_to_16_bytes(case_id_bytes))
-            self.case_id = encrypted_case_id.hex().encode()
+            self.case_id = self.encrypt_case_id(case_id)
         else:
             self.case_id = bytes(32)
         
         if evidence_id is not None:
-            # Convert integer directly to 16 bytes using big endian
-            item_id_bytes = evidence_id.to_bytes(16, byteorder='big')
-            # Encrypt using AES-ECB
-            cipher = AES.new(self.encryption_key, AES.MODE_ECB)
-            encrypted_evidence_id = cipher.encrypt(item_id_bytes)
-            # Convert to hex string and encode as bytes
-            self.evidence_id = encrypted_evidence_id.hex().encode()[:32]
+            self.evidence_id = self.encrypt_evidence_id(evidence_id)
         else:
             self.evidence_id = bytes(32)
         
@@ -68,6 +126,28 @@ class Block:
         self.creator = self._pad_to_12_bytes(creator if creator else b"")
         self.data_length = 0  # Always 0 for new blocks
 
+    @classmethod
+    @timed('block.encrypt')
+    def encrypt_case_id(cls, case_id):
+        """Encrypt a case UUID the way it is stored in the chain (hex bytes)"""
+        # Convert case_id to UUID bytes (16 bytes)
+        uuid_obj = uuid.UUID(case_id)
+        case_id_bytes = uuid_obj.bytes
+        # Encrypt using AES-ECB (a UUID is exactly one 16-byte AES block)
+        encrypted_case_id = ciphers.get_cipher().encrypt(case_id_bytes)
+        return encrypted_case_id.hex().encode()
+
+    @classmethod
+    @timed('block.encrypt')
+    def encrypt_evidence_id(cls, evidence_id):
+        """Encrypt an item ID the way it is stored in the chain (hex bytes)"""
+        # Convert integer directly to 16 bytes using big endian
+        item_id_bytes = evidence_id.to_bytes(16, byteorder='big')
+        # Encrypt using AES-ECB
+        encrypted_evidence_id = ciphers.get_cipher().encrypt(item_id_bytes)
+        # Convert to hex string and encode as bytes
+        return encrypted_evidence_id.hex().encode()[:32]
+
     def _pad_to_32_bytes(self, data):
         """Ensure data is exactly 32 bytes"""
         if len(data) > 32:
@@ -88,26 +168,6 @@ class Block:
             return data[:12]
         return data + bytes(12 - len(data))
 
-    def _encrypt_data(self, data):
-        """Encrypt data using AES-ECB"""
-        cipher = Cipher(
-            algorithms.AES(self.encryption_key),
-            modes.ECB(),
-            backend=default_backend()
-        )
-        encryptor = cipher.encryptor()
-        return encryptor.update(data) + encryptor.finalize()
-
-    def _decrypt_data(self, encrypted_data):
-        """Decrypt data using AES-ECB"""
-        cipher = Cipher(
-            algorithms.AES(self.encryption_key),
-            modes.ECB(),
-            backend=default_backend()
-        )
-        decryptor = cipher.decryptor()
-        return decryptor.update(encrypted_data) + decryptor.finalize()
-
     @classmethod
     def create_initial_block(cls):
         """Creates the genesis block with specified initial values"""
@@ -123,27 +183,15 @@ class Block:
         block.data_length = 14  # Exactly 14 bytes
         return block
 
+    @timed('block.decrypt')
     def get_decrypted_values(self, password=None):
         # Check if the provided password matches the creator's password
         if password == get_role_passwords().get('creator'):
             try:
-                # Decrypt case_id
-                cipher = AES.new(self.encryption_key, AES.MODE_ECB)
-                encrypted_case_id = bytes.fromhex(self.case_id.decode())
-                decrypted_case_id = cipher.decrypt(encrypted_case_id)
-                case_id_bytes = decrypted_case_id[:16]
-                case_id = str(uuid.UUID(bytes=case_id_bytes))
-                
-                # Decrypt evidence_id
-                cipher = AES.new(self.encryption_key, AES.MODE_ECB)
-                encrypted_evidence_id = bytes.fromhex(self.evidence_id.decode())
-                decrypted_evidence_id = cipher.decrypt(encrypted_evidence_id)
-                # Since we stored it as 16 bytes big endian, read first 4 bytes
-                evidence_id = int.from_bytes(decrypted_evidence_id[-4:], byteorder='big')
-                
+                # Decryption results are cached per ciphertext
                 return {
-                    'case_id': case_id,
-                    'evidence_id': evidence_id
+                    'case_id': ciphers.decrypt_case_id(bytes(self.case_id)),
+                    'evidence_id': ciphers.decrypt_evidence_id(bytes(self.evidence_id))
                 }
             except Exception as e:
                 print(f"Decryption error: {str(e)}")
@@ -156,7 +204,24 @@ class Block:
             'evidence_id': None
         }
 
+    def _record(self):
+        """Return the serialized record this block was loaded from"""
+        buffer = self._buffer
+        offset = self._offset
+        data_length = self.DATA_LENGTH.unpack_from(buffer, offset + self.DATA_LENGTH_OFFSET)[0]
+        return buffer[offset:offset + self.FIXED_SIZE + data_length]
+
+    def _unpack(self):
+        record = self._record()
+        fields = list(self.STRUCT.unpack_from(record))
+        fields.append(bytes(record[self.FIXED_SIZE:]))
+        self._fields = fields
+        return fields
+
+    @timed('block.serialize')
     def serialize(self):
+        if self._buffer is not None:
+            return bytes(self._record())
         fixed_fields = struct.pack(
             self.FORMAT,
             self.prev_hash,
@@ -171,16 +236,27 @@ class Block:
         return fixed_fields + self.data
 
     @classmethod
-    def deserialize(cls, data):
-        fixed_size = struct.calcsize(cls.FORMAT)
-        fields = struct.unpack(cls.FORMAT, data[:fixed_size])
-        block_data = data[fixed_size:fixed_size + fields[7]]
-        
-        block = cls()
-        (block.prev_hash, block.timestamp, block.case_id, block.evidence_id,
-         block.state, block.creator, block.owner, block.data_length) = fields
-        block.data = block_data
+    def from_buffer(cls, buffer, offset=0):
+        """Wrap the record at offset in buffer without copying or parsing it.
+
+        buffer is typically a memoryview of the mapped chain file. __init__
+        is not run, so nothing is encrypted, padded or timestamped; fields
+        are unpacked from the buffer when they are read.
+        """
+        block = _new_block(cls)
+        block._buffer = buffer
+        block._offset = offset
+        block._fields = None
         return block
 
+    @classmethod
+    def deserialize(cls, data):
+        # Reject records that are too short to hold the fixed fields
+        cls.STRUCT.unpack_from(data)
+        return cls.from_buffer(data)
+
+    @timed('block.calculate_hash')
     def calculate_hash(self):
-        return hashlib.sha256(self.serialize()).digest()
\ No newline at end of file
+        if self._buffer is not None:
+            return hashlib.sha256(self._record()).digest()
+        return hashlib.sha256(self.serialize()).digest()
@@ -0,0 +1,80 @@
+import argparse
+import hashlib
+import json
+import sys
+from block import Block
+import ciphers
+from merkle import leaf_hash, verify_inclusion
+from profiling import timed
+
+# Checks the proofs written by `bchoc prove` against a published root. Only
+# the proof file is read: each block's hash is recomputed from its record
+# and folded up its audit path, O(log n) hashes per block.
+
+def parse_check_proof_args(args):
+    parser = argparse.ArgumentParser(description='Check Merkle inclusion proofs against a published root')
+    parser.add_argument('file', help="Proof file written by 'bchoc prove' ('-' for standard input)")
+    parser.add_argument('--root', required=True, help='Published root hash (hex)')
+    parser.add_argument('--tree-size', type=int, help='Number of blocks the published root covers')
+    return parser.parse_args(args)
+
+def _describe(record):
+    """Return (item ID, state) recorded in a block, or (None, None)"""
+    try:
+        block = Block.from_buffer(record)
+        state = block.state.rstrip(b'\0').decode()
+        return ciphers.decrypt_evidence_id(bytes(block.evidence_id)), state
+    except (ValueError, UnicodeDecodeError, IndexError):
+        return None, None
+
+@timed('check_proof.run')
+def check_proofs(path, root_hex, tree_size=None):
+    try:
+        if path == '-':
+            document = json.load(sys.stdin)
+        else:
+            with open(path) as f:
+                document = json.load(f)
+        root = bytes.fromhex(root_hex)
+        proof_size = document['tree_size']
+        item_id = document['item_id']
+        proofs = document['proofs']
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        print(f"Error: cannot read proof file {path}: {e}")
+        exit(1)
+    if tree_size is not None and tree_size != proof_size:
+        print(f"Error: the proofs are for a tree of {proof_size} blocks, not {tree_size}")
+        exit(1)
+
+    failed = 0
+    for proof in proofs:
+        try:
+            index = proof['index']
+            record = bytes.fromhex(proof['record'])
+            path_hashes = [bytes.fromhex(node) for node in proof['path']]
+        except (KeyError, TypeError, ValueError):
+            print("Proof: Error: malformed proof")
+            failed += 1
+            continue
+        recorded_item, state = _describe(record)
+        leaf = leaf_hash(hashlib.sha256(record).digest())
+        if recorded_item != item_id:
+            print(f"Block {index}: FAILED (not a block of evidence item {item_id})")
+            failed += 1
+        elif verify_inclusion(index, proof_size, leaf, path_hashes, root):
+            print(f"Block {index}: {state} OK")
+        else:
+            print(f"Block {index}: {state} FAILED")
+            failed += 1
+
+    if failed or not proofs:
+        print(f"Error: {failed} of {len(proofs)} proofs of evidence item {item_id} failed")
+        exit(1)
+    print(f"All {len(proofs)} proofs of evidence item {item_id} match root {root.hex()} ({proof_size} blocks)")
+
+def run():
+    args = parse_check_proof_args(sys.argv[2:])
+    check_proofs(args.file, args.root, args.tree_size)
+
+if __name__ == "__main__":
+    run()
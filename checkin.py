@@ -2,9 +2,11 @@ import argparse
 import datetime
 import sys
 from block import Block
-from blockchain import Blockchain
+from blockchain import open_blockchain
+from evidence_index import find_evidence_item
 import os
 from utils import validate_password, get_role_passwords, get_owner
+from profiling import timed
 
 def parse_checkin_args(args):
     parser = argparse.ArgumentParser(description='Checkin evidence items to the blockchain')
@@ -12,17 +14,40 @@ def parse_checkin_args(args):
     parser.add_argument('-p', '--password', required=True, help='Password of the owner')
     return parser.parse_args(args)
 
-def find_evidence_item(blockchain, item_id):
+def checkin_error(existing_block, item_id, password):
+    """Return why item_id cannot be checked in, or None"""
+    if not validate_password(password):
+        return "Invalid password"
+    if not existing_block:
+        return f"Evidence item {item_id} not found"
+    # Check if item is already checked in
+    if existing_block.state.rstrip(b'\0') == b"CHECKEDIN":
+        return f"Evidence item {item_id} is already checked in"
+    # Check if item is already removed in
+    if existing_block.state.rstrip(b'\0') in [b'DESTROYED', b'REMOVED', b'DISPOSED', b'RELEASED']:
+        return f"Evidence item {item_id} has been removed"
+    return None
+
+def checkin_block(existing_block, item_id, password):
+    """Build the checkin block of an item whose latest block is existing_block"""
+    # Get case ID from existing block
     creator_password = get_role_passwords()['creator']  # Get creator password
-    latest_block = None
+    decrypted_values = existing_block.get_decrypted_values(creator_password)  # Use creator password
+    case_id = decrypted_values['case_id']
     
-    # Skip genesis block and look for the most recent state of the item
-    for block in blockchain.blocks[1:]:
-        decrypted_values = block.get_decrypted_values(creator_password)  # Use creator password
-        if decrypted_values.get('evidence_id') == item_id:
-            latest_block = block
-    return latest_block
+    owner = get_owner(password)
 
+    # Create new checkin block
+    return Block(
+        case_id=case_id,
+        evidence_id=item_id,
+        state=b"CHECKEDIN",
+        creator=existing_block.creator,
+        owner=owner,
+        data=b""
+    ), case_id
+
+@timed('checkin.run')
 def run():
     blockchain_file = os.getenv('BCHOC_FILE_PATH', 'blockchain.bin')
     args = parse_checkin_args(sys.argv[2:])
@@ -33,46 +58,24 @@ def run():
         sys.exit(1)
     
     # Load blockchain
-    blockchain = Blockchain(blockchain_file)
+    blockchain = open_blockchain(blockchain_file)
     if not blockchain.blocks:
         print("Error: Blockchain is empty", file=sys.stderr)
         sys.exit(1)
     
-    # Find the evidence item
-    existing_block = find_evidence_item(blockchain, args.item_id)
-    if not existing_block:
-        print(f"Error: Evidence item {args.item_id} not found", file=sys.stderr)
-        sys.exit(1)
-    
-    # Check if item is already checked in
-    if existing_block.state.rstrip(b'\0') == b"CHECKEDIN":
-        print(f"Error: Evidence item {args.item_id} is already checked in", file=sys.stderr)
-        sys.exit(1)
-
-    # Check if item is already removed in
-    if existing_block.state.rstrip(b'\0') in [b'DESTROYED', b'REMOVED', b'DISPOSED', b'RELEASED']:
-        print(f"Error: Evidence item {args.item_id} has been removed", file=sys.stderr)
-        sys.exit(1)
+    # Check the item's latest state and append under the write lock
+    with blockchain.transaction():
+        # Find the evidence item
+        existing_block = find_evidence_item(blockchain, args.item_id)
+        error = checkin_error(existing_block, args.item_id, args.password)
+        if error:
+            print(f"Error: {error}", file=sys.stderr)
+            sys.exit(1)
     
-    # Get case ID from existing block
-    creator_password = get_role_passwords()['creator']  # Get creator password
-    decrypted_values = existing_block.get_decrypted_values(creator_password)  # Use creator password
-    case_id = decrypted_values['case_id']
-    
-    owner = get_owner(args.password)
-
-    # Create new checkin block
-    block = Block(
-        case_id=case_id,
-        evidence_id=args.item_id,
-        state=b"CHECKEDIN",
-        creator=existing_block.creator,
-        owner=owner,
-        data=b""
-    )
+        block, case_id = checkin_block(existing_block, args.item_id, args.password)
     
-    # Add block to blockchain
-    blockchain.add_block(block)
+        # Add block to blockchain
+        blockchain.add_block(block)
     
     # Get current time in ISO format with Z suffix
     timestamp = datetime.datetime.now().isoformat() + "Z"
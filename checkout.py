@@ -2,9 +2,11 @@ import argparse
 import datetime
 import sys
 from block import Block
-from blockchain import Blockchain
+from blockchain import open_blockchain
+from evidence_index import find_evidence_item
 import os
 from utils import get_role_passwords, validate_password, get_owner
+from profiling import timed
 
 def parse_checkout_args(args):
     parser = argparse.ArgumentParser(description='Checkout evidence items from the blockchain')
@@ -12,75 +14,66 @@ def parse_checkout_args(args):
     parser.add_argument('-p', '--password', required=True, help='Password of the owner')
     return parser.parse_args(args)
 
-def find_evidence_item(blockchain, item_id):
-    creator_password = get_role_passwords()['creator']  # Get creator password
-    latest_block = None
-    
-    # Skip genesis block and look for the most recent state of the item
-    for block in blockchain.blocks[1:]:
-        print(creator_password)
-        decrypted_values = block.get_decrypted_values(creator_password)  # Use creator password
-        print(decrypted_values)
-        print(f"\nSearching block - Decrypted values: {decrypted_values}")
-        if decrypted_values.get('evidence_id') is not None:
-            print(f"Comparing {decrypted_values['evidence_id']} with {item_id}")
-            if decrypted_values['evidence_id'] == item_id:
-                latest_block = block
-    return latest_block
-
-def run():
-    blockchain_file = os.getenv('BCHOC_FILE_PATH', 'blockchain.bin')
-    args = parse_checkout_args(sys.argv[2:])
-    
-    # Load blockchain
-    blockchain = Blockchain(blockchain_file)
-    if not blockchain.blocks:
-        print("Error: Blockchain is empty", file=sys.stderr)
-        sys.exit(1)
-    
-    # Find the evidence item
-    existing_block = find_evidence_item(blockchain, args.item_id)
+def checkout_error(existing_block, item_id, password):
+    """Return why item_id cannot be checked out, or None"""
     if not existing_block:
-        print(f"Error: Evidence item {args.item_id} not found", file=sys.stderr)
-        sys.exit(1)
-    
+        return f"Evidence item {item_id} not found"
     # Check if item is already checked out
     if existing_block.state.rstrip(b'\0') == b"CHECKEDOUT":
-        print(f"Error: Evidence item {args.item_id} is already checked out", file=sys.stderr)
-        sys.exit(1)
-
+        return f"Evidence item {item_id} is already checked out"
     # Check if item is already removed
     if existing_block.state.rstrip(b'\0') in [b'DESTROYED', b'REMOVED', b'DISPOSED', b'RELEASED']:
-        print(f"Error: Evidence item {args.item_id} has been removed", file=sys.stderr)
-        sys.exit(1)
-    
+        return f"Evidence item {item_id} has been removed"
     # Validate owner password
-    if not validate_password(args.password):
-        print("Error: Invalid password", file=sys.stderr)
-        sys.exit(1)
-    
+    if not validate_password(password):
+        return "Invalid password"
     # Any valid password can checkout
-    
+    return None
+
+def checkout_block(existing_block, item_id, password):
+    """Build the checkout block of an item whose latest block is existing_block"""
     # Get case ID from existing block
     creator_password = get_role_passwords()['creator']  # Get creator password
     decrypted_values = existing_block.get_decrypted_values(creator_password)  # Use creator password
     case_id = decrypted_values['case_id']
     
-    owner = get_owner(args.password)
+    owner = get_owner(password)
 
     # Create new checkout block
-    block = Block(
+    return Block(
         prev_hash=bytes(32),
         case_id=case_id,
-        evidence_id=args.item_id,
+        evidence_id=item_id,
         state=b"CHECKEDOUT",
         creator=existing_block.creator,
         owner=owner,
         data=b""
-    )
+    ), case_id
+
+@timed('checkout.run')
+def run():
+    blockchain_file = os.getenv('BCHOC_FILE_PATH', 'blockchain.bin')
+    args = parse_checkout_args(sys.argv[2:])
+    
+    # Load blockchain
+    blockchain = open_blockchain(blockchain_file)
+    if not blockchain.blocks:
+        print("Error: Blockchain is empty", file=sys.stderr)
+        sys.exit(1)
+    
+    # Check the item's latest state and append under the write lock
+    with blockchain.transaction():
+        # Find the evidence item
+        existing_block = find_evidence_item(blockchain, args.item_id)
+        error = checkout_error(existing_block, args.item_id, args.password)
+        if error:
+            print(f"Error: {error}", file=sys.stderr)
+            sys.exit(1)
+    
+        block, case_id = checkout_block(existing_block, args.item_id, args.password)
     
-    # Add block to blockchain
-    blockchain.add_block(block)
+        # Add block to blockchain
+        blockchain.add_block(block)
     
     # Get current time in ISO format with Z suffix
     timestamp = datetime.datetime.now().isoformat() + "Z"
@@ -0,0 +1,120 @@
+import os
+import uuid
+from functools import lru_cache
+import profiling
+
+# Shared AES-ECB state for encrypting and decrypting case and item IDs.
+#
+# ECB is deterministic, so the same ID always has the same ciphertext and
+# the same ciphertext always decrypts to the same ID. Case and item IDs
+# repeat across many blocks, which makes decryption results very cacheable.
+
+# Use a fixed encryption key to match expected values
+ENCRYPTION_KEY = b'R0chLi4uLi4uLi4='
+
+# Maximum number of entries kept by each decryption cache
+CACHE_SIZE = int(os.getenv('BCHOC_DECRYPT_CACHE_SIZE', '65536'))
+
+# AES implementation: 'cryptography' or 'pycryptodome'. By default the first
+# one that is installed, in that order (cryptography imports faster). Only
+# the backend in use is ever imported.
+BACKEND = os.getenv('BCHOC_CRYPTO_BACKEND', 'auto')
+
+class _CryptographyCipher:
+    """AES-ECB from the cryptography package, with the encrypt/decrypt
+    interface of a pycryptodome cipher"""
+    def __init__(self, key):
+        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+        cipher = Cipher(algorithms.AES(key), modes.ECB())
+        # ECB carries nothing from one block to the next, so one context
+        # each way serves every call as long as calls are whole blocks
+        self._encryptor = cipher.encryptor()
+        self._decryptor = cipher.decryptor()
+
+    def encrypt(self, data):
+        if len(data) % 16:
+            raise ValueError("Data must be aligned to block boundary in ECB mode")
+        return self._encryptor.update(data)
+
+    def decrypt(self, data):
+        if len(data) % 16:
+            raise ValueError("Data must be aligned to block boundary in ECB mode")
+        return self._decryptor.update(data)
+
+def _pycryptodome_cipher(key):
+    from Crypto.Cipher import AES
+    return AES.new(key, AES.MODE_ECB)
+
+BACKENDS = {
+    'cryptography': _CryptographyCipher,
+    'pycryptodome': _pycryptodome_cipher,
+}
+
+if BACKEND != 'auto' and BACKEND not in BACKENDS:
+    raise ValueError(f"Unknown crypto backend: {BACKEND}")
+
+_cipher = None
+
+def get_cipher():
+    """Return the shared AES-ECB cipher (ECB keeps no state between calls)"""
+    global _cipher
+    if _cipher is None:
+        names = list(BACKENDS) if BACKEND == 'auto' else [BACKEND]
+        for name in names:
+            try:
+                with profiling.phase('ciphers.load'):
+                    _cipher = BACKENDS[name](ENCRYPTION_KEY)
+                if profiling.ENABLED:
+                    _cipher = profiling.CountingCipher(_cipher)
+                break
+            except ImportError:
+                if name == names[-1]:
+                    raise
+    return _cipher
+
+@lru_cache(maxsize=CACHE_SIZE)
+def decrypt_case_id(encrypted_case_id):
+    """Decrypt a hex-encoded case ID into its UUID string"""
+    decrypted_case_id = get_cipher().decrypt(bytes.fromhex(encrypted_case_id.decode()))
+    return str(uuid.UUID(bytes=decrypted_case_id[:16]))
+
+@lru_cache(maxsize=CACHE_SIZE)
+def decrypt_evidence_id(encrypted_evidence_id):
+    """Decrypt a hex-encoded item ID into its integer value"""
+    decrypted_evidence_id = get_cipher().decrypt(bytes.fromhex(encrypted_evidence_id.decode()))
+    # Since we stored it as 16 bytes big endian, read the last 4 bytes
+    return int.from_bytes(decrypted_evidence_id[-4:], byteorder='big')
+
+def cache_stats():
+    """Return hit/miss counters of the decryption caches"""
+    return {
+        'case_id': decrypt_case_id.cache_info()._asdict(),
+        'evidence_id': decrypt_evidence_id.cache_info()._asdict(),
+    }
+
+def clear_caches():
+    decrypt_case_id.cache_clear()
+    decrypt_evidence_id.cache_clear()
+
+def decrypt_column(encrypted_values):
+    """Decrypt many hex-encoded 16-byte IDs with a single cipher call.
+
+    ECB encrypts every 16-byte block independently, so the ciphertexts of
+    many records can be concatenated and decrypted together. Returns the
+    concatenated plaintexts, 16 bytes per value, or raises ValueError if
+    any value is not a 32-character hex string.
+    """
+    joined = b"".join(encrypted_values)
+    ciphertext = bytes.fromhex(joined.decode())
+    if len(joined) != 32 * len(encrypted_values) or len(ciphertext) != 16 * len(encrypted_values):
+        raise ValueError("encrypted IDs must be 32 hex characters each")
+    return get_cipher().decrypt(ciphertext)
+
+def encrypt_column(values):
+    """Encrypt many 16-byte values with a single cipher call.
+
+    The counterpart of decrypt_column: returns one ciphertext per value,
+    hex-encoded as stored in the chain.
+    """
+    ciphertext = get_cipher().encrypt(b"".join(values)).hex().encode()
+    return [ciphertext[i:i + 32] for i in range(0, len(ciphertext), 32)]
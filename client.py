@@ -0,0 +1,65 @@
+import os
+import sys
+
+# Client side of the resident server (see server.py). Kept apart from the
+# server so that commands, which all check for a server first, only import
+# the socket and JSON modules when there is a socket to talk to.
+
+SOCKET_SUFFIX = '.sock'
+
+def socket_path(blockchain_file=None):
+    if os.getenv('BCHOC_SOCKET'):
+        return os.getenv('BCHOC_SOCKET')
+    blockchain_file = blockchain_file or os.getenv('BCHOC_FILE_PATH', 'blockchain.bin')
+    return os.path.abspath(blockchain_file) + SOCKET_SUFFIX
+
+def forward(argv):
+    """Run a command on the resident server.
+
+    Returns the command's exit status after printing its output as the
+    server sends it, or None if no server is listening (the caller then
+    runs the command itself). Once the request is sent the command is
+    never run again locally: the server may have applied it before
+    failing to answer.
+    """
+    path = socket_path()
+    if not os.path.exists(path):
+        return None
+    import json
+    import socket
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(path)
+        except OSError:
+            # Stale socket of a server that is gone
+            return None
+        # Relative paths are resolved in the client's directory
+        env = {key: value for key, value in os.environ.items() if key.startswith('BCHOC_')}
+        request = {'argv': argv, 'cwd': os.getcwd(), 'env': env}
+        try:
+            sock.sendall(json.dumps(request).encode() + b"\n")
+            with sock.makefile('rb') as f:
+                for line in f:
+                    frame = json.loads(line)
+                    if 'status' in frame:
+                        return frame['status']
+                    try:
+                        for name, stream in (('stdout', sys.stdout), ('stderr', sys.stderr)):
+                            if name in frame:
+                                stream.write(frame[name])
+                                stream.flush()
+                    except BrokenPipeError:
+                        # The reader went away (e.g. piped into head); closing
+                        # the socket stops the command on the server
+                        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+                        return 1
+        except (OSError, ValueError):
+            # Connection lost or a garbled frame; reported below
+            pass
+    finally:
+        sock.close()
+    print("Error: the server closed the connection before the command finished; "
+          "it may or may not have been applied", file=sys.stderr)
+    return 1
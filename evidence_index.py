@@ -0,0 +1,303 @@
+import sqlite3
+import uuid
+from block import Block
+from profiling import timed
+
+# Sidecar index kept next to the chain file. It maps every evidence item to
+# its latest state, its case and the file offsets of all of its blocks, so
+# custody commands can find an item without decrypting the whole chain, and
+# every case to how many of its items are checked in, checked out and
+# removed, so cases can be listed and summarized without reading the chain.
+#
+# Items and cases are keyed by their encrypted (hex) values exactly as they
+# are stored in the chain; AES-ECB is deterministic, so encrypting an item
+# ID once is enough to look it up and the index holds no plaintext IDs.
+
+INDEX_SUFFIX = '.idx'
+# Indexes written with another schema version are rebuilt
+SCHEMA_VERSION = 2
+
+META_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value
+);
+"""
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    evidence_id TEXT PRIMARY KEY,
+    case_id TEXT NOT NULL,
+    state TEXT NOT NULL,
+    first_offset INTEGER NOT NULL,
+    last_offset INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS items_by_case ON items (case_id, first_offset);
+CREATE TABLE IF NOT EXISTS cases (
+    case_id TEXT PRIMARY KEY,
+    first_offset INTEGER NOT NULL,
+    checked_in INTEGER NOT NULL,
+    checked_out INTEGER NOT NULL,
+    removed INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS item_blocks (
+    evidence_id TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    PRIMARY KEY (evidence_id, offset)
+) WITHOUT ROWID;
+"""
+
+# Which rollup counter of a case an item in each state is counted in
+ROLLUP = {
+    'CHECKEDIN': 0,
+    'CHECKEDOUT': 1,
+    'DESTROYED': 2,
+    'DISPOSED': 2,
+    'RELEASED': 2,
+    'REMOVED': 2,
+}
+
+# Items looked up per query when indexing new blocks (under SQLite's limit
+# of 999 parameters)
+LOOKUP_BATCH = 500
+
+def index_path(blockchain):
+    return blockchain.filename + INDEX_SUFFIX
+
+def item_key(item_id):
+    if not 0 <= item_id < 1 << 128:
+        return None
+    return Block.encrypt_evidence_id(item_id).decode()
+
+def case_key(case_id):
+    """Encrypted key of a case UUID, None unless given in canonical form"""
+    try:
+        if str(uuid.UUID(case_id)) != case_id:
+            return None
+    except (TypeError, ValueError):
+        return None
+    return Block.encrypt_case_id(case_id).decode()
+
+def tip_offset(blockchain):
+    if not blockchain.blocks:
+        return None
+    return blockchain.offsets[-1]
+
+class EvidenceIndex:
+    def __init__(self, blockchain):
+        self.blockchain = blockchain
+        self.conn = sqlite3.connect(index_path(blockchain))
+        self.conn.executescript(META_SCHEMA)
+        if self._meta('version') != SCHEMA_VERSION:
+            self._reset()
+        else:
+            self.conn.executescript(SCHEMA)
+
+    def _reset(self):
+        """Drop an index of an older layout; refresh() rebuilds it"""
+        with self.conn:
+            self.conn.execute("DROP TABLE IF EXISTS items")
+            self.conn.execute("DROP TABLE IF EXISTS item_blocks")
+            self.conn.execute("DROP TABLE IF EXISTS cases")
+            self.conn.execute("DELETE FROM meta")
+        self.conn.executescript(SCHEMA)
+        with self.conn:
+            self.conn.execute("INSERT INTO meta (key, value) VALUES ('version', ?)", (SCHEMA_VERSION,))
+
+    @classmethod
+    def open(cls, blockchain):
+        """Open the index for blockchain, bringing it up to date first"""
+        index = cls(blockchain)
+        try:
+            index.refresh()
+        except BaseException:
+            # Do not leak the connection, whatever stopped the refresh
+            index.close()
+            raise
+        return index
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def _meta(self, key):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    @timed('evidence_index.refresh')
+    def refresh(self):
+        """Catch up with blocks appended since the index was last written.
+
+        The index records the chain size and tip hash it was built against.
+        If the chain still starts with that prefix only the new suffix is
+        indexed, otherwise (missing, truncated or rewritten chain) the index
+        is rebuilt from the genesis block.
+        """
+        blockchain = self.blockchain
+        size = self._meta('size')
+        tip = self._meta('tip')
+        last = self._meta('tip_offset')
+
+        # Fast path: the file has not changed length and still ends with
+        # the block the index was built against, no scan needed
+        if size is not None and size == blockchain.file_size:
+            if last is None and size == 0:
+                return
+            if last is not None and blockchain.hash_at(last) == tip:
+                return
+
+        first = blockchain.index_of_offset(size) if size else None
+        if first is not None and first > 0 and blockchain.hash_at(blockchain.offsets[first - 1]) == tip:
+            self._apply(first)
+        else:
+            self.rebuild()
+
+    def rebuild(self):
+        self._apply(1, clear=True)
+
+    @timed('evidence_index.apply')
+    def _apply(self, first, clear=False):
+        """Index blocks[first:] in a single transaction, the index first
+        emptied if clear is set.
+
+        The write lock is taken before anything is read, and the index is
+        left alone if another process brought it past blocks[first - 1]
+        meanwhile: the case rollups are added to, so applying the same
+        blocks twice would count them twice.
+        """
+        blockchain = self.blockchain
+        start = blockchain.offsets[first] if first < len(blockchain.blocks) else blockchain.size
+        # Rows of the items the new blocks touch, and the changes to the
+        # rollup counters of their cases
+        items = {}
+        cases = {}
+        item_blocks = []
+
+        def count(case_id, state, offset, delta):
+            counters = cases.get(case_id)
+            if counters is None:
+                counters = cases[case_id] = [offset, 0, 0, 0]
+            counters[0] = min(counters[0], offset)
+            if state in ROLLUP:
+                counters[1 + ROLLUP[state]] += delta
+
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            if clear:
+                self.conn.execute("DELETE FROM items")
+                self.conn.execute("DELETE FROM item_blocks")
+                self.conn.execute("DELETE FROM cases")
+                self.conn.execute("DELETE FROM meta WHERE key != 'version'")
+            elif self._meta('size') != start:
+                return
+            new_blocks = []
+            for i in range(max(first, 1), len(blockchain.blocks)):
+                block = blockchain.blocks[i]
+                offset = blockchain.offsets[i]
+                evidence_id = block.evidence_id.decode('latin-1')
+                new_blocks.append((evidence_id, block.case_id.decode('latin-1'),
+                                   block.state.rstrip(b'\0').decode('latin-1'), offset))
+                item_blocks.append((evidence_id, offset))
+
+            # Current rows of the items touched, looked up a batch at a time
+            for evidence_id, _, _, _ in new_blocks:
+                items[evidence_id] = None
+            touched = list(items)
+            for start in range(0, len(touched), LOOKUP_BATCH):
+                batch = touched[start:start + LOOKUP_BATCH]
+                for evidence_id, *row in self.conn.execute(
+                        "SELECT evidence_id, case_id, state, first_offset, last_offset FROM items "
+                        f"WHERE evidence_id IN ({', '.join('?' * len(batch))})", batch):
+                    items[evidence_id] = row
+
+            for evidence_id, case_id, state, offset in new_blocks:
+                item = items[evidence_id]
+                if item is None:
+                    items[evidence_id] = [case_id, state, offset, offset]
+                    count(case_id, state, offset, 1)
+                elif offset > item[3]:
+                    # Blocks already indexed are skipped, so applying the
+                    # same blocks twice changes nothing
+                    count(item[0], item[1], item[2], -1)
+                    item[0:2] = [case_id, state]
+                    item[3] = offset
+                    count(case_id, state, item[2], 1)
+
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO item_blocks (evidence_id, offset) VALUES (?, ?)", item_blocks)
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO items (evidence_id, case_id, state, first_offset, last_offset) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [(evidence_id, *item) for evidence_id, item in items.items() if item is not None])
+            self.conn.executemany(
+                "INSERT INTO cases (case_id, first_offset, checked_in, checked_out, removed) "
+                "VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (case_id) DO UPDATE SET "
+                "first_offset = MIN(cases.first_offset, excluded.first_offset), "
+                "checked_in = cases.checked_in + excluded.checked_in, "
+                "checked_out = cases.checked_out + excluded.checked_out, "
+                "removed = cases.removed + excluded.removed",
+                [(case_id, *counters) for case_id, counters in cases.items()])
+            last = tip_offset(blockchain)
+            meta = {
+                'size': blockchain.size,
+                'tip': blockchain.hash_at(last) if last is not None else b"",
+                'tip_offset': last,
+            }
+            self.conn.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                                  meta.items())
+
+    @timed('evidence_index.lookup')
+    def lookup(self, item_id):
+        """Return (case_id, state, last_offset) for item_id, or None"""
+        return self.conn.execute(
+            "SELECT case_id, state, last_offset FROM items WHERE evidence_id = ?",
+            (item_key(item_id),)).fetchone()
+
+    def cases(self):
+        """Return the encrypted IDs of all cases, in order of appearance"""
+        return [row[0] for row in self.conn.execute("SELECT case_id FROM cases ORDER BY first_offset")]
+
+    def case_items(self, case_id):
+        """Return the encrypted IDs of the items of a case (a UUID string),
+        in order of appearance"""
+        rows = self.conn.execute(
+            "SELECT evidence_id FROM items WHERE case_id = ? ORDER BY first_offset",
+            (case_key(case_id),))
+        return [row[0] for row in rows]
+
+    def case_summary(self):
+        """Return (case, items, checked in, checked out, removed) per case"""
+        return self.conn.execute(
+            "SELECT c.case_id, (SELECT COUNT(*) FROM items WHERE items.case_id = c.case_id), "
+            "c.checked_in, c.checked_out, c.removed FROM cases c ORDER BY c.first_offset").fetchall()
+
+    def offsets(self, item_id):
+        """Return the file offsets of every block of item_id, oldest first"""
+        rows = self.conn.execute(
+            "SELECT offset FROM item_blocks WHERE evidence_id = ? ORDER BY offset",
+            (item_key(item_id),))
+        return [row[0] for row in rows]
+
+def on_append(blockchain, first):
+    with EvidenceIndex.open(blockchain):
+        pass
+
+def find_evidence_item(blockchain, item_id):
+    """Return the most recent block of an evidence item, or None"""
+    with EvidenceIndex.open(blockchain) as index:
+        entry = index.lookup(int(item_id))
+    if entry is None:
+        return None
+    return blockchain.block_at(entry[2])
+
+def item_blocks(blockchain, item_id):
+    """Return every block of an evidence item, oldest first"""
+    with EvidenceIndex.open(blockchain) as index:
+        offsets = index.offsets(int(item_id))
+    return [blockchain.block_at(offset) for offset in offsets]
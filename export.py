@@ -0,0 +1,275 @@
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+import uuid
+from array import array
+from block import Block
+from blockchain import open_blockchain
+import ciphers
+from utils import get_role_passwords, validate_password
+from profiling import timed
+
+# Exports the chain for analytics tools, one row per block in chain order.
+#
+# npy: a directory with one NumPy .npy file per column, written without
+# NumPy and loadable with numpy.load(path, mmap_mode='r'):
+#   offset     uint64    byte offset of the block
+#   timestamp  float64   seconds since the epoch
+#   case       16 bytes  case UUID (void dtype)
+#   item       uint32    item ID
+#   state, owner  uint8, creator  uint16: codes into the label lists of
+#              columns.json
+# Without the creator password, case and item hold the 16-byte ciphertexts
+# as stored in the chain instead.
+#
+# csv and jsonl write the same columns as text, with the labels in place of
+# the codes.
+#
+# The chain is read a chunk of records at a time and every chunk's IDs are
+# decrypted with one cipher call per column, so memory stays bounded
+# whatever the length of the chain.
+
+FORMATS = ['npy', 'csv', 'jsonl']
+COLUMNS = ['offset', 'timestamp', 'case', 'item', 'state', 'owner', 'creator']
+# Records read, decrypted and written at a time
+CHUNK_BLOCKS = 65536
+# Codes of the values every chain uses, so they are the same in every
+# export; other values get the next codes as they are found
+STATES = ['INITIAL', 'CHECKEDIN', 'CHECKEDOUT', 'DISPOSED', 'DESTROYED', 'RELEASED']
+OWNERS = ['', 'POLICE', 'LAWYER', 'ANALYST', 'EXECUTIVE']
+
+NPY_MAGIC = b'\x93NUMPY\x01\x00'
+# Size of a .npy header: room for any row count, so the header can be
+# rewritten in place once the rows are counted (a multiple of 64, as the
+# format asks)
+NPY_HEADER_SIZE = 128
+_ENDIAN = '<' if sys.byteorder == 'little' else '>'
+
+def parse_export_args(args):
+    parser = argparse.ArgumentParser(description='Export the blockchain as columns for analytics tools')
+    parser.add_argument('--format', choices=FORMATS, default='npy', help='Output format (default: npy)')
+    parser.add_argument('-o', '--output',
+                        help="Directory of the .npy files, or file of the csv/jsonl rows ('-' or unset: standard output)")
+    parser.add_argument('-p', '--password', help='Creator password, to export decrypted case and item IDs')
+    args = parser.parse_args(args)
+    if args.format == 'npy' and not args.output:
+        parser.error("--format npy needs -o/--output DIRECTORY")
+    return args
+
+class _Codes:
+    """Dictionary encoding of a text column"""
+    def __init__(self, name, labels, limit):
+        self.name = name
+        self.labels = list(labels)
+        self.codes = {label.encode(): code for code, label in enumerate(labels)}
+        self.limit = limit
+
+    def __call__(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = len(self.labels)
+            if code == self.limit:
+                raise ValueError(f"more than {self.limit} distinct {self.name} values")
+            self.codes[value] = code
+            self.labels.append(value.decode('latin-1'))
+        return code
+
+class _NpyColumn:
+    """A .npy file of one column, written a chunk at a time"""
+    def __init__(self, path, descr):
+        self.file = open(path, 'wb')
+        self.descr = descr
+        self.rows = 0
+        self._header()
+
+    def _header(self):
+        header = f"{{'descr': '{self.descr}', 'fortran_order': False, 'shape': ({self.rows},), }}"
+        header = header.ljust(NPY_HEADER_SIZE - len(NPY_MAGIC) - 3) + "\n"
+        self.file.write(NPY_MAGIC + len(header).to_bytes(2, 'little') + header.encode('latin-1'))
+
+    def write(self, data, rows):
+        self.file.write(data)
+        self.rows += rows
+
+    def close(self):
+        self.file.seek(0)
+        self._header()
+        self.file.close()
+
+def _decrypted(column):
+    """Decrypt a chunk's ID column, blocks whose ID is not valid
+    ciphertext getting zeros"""
+    try:
+        return ciphers.decrypt_column(column)
+    except ValueError:
+        pass
+    plain = bytearray()
+    for value in column:
+        try:
+            plain += ciphers.decrypt_column([value])
+        except ValueError:
+            plain += bytes(16)
+    return bytes(plain)
+
+def _ciphertexts(column):
+    """The 16-byte ciphertexts of a chunk's ID column, as stored in hex"""
+    raw = bytearray()
+    for value in column:
+        try:
+            raw += bytes.fromhex(value.decode('latin-1')).ljust(16, b"\0")[:16]
+        except ValueError:
+            raw += bytes(16)
+    return bytes(raw)
+
+def _chunks(blockchain, decrypt, codes):
+    """Yield the columns of the chain a chunk of records at a time: offsets,
+    timestamps, case and item bytes (16 per block), state, owner and
+    creator codes"""
+    unpack = Block.STRUCT.unpack_from
+    state_code, owner_code, creator_code = codes
+    records = blockchain.records()
+    while True:
+        offsets = array('Q')
+        timestamps = array('d')
+        cases = []
+        items = []
+        initial = []
+        states = array('B')
+        owners = array('B')
+        creators = array('H')
+        for offset, record in records:
+            _, timestamp, case_id, evidence_id, state, creator, owner, _ = unpack(record)
+            state = state.rstrip(b"\0")
+            if state == b"INITIAL":
+                initial.append(len(offsets))
+            offsets.append(offset)
+            timestamps.append(timestamp)
+            cases.append(case_id)
+            items.append(evidence_id)
+            states.append(state_code(state))
+            owners.append(owner_code(owner.rstrip(b"\0")))
+            creators.append(creator_code(creator.rstrip(b"\0")))
+            if len(offsets) == CHUNK_BLOCKS:
+                break
+        if not offsets:
+            return
+        if decrypt:
+            cases = bytearray(_decrypted(cases))
+            plain = _decrypted(items)
+            # Item IDs are stored as 16 bytes big endian, the value is the last 4
+            items = array('I', [int.from_bytes(plain[i + 12:i + 16], 'big') for i in range(0, len(plain), 16)])
+            # The genesis block has no case or item, as history shows it
+            for i in initial:
+                cases[16 * i:16 * i + 16] = bytes(16)
+                items[i] = 0
+            cases = bytes(cases)
+        else:
+            cases = _ciphertexts(cases)
+            items = _ciphertexts(items)
+        yield offsets, timestamps, cases, items, states, owners, creators
+
+def _write_npy(output, chunks, decrypt, codes):
+    os.makedirs(output, exist_ok=True)
+    descrs = {
+        'offset': _ENDIAN + 'u8',
+        'timestamp': _ENDIAN + 'f8',
+        'case': '|V16',
+        'item': _ENDIAN + 'u4' if decrypt else '|V16',
+        'state': '|u1',
+        'owner': '|u1',
+        'creator': _ENDIAN + 'u2',
+    }
+    columns = {name: _NpyColumn(os.path.join(output, name + '.npy'), descrs[name]) for name in COLUMNS}
+    try:
+        for chunk in chunks:
+            rows = len(chunk[0])
+            for name, values in zip(COLUMNS, chunk):
+                columns[name].write(values if isinstance(values, bytes) else values.tobytes(), rows)
+    finally:
+        for column in columns.values():
+            column.close()
+    rows = columns['offset'].rows
+    with open(os.path.join(output, 'columns.json'), 'w') as f:
+        json.dump({
+            'blocks': rows,
+            'decrypted': decrypt,
+            'columns': descrs,
+            'state': codes[0].labels,
+            'owner': codes[1].labels,
+            'creator': codes[2].labels,
+        }, f, indent=1)
+        f.write("\n")
+    return rows
+
+def _rows(chunks, decrypt, codes):
+    """Yield the rows of the text formats"""
+    states, owners, creators = (code.labels for code in codes)
+    for offsets, timestamps, cases, items, state_codes, owner_codes, creator_codes in chunks:
+        for i, offset in enumerate(offsets):
+            case = cases[16 * i:16 * i + 16]
+            if decrypt:
+                case, item = str(uuid.UUID(bytes=case)), items[i]
+            else:
+                case, item = case.hex(), items[16 * i:16 * i + 16].hex()
+            yield (offset, timestamps[i], case, item, states[state_codes[i]],
+                   owners[owner_codes[i]], creators[creator_codes[i]])
+
+def _write_text(f, file_format, chunks, decrypt, codes):
+    rows = 0
+    if file_format == 'csv':
+        writer = csv.writer(f)
+        writer.writerow(COLUMNS)
+        for row in _rows(chunks, decrypt, codes):
+            writer.writerow(row)
+            rows += 1
+    else:
+        for row in _rows(chunks, decrypt, codes):
+            f.write(json.dumps(dict(zip(COLUMNS, row))) + "\n")
+            rows += 1
+    return rows
+
+@timed('export.run')
+def export_chain(file_format, output, password=None):
+    blockchain_file = os.getenv('BCHOC_FILE_PATH', 'blockchain.bin')
+    if not os.path.exists(blockchain_file):
+        print("Error: blockchain file not found")
+        exit(1)
+    if password and not validate_password(password):
+        print("Error: Invalid password")
+        exit(1)
+    decrypt = password == get_role_passwords()['creator']
+
+    started = time.perf_counter()
+    blockchain = open_blockchain(blockchain_file)
+    codes = (_Codes('state', STATES, 256), _Codes('owner', OWNERS, 256), _Codes('creator', [''], 65536))
+    chunks = _chunks(blockchain, decrypt, codes)
+    try:
+        if file_format == 'npy':
+            rows = _write_npy(output, chunks, decrypt, codes)
+        elif output and output != '-':
+            with open(output, 'w', newline='') as f:
+                rows = _write_text(f, file_format, chunks, decrypt, codes)
+        else:
+            try:
+                _write_text(sys.stdout, file_format, chunks, decrypt, codes)
+                sys.stdout.flush()
+            except BrokenPipeError:
+                # The reader went away (e.g. piped into head); stop quietly
+                os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+                sys.exit(1)
+            return
+    except ValueError as e:
+        print(f"Error: {e}")
+        exit(1)
+    elapsed = time.perf_counter() - started
+    print(f"Exported {rows:,} blocks to {output} in {elapsed:.2f} s ({rows / elapsed:,.0f} blocks/s)")
+
+def run():
+    args = parse_export_args(sys.argv[2:])
+    export_chain(args.format, args.output, args.password)
+
+if __name__ == "__main__":
+    run()
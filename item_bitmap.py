@@ -0,0 +1,370 @@
+import argparse
+import mmap
+import os
+import struct
+import sys
+import time
+from array import array
+from bisect import bisect_left
+from blockchain import open_blockchain
+from profiling import timed
+
+# Sidecar set of every item ID in the chain, kept next to the chain as
+# <chain>.bmp, for the duplicate check of `bchoc add`: an ID is looked up in
+# the mapped file without decrypting or replaying any block.
+#
+# The IDs are stored like a Roaring bitmap: they are split by their high 16
+# bits into containers, and each container holds the low 16 bits of its IDs
+# either as a sorted array of uint16 (up to ARRAY_MAX of them) or as a
+# 65536-bit bitmap. A lookup is a binary search over the container keys and
+# one probe of the container.
+#
+# File layout: the header, the container keys (uint16), their
+# cardinalities (uint32) and their positions in the file (uint64), each
+# section padded to 8 bytes, then the containers, all in native byte order.
+# The file is written whole and renamed into place, so a mapped bitmap
+# never changes under its reader.
+
+BITMAP_SUFFIX = '.bmp'
+
+MAGIC = b'BCBM'
+VERSION = 1
+# magic, version, blocks covered, chain bytes covered, offset of the last
+# block covered, hash of that block, number of IDs, number of containers
+HEADER = struct.Struct('=4sIQQQ32sQQ')
+# Containers with more IDs than this are bitmaps
+ARRAY_MAX = 4096
+BITMAP_BYTES = 1 << 13
+
+def bitmap_path(blockchain):
+    return blockchain.filename + BITMAP_SUFFIX
+
+def parse_bitmap_args(args):
+    parser = argparse.ArgumentParser(description='Rebuild or check the item ID bitmap of the blockchain')
+    parser.add_argument('action', choices=['rebuild', 'check'],
+                        help='rebuild: write the bitmap from the chain; check: compare it with the chain')
+    return parser.parse_args(args)
+
+def _padded(n):
+    return (n + 7) & ~7
+
+def _container(lows):
+    """Encode the low 16 bits of a container's IDs; returns (data,
+    cardinality)"""
+    if len(lows) <= ARRAY_MAX:
+        return array('H', sorted(lows)).tobytes(), len(lows)
+    bits = bytearray(BITMAP_BYTES)
+    for low in lows:
+        bits[low >> 3] |= 1 << (low & 7)
+    return bytes(bits), len(lows)
+
+def _length(cardinality):
+    """Bytes of a container holding cardinality IDs"""
+    return 2 * cardinality if cardinality <= ARRAY_MAX else BITMAP_BYTES
+
+def _group(item_ids):
+    """Split item IDs into {high 16 bits: set of low 16 bits}"""
+    groups = {}
+    for item_id in item_ids:
+        lows = groups.get(item_id >> 16)
+        if lows is None:
+            lows = groups[item_id >> 16] = set()
+        lows.add(item_id & 0xFFFF)
+    return groups
+
+def _item_ids(decoded, skip_first):
+    """Item IDs of decoded blocks, without the genesis block and blocks
+    whose IDs could not be decrypted"""
+    evidence_ids = decoded.evidence_ids
+    if not decoded.invalid:
+        return evidence_ids[1:] if skip_first else evidence_ids
+    return [evidence_ids[i] for i in range(1 if skip_first else 0, len(evidence_ids))
+            if i not in decoded.invalid]
+
+class ItemBitmap:
+    def __init__(self, blockchain):
+        self.blockchain = blockchain
+        self.path = bitmap_path(blockchain)
+        self._map = None
+
+    def _header(self):
+        try:
+            with open(self.path, 'rb') as f:
+                header = f.read(HEADER.size)
+        except OSError:
+            return None
+        if len(header) != HEADER.size:
+            return None
+        fields = HEADER.unpack(header)
+        if fields[0] != MAGIC or fields[1] != VERSION:
+            return None
+        return fields[2:]
+
+    def _open(self):
+        """Map the bitmap file; returns False if it is missing or invalid"""
+        self.close()
+        try:
+            with open(self.path, 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return False
+        view = memoryview(mapped)
+        try:
+            fields = HEADER.unpack_from(view)
+            if fields[0] != MAGIC or fields[1] != VERSION:
+                raise ValueError
+            self.blocks, self.size, _, _, self.count, containers = fields[2:]
+            start = HEADER.size
+            self._keys = view[start:start + 2 * containers].cast('H')
+            start += _padded(2 * containers)
+            self._cardinalities = view[start:start + 4 * containers].cast('I')
+            start += _padded(4 * containers)
+            self._positions = view[start:start + 8 * containers].cast('Q')
+            if len(self._positions) != containers:
+                raise ValueError
+        except (struct.error, ValueError, TypeError):
+            view.release()
+            mapped.close()
+            return False
+        self._view = view
+        self._map = mapped
+        return True
+
+    def close(self):
+        if self._map is not None:
+            for view in (self._keys, self._cardinalities, self._positions, self._view):
+                view.release()
+            self._map.close()
+            self._map = None
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, item_id):
+        keys = self._keys
+        i = bisect_left(keys, item_id >> 16)
+        if i == len(keys) or keys[i] != item_id >> 16:
+            return False
+        low = item_id & 0xFFFF
+        cardinality = self._cardinalities[i]
+        position = self._positions[i]
+        if cardinality > ARRAY_MAX:
+            return bool(self._map[position + (low >> 3)] >> (low & 7) & 1)
+        lows = self._view[position:position + 2 * cardinality].cast('H')
+        try:
+            j = bisect_left(lows, low)
+            return j < cardinality and lows[j] == low
+        finally:
+            lows.release()
+
+    def _lows(self, i):
+        """Low 16 bits of the IDs of container i, in order"""
+        cardinality = self._cardinalities[i]
+        position = self._positions[i]
+        if cardinality <= ARRAY_MAX:
+            return array('H', self._map[position:position + _length(cardinality)])
+        bits = self._map[position:position + BITMAP_BYTES]
+        return [byte << 3 | bit for byte in range(BITMAP_BYTES) if bits[byte]
+                for bit in range(8) if bits[byte] >> bit & 1]
+
+    def __iter__(self):
+        for i, key in enumerate(self._keys):
+            high = key << 16
+            for low in self._lows(i):
+                yield high | low
+
+    @timed('item_bitmap.refresh')
+    def refresh(self):
+        """Bring the bitmap up to date with the chain and map it. Must be
+        called under the chain's write lock.
+
+        IDs are only added for blocks past the ones covered, as long as the
+        last covered block is still in place; otherwise the bitmap is
+        rebuilt.
+        """
+        blockchain = self.blockchain
+        header = self._header()
+        if header is not None and self._open():
+            blocks, size, tip_offset, tip, _, _ = header
+            if size > blockchain.file_size and blockchain.stored_size() >= size:
+                # Written after this process loaded the chain
+                return
+            try:
+                matches = blocks and blockchain.hash_at(tip_offset) == tip
+            except (IndexError, struct.error):
+                matches = False
+            if matches:
+                if size != blockchain.file_size:
+                    self._append(blocks)
+                return
+        self.rebuild()
+
+    def rebuild(self):
+        """Write the bitmap of the whole chain"""
+        blockchain = self.blockchain
+        self.close()
+        if not blockchain.blocks:
+            self._write({}, 0)
+            return
+        item_ids = _item_ids(blockchain.decode_ids(), True)
+        self._write({key: _container(lows) for key, lows in _group(set(item_ids)).items()},
+                    len(blockchain.blocks))
+
+    def _append(self, blocks):
+        blockchain = self.blockchain
+        count = len(blockchain.blocks)
+        new_ids = [item_id for item_id in _item_ids(blockchain.decode_ids(blocks), blocks == 0)
+                   if item_id not in self]
+        containers = {}
+        for key, lows in _group(new_ids).items():
+            i = bisect_left(self._keys, key)
+            if i < len(self._keys) and self._keys[i] == key:
+                lows.update(self._lows(i))
+            containers[key] = _container(lows)
+        self._write(containers, count)
+
+    def _write(self, changed, blocks):
+        """Write the bitmap with the changed containers, {key: (data,
+        cardinality)}, replacing or adding to the mapped ones, as covering
+        the first blocks of the chain"""
+        blockchain = self.blockchain
+        keys = array('H')
+        cardinalities = array('I')
+        # Positions of the containers from the first one
+        positions = array('Q')
+        pieces = []
+        length = 0
+
+        def copy(i, j):
+            # Unchanged containers i..j-1 lie end to end and are copied in
+            # one piece
+            nonlocal length
+            if i == j:
+                return
+            start = self._positions[i]
+            end = self._positions[j - 1] + _length(self._cardinalities[j - 1])
+            keys.frombytes(self._keys[i:j].cast('B'))
+            cardinalities.frombytes(self._cardinalities[i:j].cast('B'))
+            shift = length - start
+            positions.extend(position + shift for position in self._positions[i:j])
+            pieces.append(self._map[start:end])
+            length += end - start
+
+        old_keys = self._keys if self._map is not None else ()
+        i = 0
+        for key in sorted(changed):
+            j = bisect_left(old_keys, key, i)
+            copy(i, j)
+            data, cardinality = changed[key]
+            keys.append(key)
+            cardinalities.append(cardinality)
+            positions.append(length)
+            pieces.append(data)
+            length += len(data)
+            i = j + 1 if j < len(old_keys) and old_keys[j] == key else j
+        copy(i, len(old_keys))
+        n = len(keys)
+        start = HEADER.size + _padded(2 * n) + _padded(4 * n) + 8 * n
+        positions = array('Q', (position + start for position in positions))
+
+        if blocks:
+            tip_offset = blockchain.offsets[blocks - 1]
+            size = tip_offset + blockchain.record_length(tip_offset)
+            tip = blockchain.hash_at(tip_offset)
+        else:
+            tip_offset, size, tip = 0, 0, bytes(32)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, blocks, size, tip_offset, tip, sum(cardinalities), n))
+            f.write(keys.tobytes().ljust(_padded(2 * n), b"\0"))
+            f.write(cardinalities.tobytes().ljust(_padded(4 * n), b"\0"))
+            f.write(positions.tobytes())
+            f.write(b"".join(pieces))
+        os.replace(tmp_path, self.path)
+        self._open()
+
+def on_append(blockchain, first):
+    bitmap = ItemBitmap(blockchain)
+    try:
+        bitmap.refresh()
+    finally:
+        bitmap.close()
+
+def open_bitmap(blockchain):
+    """Return the chain's item bitmap, brought up to date and mapped"""
+    bitmap = ItemBitmap(blockchain)
+    with blockchain.transaction():
+        bitmap.refresh()
+    return bitmap
+
+@timed('item_bitmap.check')
+def check_bitmap(blockchain):
+    """Compare the stored bitmap with the chain; returns a list of problems"""
+    bitmap = ItemBitmap(blockchain)
+    if not bitmap._open():
+        return [f"no valid bitmap at {bitmap.path}"]
+    try:
+        problems = []
+        blocks = len(blockchain.blocks)
+        header = bitmap._header()
+        if bitmap.blocks != blocks or bitmap.size != blockchain.size:
+            problems.append(f"bitmap covers {bitmap.blocks} blocks ({bitmap.size} bytes), "
+                            f"the chain has {blocks} ({blockchain.size} bytes)")
+        elif blocks and blockchain.hash_at(header[2]) != header[3]:
+            problems.append("bitmap tip hash does not match the chain")
+
+        keys = list(bitmap._keys)
+        if keys != sorted(set(keys)):
+            problems.append("container keys are not in order")
+        stored = []
+        for i in range(len(keys)):
+            lows = list(bitmap._lows(i))
+            if len(lows) != bitmap._cardinalities[i]:
+                problems.append(f"container {keys[i]} holds {len(lows)} IDs, "
+                                f"its cardinality is {bitmap._cardinalities[i]}")
+            if lows != sorted(set(lows)):
+                problems.append(f"container {keys[i]} is not sorted")
+            stored.extend(keys[i] << 16 | low for low in lows)
+        if len(stored) != bitmap.count:
+            problems.append(f"bitmap holds {len(stored)} IDs, its header says {bitmap.count}")
+
+        stored = set(stored)
+        expected = set(_item_ids(blockchain.decode_ids(), True)) if blocks else set()
+        missing = sorted(expected - stored)
+        extra = sorted(stored - expected)
+        if missing:
+            problems.append(f"{len(missing)} item IDs of the chain are missing, e.g. {missing[:5]}")
+        if extra:
+            problems.append(f"{len(extra)} item IDs are not in the chain, e.g. {extra[:5]}")
+        return problems
+    finally:
+        bitmap.close()
+
+def run():
+    args = parse_bitmap_args(sys.argv[2:])
+    blockchain_file = os.getenv('BCHOC_FILE_PATH', 'blockchain.bin')
+    if not os.path.exists(blockchain_file):
+        print("Error: blockchain file not found")
+        exit(1)
+
+    blockchain = open_blockchain(blockchain_file)
+    if args.action == 'rebuild':
+        started = time.perf_counter()
+        bitmap = ItemBitmap(blockchain)
+        with blockchain.transaction():
+            bitmap.rebuild()
+        elapsed = time.perf_counter() - started
+        print(f"Rebuilt {bitmap.path}: {len(bitmap):,} item IDs in {len(bitmap._keys):,} containers "
+              f"({os.path.getsize(bitmap.path):,} bytes) from {bitmap.blocks:,} blocks in {elapsed:.2f} s")
+        bitmap.close()
+        return
+
+    problems = check_bitmap(blockchain)
+    if problems:
+        for problem in problems:
+            print(f"Error: {problem}")
+        exit(1)
+    print(f"Item bitmap matches the chain ({len(blockchain.blocks):,} blocks)")
+
+if __name__ == "__main__":
+    run()
@@ -1,21 +1,62 @@
 #!/usr/bin/env python3
 #Driver File - runs the program 
 import os
-import importlib
-import logging
 import sys
+import profiling
 
-# Get blockchain file path from environment variable
-BLOCKCHAIN_FILE = os.getenv('BCHOC_FILE_PATH', 'blockchain.bin')
+# Command name -> module whose run() implements it. A module is imported
+# only when its command runs, so each command only pays for its own
+# imports at startup.
+COMMANDS = {
+    'add': 'add',
+    'verify': 'verify',
+    'dump': 'show_history',
+    'show': 'show',
+    'checkout': 'checkout',
+    'checkin': 'checkin',
+    'remove': 'remove',
+    'batch': 'batch',
+    'archive': 'archive',
+    'prove': 'prove',
+    'check-proof': 'check_proof',
+    'bitmap': 'item_bitmap',
+    'export': 'export',
+}
 
-def load_modules():
-    modules = {}
-    for filename in os.listdir('.'):
-        if filename.endswith('.py') and filename != 'main.py':
-            module_name = filename[:-3]
-            module = importlib.import_module(module_name)
-            modules[module_name] = module
-    return modules
+# Number of modules listed by --startup-profile
+PROFILE_TOP = 20
+
+def startup_profile(argv):
+    """Run a command under `python -X importtime` and report where its
+    startup time went. The command's own output is passed through; the
+    report goes to stderr. Returns the command's exit status."""
+    import subprocess
+    import time
+
+    started = time.perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime', os.path.abspath(__file__)] + argv,
+                            stderr=subprocess.PIPE, text=True)
+    elapsed = time.perf_counter() - started
+
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:'):
+            print(line, file=sys.stderr)
+            continue
+        fields = line[len('import time:'):].split('|')
+        if not fields[0].strip().isdigit():
+            # Column headings
+            continue
+        imports.append((int(fields[0]), int(fields[1]), fields[2].strip()))
+
+    total = sum(self_time for self_time, _, _ in imports)
+    print(f"Startup profile: bchoc {' '.join(argv)}", file=sys.stderr)
+    print(f"  wall time  {elapsed * 1000:8.1f} ms (exit status {result.returncode})", file=sys.stderr)
+    print(f"  imports    {total / 1000:8.1f} ms in {len(imports)} modules", file=sys.stderr)
+    print(f"  {'self ms':>8} {'cumul. ms':>10}  module", file=sys.stderr)
+    for self_time, cumulative, name in sorted(imports, reverse=True)[:PROFILE_TOP]:
+        print(f"  {self_time / 1000:8.1f} {cumulative / 1000:10.1f}  {name}", file=sys.stderr)
+    return result.returncode
 
 def main():
     
@@ -24,29 +65,49 @@ def main():
         print("Error: No command provided")
         sys.exit(1)
 
+    if sys.argv[1] == '--startup-profile':
+        sys.exit(startup_profile(sys.argv[2:]))
+
     command = sys.argv[1].lower()
-    
+
+    # Hand the command to the resident server if one is running
+    if command != 'serve':
+        from client import forward
+        status = forward(sys.argv)
+        if status is not None:
+            sys.exit(status)
+
+    run_command(command)
+
+def run_command(command):
+    with profiling.command(command, sys.argv):
+        dispatch(command)
+
+def dispatch(command):
+    # Get blockchain file path from environment variable
+    blockchain_file = os.getenv('BCHOC_FILE_PATH', 'blockchain.bin')
+
     if command == 'init':
         # Check for additional parameters
         if len(sys.argv) > 2:
             print("Error: init command takes no parameters")
             sys.exit(1)
             
-        if os.path.exists(BLOCKCHAIN_FILE):
+        if os.path.exists(blockchain_file):
             try:
                 from block import Block
                 from blockchain import Blockchain
                 
                 # Try to load the blockchain - this will validate the file structure
-                blockchain = Blockchain(BLOCKCHAIN_FILE)
-                if len(blockchain.blocks) > 0:  # If we can load blocks, file is valid
+                blockchain = Blockchain(blockchain_file)
+                if blockchain.blocks:  # If we can load blocks, file is valid
                     print("Blockchain already initialized")
                     sys.exit(0)
                 else:  # No valid blocks found
-                    print(f"Error: Failed to load blockchain from {BLOCKCHAIN_FILE}")
+                    print(f"Error: Failed to load blockchain from {blockchain_file}")
                     sys.exit(1)
             except Exception as e:
-                print(f"Error: Failed to load blockchain from {BLOCKCHAIN_FILE}")
+                print(f"Error: Failed to load blockchain from {blockchain_file}")
                 sys.exit(1)
         else:
             # Create new blockchain file with initial block
@@ -55,7 +116,7 @@ def main():
                 from blockchain import Blockchain
                 
                 # Create blockchain with the specified file
-                blockchain = Blockchain(BLOCKCHAIN_FILE)
+                blockchain = Blockchain(blockchain_file)
                 # Initialize it with genesis block
                 blockchain.init_blockchain()
                 
@@ -64,58 +125,14 @@ def main():
             except Exception as e:
                 print(f"Error: Failed to create blockchain file: {str(e)}")
                 sys.exit(1)
-    elif command == 'add':
-        try:
-            from add import run
-            run()
-            sys.exit(0)
-        except Exception as e:
-            print(f"Error: {str(e)}")
-            sys.exit(1)
-    elif command == 'verify':
-        try:
-            from verify import run
-            run()
-            sys.exit(0)
-        except Exception as e:
-            print(f"Error: {str(e)}")
-            sys.exit(1)
-    elif command == 'dump':
-        try:
-            from show_history import run
-            run()
-            sys.exit(0)
-        except Exception as e:
-            print(f"Error: {str(e)}")
-            sys.exit(1)
-    elif command == 'show':
-        try:
-            from show import run
-            run()
-            sys.exit(0)
-        except Exception as e:
-            print(f"Error: {str(e)}")
-            sys.exit(1)
-    elif command == 'checkout':
-        try:
-            from checkout import run
-            run()
-            sys.exit(0)
-        except Exception as e:
-            print(f"Error: {str(e)}")
-            sys.exit(1)
-    elif command == 'checkin':
-        try:
-            from checkin import run
-            run()
-            sys.exit(0)
-        except Exception as e:
-            print(f"Error: {str(e)}")
-            sys.exit(1)
-    elif command == "remove":
+    elif command == 'serve':
+        from server import run
+        run()
+        sys.exit(0)
+    elif command in COMMANDS:
         try:
-            from remove import run
-            run()
+            from importlib import import_module
+            import_module(COMMANDS[command]).run()
             sys.exit(0)
         except Exception as e:
             print(f"Error: {str(e)}")
@@ -0,0 +1,256 @@
+import fcntl
+import hashlib
+import os
+import struct
+from contextlib import contextmanager
+from profiling import timed
+
+# Sidecar Merkle tree over the block hashes (Block.calculate_hash, the
+# SHA-256 of each record), kept next to the chain as <chain>.mrk. The tree
+# is the one of RFC 6962 / RFC 9162: leaf hash H(0x00 || block hash), node
+# hash H(0x01 || left || right), a tree of n leaves split at the largest
+# power of two below n. Its root commits to the whole chain, and an
+# inclusion proof of a block is O(log n) hashes that anyone can check
+# against a published root without the chain.
+#
+# Only complete subtrees are stored, in post-order as they are completed
+# when leaves are appended (a Merkle mountain range): leaf i is node
+# 2i - popcount(i), and the subtree of height h ending with leaf i is node
+# 2i - popcount(i) + h. Appending never rewrites a node, and every node an
+# RFC 6962 proof needs is either stored or one of the O(log n) right-edge
+# nodes computed from the stored ones.
+
+MERKLE_SUFFIX = '.mrk'
+
+MAGIC = b'BCMK'
+VERSION = 1
+# magic, version, number of leaves, chain bytes covered, offset of the last
+# block covered, hash of that block
+HEADER = struct.Struct('<4sIQQQ32s')
+NODE_SIZE = 32
+
+def merkle_path(blockchain):
+    return blockchain.filename + MERKLE_SUFFIX
+
+def leaf_hash(block_hash):
+    return hashlib.sha256(b"\x00" + block_hash).digest()
+
+def node_hash(left, right):
+    return hashlib.sha256(b"\x01" + left + right).digest()
+
+def _leaf_position(i):
+    return 2 * i - bin(i).count('1')
+
+def _node_position(start, height):
+    """Position of the stored subtree of 2**height leaves from leaf start"""
+    return _leaf_position(start + (1 << height) - 1) + height
+
+def _split(n):
+    """Largest power of two below n"""
+    return 1 << ((n - 1).bit_length() - 1)
+
+def verify_inclusion(index, tree_size, leaf, path, root):
+    """Check an inclusion proof of the leaf hash at index in a tree of
+    tree_size leaves against its root (RFC 9162, 2.1.3.2)"""
+    if index >= tree_size:
+        return False
+    fn, sn = index, tree_size - 1
+    r = leaf
+    for p in path:
+        if sn == 0:
+            return False
+        if fn & 1 or fn == sn:
+            r = node_hash(p, r)
+            if not fn & 1:
+                while not fn & 1 and fn != 0:
+                    fn >>= 1
+                    sn >>= 1
+        else:
+            r = node_hash(r, p)
+        fn >>= 1
+        sn >>= 1
+    return sn == 0 and r == root
+
+def _block_hashes(blockchain, index, offset):
+    """Yield (offset, hash) of the blocks from a block boundary onwards:
+    records on disk are hashed straight from the mapping"""
+    for record_offset, record in blockchain.records(offset):
+        yield record_offset, hashlib.sha256(record).digest()
+        index += 1
+        offset = record_offset + len(record)
+    for _, block_offset, _ in blockchain.walk(index, offset):
+        yield block_offset, blockchain.hash_at(block_offset)
+
+class MerkleTree:
+    def __init__(self, blockchain):
+        self.blockchain = blockchain
+        self.path = merkle_path(blockchain)
+
+    def _header(self):
+        try:
+            with open(self.path, 'rb') as f:
+                header = f.read(HEADER.size)
+        except OSError:
+            return None
+        if len(header) != HEADER.size:
+            return None
+        fields = HEADER.unpack(header)
+        if fields[0] != MAGIC or fields[1] != VERSION:
+            return None
+        return fields[2:]
+
+    @property
+    def size(self):
+        """Number of leaves in the stored tree"""
+        return self.extent()[0]
+
+    def extent(self):
+        """Return the number of leaves and the chain bytes they cover"""
+        header = self._header()
+        return header[:2] if header else (0, 0)
+
+    @timed('merkle.refresh')
+    def refresh(self):
+        """Bring the tree up to date with the chain.
+
+        Leaves are only appended for blocks past the ones covered, as long
+        as the last covered block is still in place; otherwise the tree is
+        rebuilt.
+        """
+        blockchain = self.blockchain
+        header = self._header()
+        if header is not None:
+            count, size, tip_offset, tip = header
+            if size > blockchain.file_size and blockchain.stored_size() >= size:
+                # Written after this process loaded the chain
+                return
+            try:
+                matches = count and blockchain.hash_at(tip_offset) == tip
+            except (IndexError, struct.error):
+                matches = False
+            if matches:
+                if size == blockchain.file_size:
+                    return
+                self._append(count, size)
+                return
+        self._append(0, 0)
+
+    def _append(self, count, size):
+        blockchain = self.blockchain
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            stored = _leaf_position(count)
+            nodes = []
+
+            def node(position):
+                if position >= stored:
+                    return nodes[position - stored]
+                return os.pread(fd, NODE_SIZE, HEADER.size + position * NODE_SIZE)
+
+            i = count
+            tip_offset = None
+            for offset, block_hash in _block_hashes(blockchain, count, size):
+                nodes.append(leaf_hash(block_hash))
+                # Complete the subtrees this leaf closes, one per trailing
+                # one bit of its index
+                height = 0
+                while i >> height & 1:
+                    right = stored + len(nodes) - 1
+                    left = right - ((1 << (height + 1)) - 1)
+                    nodes.append(node_hash(node(left), node(right)))
+                    height += 1
+                i += 1
+                tip_offset = offset
+            if tip_offset is None:
+                if count:
+                    return
+                header = HEADER.pack(MAGIC, VERSION, 0, 0, 0, bytes(32))
+                end = 0
+            else:
+                end = tip_offset + blockchain.record_length(tip_offset)
+                header = HEADER.pack(MAGIC, VERSION, i, end, tip_offset, blockchain.hash_at(tip_offset))
+            start = HEADER.size + stored * NODE_SIZE
+            os.ftruncate(fd, start)
+            os.pwrite(fd, b"".join(nodes), start)
+            # The header goes last: until it is written the new nodes are
+            # not covered and are rewritten by the next refresh
+            os.pwrite(fd, header, 0)
+        finally:
+            os.close(fd)
+
+    @contextmanager
+    def _nodes(self):
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            yield lambda start, height: os.pread(fd, NODE_SIZE, HEADER.size + _node_position(start, height) * NODE_SIZE)
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def _subtree_root(node, start, n):
+        """Root of the n leaves from leaf start: the stored subtrees of
+        n's set bits, folded from the right"""
+        peaks = []
+        while n:
+            height = n.bit_length() - 1
+            peaks.append(node(start, height))
+            start += 1 << height
+            n -= 1 << height
+        root = peaks.pop()
+        while peaks:
+            root = node_hash(peaks.pop(), root)
+        return root
+
+    def root(self, tree_size=None):
+        """Root hash of the first tree_size leaves (all by default)"""
+        tree_size = self.size if tree_size is None else tree_size
+        if not 0 < tree_size <= self.size:
+            raise ValueError(f"No Merkle tree of {tree_size} blocks")
+        with self._nodes() as node:
+            return self._subtree_root(node, 0, tree_size)
+
+    def inclusion_path(self, index, tree_size=None):
+        """Audit path of leaf index in the tree of the first tree_size
+        leaves, leaf side first (RFC 6962 PATH)"""
+        tree_size = self.size if tree_size is None else tree_size
+        if not 0 <= index < tree_size <= self.size:
+            raise ValueError(f"Block {index} is not in a Merkle tree of {tree_size} blocks")
+        path = []
+        start, n = 0, tree_size
+        with self._nodes() as node:
+            # Walk down from the root; the sibling of each step is recorded
+            # and the path is reversed at the end
+            while n > 1:
+                k = _split(n)
+                if index - start < k:
+                    path.append(self._subtree_root(node, start + k, n - k))
+                    n = k
+                else:
+                    path.append(node(start, k.bit_length() - 1))
+                    start += k
+                    n -= k
+        path.reverse()
+        return path
+
+    @contextmanager
+    def locked(self):
+        """Hold the tree's own lock: readers refresh it too, outside the
+        chain's write transaction"""
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield self
+        finally:
+            os.close(fd)
+
+def on_append(blockchain, first):
+    tree = MerkleTree(blockchain)
+    with tree.locked():
+        tree.refresh()
+
+def open_tree(blockchain):
+    """Return the chain's Merkle tree, brought up to date"""
+    tree = MerkleTree(blockchain)
+    with tree.locked():
+        tree.refresh()
+    return tree
@@ -0,0 +1,188 @@
+import os
+import sys
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+from time import perf_counter
+
+# Phase-level instrumentation, enabled with BCHOC_PROFILE=1. Each command
+# then reports one JSON line with the time and number of calls of every
+# instrumented phase (loading and scanning the chain, decryption, hashing,
+# commits, fsyncs, index refreshes, ...), counters such as cipher calls and
+# bytes appended, the process's I/O byte counts and its peak RSS.
+#
+#   BCHOC_PROFILE=1                 enable, report on stderr
+#   BCHOC_PROFILE_FILE=path         append the reports to path instead
+#   BCHOC_PROFILE_CPROFILE=path     also run the command under cProfile and
+#                                   dump its stats (pstats format) to path
+#   BCHOC_PROFILE_TRACEMALLOC=path  also trace allocations and dump the
+#                                   final snapshot (tracemalloc format)
+#
+# The settings are read once per process (a resident server is profiled
+# if it was started with them). When profiling is off timed() returns the
+# function it decorates unchanged and command() a shared null context, so
+# instrumented code runs exactly as before.
+
+ENABLED = os.getenv('BCHOC_PROFILE', '') not in ('', '0')
+
+# name -> [calls, seconds]
+_phases = {}
+# name -> value
+_counters = {}
+
+def _record(name, seconds):
+    phase = _phases.get(name)
+    if phase is None:
+        _phases[name] = [1, seconds]
+    else:
+        phase[0] += 1
+        phase[1] += seconds
+
+def timed(name):
+    """Decorator that adds every call of the function to phase name"""
+    def decorate(function):
+        if not ENABLED:
+            return function
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            started = perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                _record(name, perf_counter() - started)
+        return wrapper
+    return decorate
+
+@contextmanager
+def _phase(name):
+    started = perf_counter()
+    try:
+        yield
+    finally:
+        _record(name, perf_counter() - started)
+
+_NULL = nullcontext()
+
+def phase(name):
+    """Context manager that adds the time spent in it to phase name"""
+    if not ENABLED:
+        return _NULL
+    return _phase(name)
+
+def count(name, amount=1):
+    if ENABLED:
+        _counters[name] = _counters.get(name, 0) + amount
+
+class CountingCipher:
+    """Wraps a cipher to count calls and bytes"""
+    def __init__(self, cipher):
+        self._cipher = cipher
+
+    def encrypt(self, data):
+        count('cipher.encrypt.calls')
+        count('cipher.encrypt.bytes', len(data))
+        return self._cipher.encrypt(data)
+
+    def decrypt(self, data):
+        count('cipher.decrypt.calls')
+        count('cipher.decrypt.bytes', len(data))
+        return self._cipher.decrypt(data)
+
+def _process_io():
+    try:
+        with open('/proc/self/io') as f:
+            return {key: int(value) for key, _, value in (line.partition(':') for line in f)}
+    except OSError:
+        return {}
+
+@contextmanager
+def _command(name, argv):
+    import resource
+
+    _phases.clear()
+    _counters.clear()
+    io_before = _process_io()
+    profiler = None
+    if os.getenv('BCHOC_PROFILE_CPROFILE'):
+        import cProfile
+        profiler = cProfile.Profile()
+    tracemalloc_path = os.getenv('BCHOC_PROFILE_TRACEMALLOC')
+    if tracemalloc_path:
+        import tracemalloc
+        tracemalloc.start()
+
+    status = 0
+    started = perf_counter()
+    if profiler:
+        profiler.enable()
+    try:
+        yield
+    except SystemExit as e:
+        status = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+        raise
+    except BaseException:
+        status = 1
+        raise
+    finally:
+        if profiler:
+            profiler.disable()
+        elapsed = perf_counter() - started
+        report = {
+            'command': name,
+            'argv': _redacted(argv[1:]),
+            'status': status,
+            'wall_s': round(elapsed, 6),
+            'phases': {phase: {'calls': calls, 'seconds': round(seconds, 6)}
+                       for phase, (calls, seconds) in sorted(_phases.items())},
+            'counters': dict(sorted(_counters.items())),
+        }
+        io_after = _process_io()
+        report['io'] = {key: io_after[key] - io_before.get(key, 0)
+                        for key in ('rchar', 'wchar', 'read_bytes', 'write_bytes') if key in io_after}
+        report['max_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if profiler:
+            profiler.dump_stats(os.getenv('BCHOC_PROFILE_CPROFILE'))
+        if tracemalloc_path:
+            report['tracemalloc_peak_bytes'] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.take_snapshot().dump(tracemalloc_path)
+            tracemalloc.stop()
+        _emit(report)
+
+def _is_password_option(arg):
+    # argparse also accepts unambiguous prefixes such as --pass
+    return arg == '-p' or (len(arg) > 2 and '--password'.startswith(arg))
+
+def _redacted(argv):
+    """Command line arguments with the values of -p/--password masked"""
+    redacted = []
+    hide_next = False
+    for arg in argv:
+        if hide_next:
+            redacted.append('***')
+            hide_next = False
+        elif _is_password_option(arg):
+            redacted.append(arg)
+            hide_next = True
+        elif arg.startswith('--') and '=' in arg and _is_password_option(arg.split('=', 1)[0]):
+            redacted.append(arg.split('=', 1)[0] + '=***')
+        elif arg.startswith('-p') and not arg.startswith('--'):
+            redacted.append('-p***')
+        else:
+            redacted.append(arg)
+    return redacted
+
+def _emit(report):
+    import json
+
+    line = json.dumps(report)
+    path = os.getenv('BCHOC_PROFILE_FILE')
+    if path:
+        with open(path, 'a') as f:
+            f.write(line + "\n")
+    else:
+        print(line, file=sys.stderr)
+
+def command(name, argv):
+    """Context manager around one command; reports it when it ends"""
+    if not ENABLED:
+        return _NULL
+    return _command(name, argv)
@@ -0,0 +1,89 @@
+import argparse
+import json
+import os
+import sys
+from blockchain import open_blockchain
+from evidence_index import EvidenceIndex
+from merkle import open_tree
+from profiling import timed
+
+# Inclusion proofs of an item's custody events. The output carries, for
+# every block of the item, the raw record and its audit path in the Merkle
+# tree of the chain (see merkle.py), along with the tree size and root;
+# `bchoc check-proof` verifies it against a published root without the
+# chain.
+
+def parse_prove_args(args):
+    parser = argparse.ArgumentParser(description='Emit Merkle inclusion proofs of the blocks of an evidence item')
+    parser.add_argument('-i', '--item_id', type=int, help='Evidence item identifier')
+    parser.add_argument('--tree-size', type=int, help='Prove against the root of the first N blocks (default: all blocks)')
+    parser.add_argument('--root', action='store_true', help='Only print the tree size and root hash, for publishing')
+    parser.add_argument('-o', '--output', help='Write the proofs to this file instead of standard output')
+    args = parser.parse_args(args)
+    if args.item_id is None and not args.root:
+        parser.error("the following arguments are required: -i/--item_id")
+    return args
+
+@timed('prove.run')
+def prove_item(item_id, tree_size=None, root_only=False, output=None):
+    blockchain_file = os.getenv('BCHOC_FILE_PATH', 'blockchain.bin')
+    if not os.path.exists(blockchain_file):
+        print("Error: blockchain file not found")
+        exit(1)
+
+    blockchain = open_blockchain(blockchain_file)
+    if not blockchain.blocks:
+        print("Error: blockchain is empty")
+        exit(1)
+    tree = open_tree(blockchain)
+    leaves, covered = tree.extent()
+    # The tree may already cover blocks appended after the chain was loaded
+    available = leaves if covered <= blockchain.file_size else len(blockchain.blocks)
+    if tree_size is None:
+        tree_size = available
+    if not 0 < tree_size <= available:
+        print(f"Error: tree size must be between 1 and {available}")
+        exit(1)
+    root = tree.root(tree_size)
+
+    if root_only:
+        print(f"Tree size: {tree_size}")
+        print(f"Root: {root.hex()}")
+        return
+
+    with EvidenceIndex.open(blockchain) as index:
+        offsets = index.offsets(item_id)
+    proofs = []
+    for offset in offsets:
+        block_index = blockchain.index_of_offset(offset)
+        if block_index is None or block_index >= tree_size:
+            continue
+        proofs.append({
+            'index': block_index,
+            'record': blockchain.block_at(offset).serialize().hex(),
+            'path': [node.hex() for node in tree.inclusion_path(block_index, tree_size)],
+        })
+    if not proofs:
+        print(f"Error: no blocks of evidence item {item_id} in the first {tree_size} blocks")
+        exit(1)
+
+    document = json.dumps({
+        'tree_size': tree_size,
+        'root': root.hex(),
+        'item_id': item_id,
+        'proofs': proofs,
+    }, indent=1)
+    if output:
+        with open(output, 'w') as f:
+            f.write(document + "\n")
+        print(f"Wrote {len(proofs)} proofs of evidence item {item_id} against root {root.hex()} "
+              f"({tree_size} blocks) to {output}")
+    else:
+        print(document)
+
+def run():
+    args = parse_prove_args(sys.argv[2:])
+    prove_item(args.item_id, args.tree_size, args.root, args.output)
+
+if __name__ == "__main__":
+    run()
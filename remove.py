@@ -1,10 +1,12 @@
 import argparse
 from block import Block
-from blockchain import Blockchain
+from blockchain import open_blockchain
+from evidence_index import find_evidence_item
 import sys
 import os
 import datetime
 from utils import validate_password, get_role_passwords, get_owner
+from profiling import timed
 
 def parse_remove_args(args):
   parser = argparse.ArgumentParser(description='Remove an evidence item from the blockchain')
@@ -13,26 +15,47 @@ def parse_remove_args(args):
   parser.add_argument('-p', '--password', required=True, help='Password for the creator')
   return parser.parse_args(args)
 
-def find_evidence_item(blockchain, item_id):
+REASONS = ['DESTROYED', 'REMOVED', 'DISPOSED', 'RELEASED']
+
+def remove_error(existing_block, item_id, why, password):
+    """Return why item_id cannot be removed for the given reason, or None"""
+    if why not in REASONS:
+        return "Invalid reason"
+    if not validate_password(password):
+        return "Invalid password"
+    if not existing_block:
+        return f"Evidence item {item_id} not found"
+    # Check if item is already checked out
+    if existing_block.state.rstrip(b'\0') == b"CHECKEDOUT":
+        return f"Evidence item {item_id} is already checked out"
+    # Check if item is already removed
+    if existing_block.state.rstrip(b'\0') in [b'DESTROYED', b'REMOVED', b'DISPOSED', b'RELEASED']:
+        return f"Evidence item {item_id} has been removed"
+    return None
+
+def remove_block(existing_block, item_id, why):
+    """Build the removal block of an item whose latest block is existing_block"""
+    # Get case ID from existing block
     creator_password = get_role_passwords()['creator']  # Get creator password
-    latest_block = None
-    
-    # Skip genesis block and look for the most recent state of the item
-    for block in blockchain.blocks[1:]:
-        print(creator_password)
-        decrypted_values = block.get_decrypted_values(creator_password)  # Use creator password
-        print(decrypted_values)
-        print(f"\nSearching block - Decrypted values: {decrypted_values}")
-        if decrypted_values.get('evidence_id') is not None:
-            if int(decrypted_values['evidence_id']) == int(item_id):
-                latest_block = block
-    return latest_block
+    decrypted_values = existing_block.get_decrypted_values(creator_password)  # Use creator password
+    case_id = decrypted_values['case_id']
 
+    # Create new checkin block
+    return Block(
+        case_id=case_id,
+        evidence_id=item_id,
+        state=why.encode(),
+        creator=existing_block.creator,
+        owner=existing_block.owner,
+        data=b""
+    ), case_id
+
+@timed('remove.run')
 def run():
     blockchain_file = os.getenv('BCHOC_FILE_PATH', 'blockchain.bin')
     args = parse_remove_args(sys.argv[2:])
 
-    if args.why not in ['DESTROYED', 'REMOVED', 'DISPOSED', 'RELEASED']:
+    if args.why not in REASONS:
         print("Error: Invalid reason", file=sys.stderr)
         sys.exit(1)
         
@@ -43,45 +66,24 @@ def run():
         sys.exit(1)
     
     # Load blockchain
-    blockchain = Blockchain(blockchain_file)
+    blockchain = open_blockchain(blockchain_file)
     if not blockchain.blocks:
         print("Error: Blockchain is empty", file=sys.stderr)
         sys.exit(1)
     
-    # Find the evidence item
-    existing_block = find_evidence_item(blockchain, args.item_id)
-    if not existing_block:
-        print(f"Error: Evidence item {args.item_id} not found", file=sys.stderr)
-        sys.exit(1)
+    # Check the item's latest state and append under the write lock
+    with blockchain.transaction():
+        # Find the evidence item
+        existing_block = find_evidence_item(blockchain, args.item_id)
+        error = remove_error(existing_block, args.item_id, args.why, args.password)
+        if error:
+            print(f"Error: {error}", file=sys.stderr)
+            sys.exit(1)
 
-    # Check if item is already checked out
-    if existing_block.state.rstrip(b'\0') == b"CHECKEDOUT":
-        print(f"Error: Evidence item {args.item_id} is already checked out", file=sys.stderr)
-        sys.exit(1)
-
-    # Check if item is already removed
-    if existing_block.state.rstrip(b'\0') in [b'DESTROYED', b'REMOVED', b'DISPOSED', b'RELEASED']:
-        print(f"Error: Evidence item {args.item_id} has been removed", file=sys.stderr)
-        sys.exit(1)
-    
-    # Get case ID from existing block
-    creator_password = get_role_passwords()['creator']  # Get creator password
-    decrypted_values = existing_block.get_decrypted_values(creator_password)  # Use creator password
-    case_id = decrypted_values['case_id']
-    owner = get_owner(args.password)
-
-    # Create new checkin block
-    block = Block(
-        case_id=case_id,
-        evidence_id=args.item_id,
-        state=args.why.encode(),
-        creator=existing_block.creator,
-        owner=existing_block.owner,
-        data=b""
-    )
+        block, case_id = remove_block(existing_block, args.item_id, args.why)
     
-    # Add block to blockchain
-    blockchain.add_block(block)
+        # Add block to blockchain
+        blockchain.add_block(block)
 
     # Get current time in ISO format with Z suffix
     timestamp = datetime.datetime.now().isoformat() + "Z"
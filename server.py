@@ -0,0 +1,229 @@
+import errno
+import io
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+from contextlib import redirect_stdout, redirect_stderr
+from client import socket_path
+
+# Resident server: `bchoc serve` keeps the chain mapped, its indexes open and
+# the decryption caches warm in one long-running process and runs commands
+# sent over a Unix domain socket next to the chain file. main.py forwards
+# every other command to it when it is running and runs the command itself
+# when it is not (the client side lives in client.py).
+#
+# Requests are handled one at a time, so the server is also the single
+# writer for the clients that go through it. The socket is only accessible
+# to the user running the server.
+#
+# Protocol: JSON lines. The client sends one request with its argv, working
+# directory and BCHOC_* environment. The server answers with the command's
+# output in frames as it is produced, {"stdout": text} or {"stderr": text},
+# and ends with {"status": exit status}.
+
+# Characters of stdout collected before a frame is sent; stderr is sent as
+# soon as it is written
+FRAME_SIZE = 65536
+
+# Settings read once, when the module using them is imported. The server
+# keeps the values it started with, so a client asking for other ones is
+# refused rather than silently served with the server's.
+FIXED_SETTINGS = ['BCHOC_SEGMENT_BLOCKS', 'BCHOC_SEGMENT_BYTES', 'BCHOC_CRYPTO_BACKEND',
+                  'BCHOC_DECRYPT_CACHE_SIZE', 'BCHOC_PROFILE', 'BCHOC_SNAPSHOT_INTERVAL',
+                  'BCHOC_SNAPSHOT_KEEP', 'BCHOC_VERIFY_CHECKPOINTS']
+# The role passwords are the server's own: a client may not pick the
+# passwords its commands are checked against
+PASSWORD_SETTINGS = ['BCHOC_PASSWORD_POLICE', 'BCHOC_PASSWORD_LAWYER', 'BCHOC_PASSWORD_ANALYST',
+                     'BCHOC_PASSWORD_EXECUTIVE', 'BCHOC_PASSWORD_CREATOR']
+_settings = {key: os.getenv(key) for key in FIXED_SETTINGS + PASSWORD_SETTINGS}
+
+class Frames:
+    """Output of a command, sent to the client in frames"""
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.name = None
+        self.pending = []
+        self.size = 0
+        # The client went away; the rest of the output is dropped
+        self.gone = False
+
+    def write(self, name, text):
+        if name != self.name:
+            self.flush()
+            self.name = name
+        self.pending.append(text)
+        self.size += len(text)
+        if name == 'stderr' or self.size >= FRAME_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        frame = {self.name: ''.join(self.pending)}
+        self.pending = []
+        self.size = 0
+        self._send(frame)
+
+    def finish(self, status):
+        self.flush()
+        self._send({'status': status})
+
+    def _send(self, frame):
+        if self.gone:
+            return
+        try:
+            self.wfile.write(json.dumps(frame).encode() + b"\n")
+        except OSError:
+            # Commands stop writing on a broken pipe, as they do when
+            # their output is piped into a reader that exits
+            self.gone = True
+            raise BrokenPipeError(errno.EPIPE, "client went away")
+
+class FrameStream(io.TextIOBase):
+    """sys.stdout or sys.stderr of a forwarded command"""
+    def __init__(self, frames, name):
+        self.frames = frames
+        self.name = name
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        self.frames.write(self.name, text)
+        return len(text)
+
+    def flush(self):
+        self.frames.flush()
+
+def _apply_env(env):
+    """Replace the BCHOC_* environment with a client's, except for the
+    settings the server keeps (see _settings)"""
+    for key in [key for key in os.environ if key.startswith('BCHOC_')]:
+        if key not in env and key not in _settings:
+            del os.environ[key]
+    for key, value in env.items():
+        if key.startswith('BCHOC_') and key not in _settings:
+            os.environ[key] = value
+
+def _mismatched_settings(env):
+    return [key for key in _settings if env.get(key) != _settings[key]]
+
+def execute(request, frames):
+    """Run one forwarded command in this process, sending its output to
+    frames, and return its exit status"""
+    import main
+
+    argv = request['argv']
+    stdout = FrameStream(frames, 'stdout')
+    stderr = FrameStream(frames, 'stderr')
+    mismatched = _mismatched_settings(request['env'])
+    if mismatched:
+        for key in mismatched:
+            if key in PASSWORD_SETTINGS:
+                # Never tell a client the server's passwords
+                stderr.write(f"Error: the server runs with another {key}; restart it with "
+                             "the same passwords or stop it to run the command directly\n")
+            else:
+                stderr.write(f"Error: the server runs with {key}={_settings[key] or ''!r}, "
+                             f"not {request['env'].get(key) or ''!r}; restart it with the same "
+                             "settings or stop it to run the command directly\n")
+        return 1
+    os.chdir(request['cwd'])
+    _apply_env(request['env'])
+    saved_argv = sys.argv
+    sys.argv = argv
+    status = 0
+    try:
+        with redirect_stdout(stdout), redirect_stderr(stderr):
+            try:
+                main.run_command(argv[1].lower())
+            except SystemExit as e:
+                if e.code is None:
+                    status = 0
+                elif isinstance(e.code, int):
+                    status = e.code
+                else:
+                    print(e.code, file=sys.stderr)
+                    status = 1
+            except Exception as e:
+                print(f"Error: {str(e)}")
+                status = 1
+    finally:
+        sys.argv = saved_argv
+    return status
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        frames = Frames(self.wfile)
+        status = execute(json.loads(line), frames)
+        try:
+            frames.finish(status)
+        except BrokenPipeError:
+            pass
+
+class Server(socketserver.UnixStreamServer):
+    pass
+
+def _in_use(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.close()
+
+def preload(blockchain_file):
+    """Load the chain and bring its indexes up to date before serving"""
+    from blockchain import open_blockchain
+    import evidence_index
+
+    blockchain = open_blockchain(blockchain_file)
+    if blockchain.blocks:
+        blockchain.offsets
+        evidence_index.on_append(blockchain, 0)
+
+def run():
+    from blockchain import keep_resident, close_resident
+
+    if len(sys.argv) > 2:
+        print("Error: serve command takes no parameters")
+        exit(1)
+
+    blockchain_file = os.getenv('BCHOC_FILE_PATH', 'blockchain.bin')
+    path = socket_path(blockchain_file)
+    if os.path.exists(path):
+        if _in_use(path):
+            print(f"Error: a server is already listening on {path}")
+            exit(1)
+        os.unlink(path)
+
+    keep_resident()
+    preload(blockchain_file)
+
+    # Stop cleanly on SIGTERM as well as Ctrl-C
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    # Create the socket with mode 0600: whoever can connect runs commands
+    # as the server's user
+    umask = os.umask(0o177)
+    try:
+        server = Server(path, RequestHandler)
+    finally:
+        os.umask(umask)
+    try:
+        print(f"Serving {os.path.abspath(blockchain_file)} on {path}", flush=True)
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        close_resident()
+        if os.path.exists(path):
+            os.unlink(path)
@@ -1,9 +1,13 @@
 import os
 import sys
 import argparse
-from datetime import datetime
-from blockchain import Blockchain
-from utils import validate_password, get_role_passwords, get_owner
+from blockchain import open_blockchain
+from itertools import islice
+from evidence_index import EvidenceIndex, case_key, item_key
+from time_index import blocks_between, parse_time
+import ciphers
+from utils import validate_password
+from profiling import timed
 
 # Function generated with the help of ChatGPT, OpenAI
 def parse_show_args(args):
@@ -12,6 +16,7 @@ def parse_show_args(args):
 
     # Subcommand: show cases
     cases_parser = subparsers.add_parser("cases", help="Show all cases")
+    cases_parser.add_argument('--summary', action='store_true', help="Show item counts per state for each case")
 
     # Subcommand: show items
     items_parser = subparsers.add_parser("items", help="Show items in a case")
@@ -23,9 +28,24 @@ def parse_show_args(args):
     history_parser.add_argument('-r', '--reverse', action='store_true', help="Reverse history")
     history_parser.add_argument('-p', '--password', required=False, help='password')
     history_parser.add_argument('-n', '--num_entries', required=False, type=int, help="Number of entries in output")
+    history_parser.add_argument('--since', type=parse_time, help="Only blocks at or after this time (ISO 8601 or epoch seconds)")
+    history_parser.add_argument('--until', type=parse_time, help="Only blocks at or before this time (ISO 8601 or epoch seconds)")
 
     return parser.parse_args(args)
 
+def _case_uuid(encrypted_case_id):
+    try:
+        return ciphers.decrypt_case_id(encrypted_case_id.encode('latin-1'))
+    except ValueError:
+        return None
+
+def _item_id(encrypted_evidence_id):
+    try:
+        return ciphers.decrypt_evidence_id(encrypted_evidence_id.encode('latin-1'))
+    except ValueError:
+        return None
+
+@timed('show.items')
 def showItems(case_id):
     # Get blockchain file path from environment variable
     blockchain_file = os.getenv('BCHOC_FILE_PATH', 'blockchain.bin')
@@ -35,28 +55,16 @@ def showItems(case_id):
         print("Error: blockchain file not found")
         exit(1)
 
-    # Load the blockchain
-    blockchain = Blockchain(blockchain_file)
-    itemsList = []
-
-    creator_password = get_role_passwords()['creator']
-
-    for block in blockchain.blocks:
-        # ignore genesis block
-        if block.state == b"INITIAL\0\0\0\0\0":
-            continue
-        
-        # decrypt the blocks
-        decrypted_values = block.get_decrypted_values(creator_password)
-
-        # add case ID's to list if it is unique
-        if decrypted_values['case_id'] == case_id and decrypted_values['evidence_id'] not in itemsList:
-            itemsList.append(decrypted_values['evidence_id'])
+    # Answered from the case index, only the listed item IDs are decrypted
+    blockchain = open_blockchain(blockchain_file)
+    with EvidenceIndex.open(blockchain) as index:
+        itemsList = index.case_items(case_id)
 
     for item in itemsList:
-        print(f"{item}")
+        print(f"{_item_id(item)}")
 
-def showCases():
+@timed('show.cases')
+def showCases(summary=False):
     # Get blockchain file path from environment variable
     blockchain_file = os.getenv('BCHOC_FILE_PATH', 'blockchain.bin')
     
@@ -65,28 +73,82 @@ def showCases():
         print("Error: blockchain file not found")
         exit(1)
 
-    # Load the blockchain
-    blockchain = Blockchain(blockchain_file)
-    caseList = []
-
-    creator_password = get_role_passwords()['creator']
-
-    for block in blockchain.blocks:
-        # ignore genesis block
-        if block.state == b"INITIAL\0\0\0\0\0":
-            continue
-        
-        # decrypt the blocks
-        decrypted_values = block.get_decrypted_values(creator_password)
-
-        # add case ID's to list if it is unique
-        if decrypted_values['case_id'] not in caseList:
-            caseList.append(decrypted_values['case_id'])
+    # Answered from the case index, only the listed case IDs are decrypted
+    blockchain = open_blockchain(blockchain_file)
+    with EvidenceIndex.open(blockchain) as index:
+        if summary:
+            rollups = index.case_summary()
+        else:
+            caseList = index.cases()
+
+    if summary:
+        for case, items, checked_in, checked_out, removed in rollups:
+            print(f"Case: {_case_uuid(case)}")
+            print(f"Items: {items}")
+            print(f"Checked in: {checked_in}")
+            print(f"Checked out: {checked_out}")
+            print(f"Removed: {removed}")
+            print()
+        return
 
     for case in caseList:
-        print(f"{case}")
-
-def showHistory(case_id = None, item_id = None, reverse = None, password=None, num_entries=None):
+        print(f"{_case_uuid(case)}")
+
+def _history_blocks(blockchain, reverse, since, until):
+    """Yield the blocks history looks at, in output order"""
+    if since is not None or until is not None or reverse:
+        # The time index holds the offset of every block, so a window or a
+        # walk back from the end of the file starts right where it should
+        for offset in blocks_between(blockchain, since, until, reverse):
+            yield blockchain.block_at(offset)
+    else:
+        for _, _, block in blockchain.walk():
+            yield block
+
+def _matching(blocks, case_id, item_id):
+    """Keep the blocks of the case or of the item; both are compared
+    encrypted, so blocks that are skipped are never decrypted"""
+    if not case_id and not item_id:
+        yield from blocks
+        return
+    case = case_key(case_id) if case_id else None
+    item = item_key(int(item_id)) if item_id else None
+    case = case.encode() if case else None
+    item = item.encode() if item else None
+    for block in blocks:
+        if (case and block.case_id == case) or (item and block.evidence_id == item):
+            yield block
+
+def _decrypted(blockchain, blocks):
+    """Yield lists of (block, case_id, evidence_id), decrypting the IDs a
+    chunk at a time. Chunks start small so the first entries show up at
+    once and grow so long listings are decrypted in bulk."""
+    size = 16
+    while True:
+        chunk = list(islice(blocks, size))
+        if not chunk:
+            return
+        decoded = blockchain.decode_block_ids(chunk)
+        yield [(block, decoded.case_id(i), decoded.evidence_id(i)) for i, block in enumerate(chunk)]
+        size = min(size * 2, 4096)
+
+def _history_entry(block, case_id, evidence_id, password):
+    from datetime import datetime
+
+    state = block.state.rstrip(b'\x00').decode()
+    data = {
+        "Case": case_id if password else block.case_id,
+        "Item": evidence_id,
+        "Action": state,
+        "Time": datetime.fromtimestamp(block.timestamp).isoformat() + "Z"
+    }
+    if state == 'INITIAL':
+        data['Case'] = '00000000-0000-0000-0000-000000000000'
+        data['Item'] = 0
+    return data
+
+@timed('show.history')
+def showHistory(case_id = None, item_id = None, reverse = None, password=None, num_entries=None, since=None, until=None):
     # Get blockchain file path from environment variable
     blockchain_file = os.getenv('BCHOC_FILE_PATH', 'blockchain.bin')
     
@@ -100,59 +162,26 @@ def showHistory(case_id = None, item_id = None, reverse = None, password=None, n
         sys.exit(1)
 
     # Load the blockchain
-    blockchain = Blockchain(blockchain_file)
-    historyBlocks = []
-
-    creator_password = get_role_passwords()['creator']
-
-    for block in blockchain.blocks:
-        # default: do not add block to list
-        found = False
-        
-        # decrypt the blocks
-        decrypted_values = block.get_decrypted_values(creator_password)
-
-        # check if case id matches
-        if case_id and decrypted_values['case_id'] == case_id:
-            found = True
-
-        # check if evidence_id matches
-        if item_id and int(decrypted_values['evidence_id']) == int(item_id):
-            found = True
-  
-        # if both are none, print all 
-        if not case_id and not item_id:
-            found = True
-
-        if found and block not in historyBlocks:
-            data = {
-                "Case": "",
-                "Item": decrypted_values['evidence_id'],
-                "Action": block.state.rstrip(b'\x00').decode(),
-                "Time": datetime.fromtimestamp(block.timestamp).isoformat() + "Z"
-            }
-
-            if password:
-                data['Case'] = decrypted_values['case_id']
-            else:
-                data['Case'] = block.case_id
-
-            if block.state.rstrip(b'\x00').decode() == 'INITIAL':
-                data['Case'] = '00000000-0000-0000-0000-000000000000'
-                data['Item'] = 0
-
-            if not reverse:
-                historyBlocks.append(data)
-            else:
-                historyBlocks = [data] + historyBlocks
-
-    if num_entries and num_entries < len(historyBlocks):
-        historyBlocks = historyBlocks[:num_entries]
-
-    for block in historyBlocks:
-        for key in block:
-            print(f"{key}: {block[key]}")
-        print()
+    blockchain = open_blockchain(blockchain_file)
+
+    # History is a pipeline over the file: nothing is collected, -n stops
+    # reading after the last entry it needs and --reverse reads backwards
+    blocks = _matching(_history_blocks(blockchain, reverse, since, until), case_id, item_id)
+    if num_entries and num_entries > 0:
+        blocks = islice(blocks, num_entries)
+
+    try:
+        for chunk in _decrypted(blockchain, blocks):
+            for entry in chunk:
+                data = _history_entry(*entry, password)
+                for key in data:
+                    print(f"{key}: {data[key]}")
+                print()
+            sys.stdout.flush()
+    except BrokenPipeError:
+        # The reader went away (e.g. piped into head); stop quietly
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
 
 
 
@@ -160,9 +189,10 @@ def run():
     args = parse_show_args(sys.argv[2:])
 
     if args.subcommand == "cases":
-        showCases()
+        showCases(args.summary)
     elif args.subcommand == "items":
         showItems(args.case_id)
     elif args.subcommand == "history":
-        showHistory(args.case_id, args.item_id, args.reverse, args.password, args.num_entries)
+        showHistory(args.case_id, args.item_id, args.reverse, args.password, args.num_entries,
+                    args.since, args.until)
 
@@ -1,14 +1,18 @@
 import argparse
 import os
-from blockchain import Blockchain
+from blockchain import open_blockchain
 from datetime import datetime
-from utils import get_role_passwords, validate_password
+from evidence_index import item_blocks
+from time_index import parse_time
+from profiling import timed
 
 def parse_history_args(args):
     parser = argparse.ArgumentParser(description='Show history of evidence items')
     parser.add_argument('-i', '--item_id', required=True, help='Evidence item identifier')
     parser.add_argument('-p', '--password', required=True, help='Password for authentication')
     parser.add_argument('-r', '--reverse', action='store_true', help='Display history in reverse order')
+    parser.add_argument('--since', type=parse_time, help='Only actions at or after this time (ISO 8601 or epoch seconds)')
+    parser.add_argument('--until', type=parse_time, help='Only actions at or before this time (ISO 8601 or epoch seconds)')
     return parser.parse_args(args)
 
 def format_timestamp(timestamp):
@@ -16,7 +20,8 @@ def format_timestamp(timestamp):
     dt = datetime.fromtimestamp(timestamp)
     return dt.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
 
-def show_item_history(item_id, password, reverse=False):
+@timed('dump.run')
+def show_item_history(item_id, password, reverse=False, since=None, until=None):
     # Get blockchain file path from environment variable
     blockchain_file = os.getenv('BCHOC_FILE_PATH', 'blockchain.bin')
     
@@ -27,34 +32,36 @@ def show_item_history(item_id, password, reverse=False):
     
     try:
         # Load the blockchain
-        blockchain = Blockchain(blockchain_file)
+        blockchain = open_blockchain(blockchain_file)
         
         # Find all entries for the specified item_id
         found_entries = []
-        creator_password = get_role_passwords()['creator']  # Get creator password
         
-        for block in blockchain.blocks:
+        # Only the item's own blocks are read, located through the index
+        for block in item_blocks(blockchain, item_id):
+            # An item has few blocks, their own timestamps select the window
+            if since is not None and block.timestamp < since:
+                continue
+            if until is not None and block.timestamp > until:
+                continue
             # Skip genesis block
             if block.state == b"INITIAL\0\0\0\0\0":
                 continue
                 
-            # Decrypt and check if this block matches our item_id
-            decrypted_values = block.get_decrypted_values(creator_password)
-            if int(decrypted_values['evidence_id']) == int(item_id):
-                # Format the output
-                timestamp = format_timestamp(block.timestamp)
-                state = block.state
-                creator = block.creator
-                
-                # Collect entry details
-                entry = {
-                    'State': state,
-                    'Time of action': timestamp,
-                    'Creator/Owner': creator,
-                    'Additional data': block.data.decode().rstrip('\x00') if block.data else None
-                }
-                found_entries.append(entry)
-        
+            # Format the output
+            timestamp = format_timestamp(block.timestamp)
+            state = block.state
+            creator = block.creator
+            
+            # Collect entry details
+            entry = {
+                'State': state,
+                'Time of action': timestamp,
+                'Creator/Owner': creator,
+                'Additional data': block.data.decode().rstrip('\x00') if block.data else None
+            }
+            found_entries.append(entry)
+    
         # Reverse the order if the reverse flag is set
         if reverse:
             found_entries.reverse()
@@ -80,7 +87,7 @@ def show_item_history(item_id, password, reverse=False):
 def run():
     import sys
     args = parse_history_args(sys.argv[2:])  # Skip the first two arguments (script name and command)
-    show_item_history(args.item_id, args.password, args.reverse)
+    show_item_history(args.item_id, args.password, args.reverse, args.since, args.until)
 
 if __name__ == "__main__":
     run()
\ No newline at end of file
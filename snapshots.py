@@ -0,0 +1,177 @@
+import os
+import struct
+import sys
+from profiling import timed
+
+# Periodic snapshots of the latest state of every evidence item, kept next
+# to the chain as <chain>.snap.<blocks>. Each one records, for the first
+# <blocks> blocks of the chain, item -> (case, state, owner, creator), so
+# the current state of all items is the newest snapshot whose prefix still
+# matches the chain plus a replay of the blocks after it.
+#
+# Items and cases are stored encrypted, as they are in the chain.
+#
+# File layout: a header, then one fixed-size record per item sorted by
+# item. A snapshot is only used while the block at its tip_offset still
+# hashes to its tip; snapshots of a prefix the chain no longer has are
+# deleted when they are found.
+
+SNAPSHOT_SUFFIX = '.snap.'
+# A snapshot is written once this many blocks were appended since the last
+INTERVAL = int(os.getenv('BCHOC_SNAPSHOT_INTERVAL', '10000'))
+# Number of snapshots kept
+KEEP = int(os.getenv('BCHOC_SNAPSHOT_KEEP', '3'))
+
+MAGIC = b'BCSN'
+VERSION = 1
+# magic, version, blocks, size, tip_offset, tip hash, number of items
+HEADER = struct.Struct('<4sIQQQ32sI')
+# evidence_id, case_id, state, owner, creator
+ITEM = struct.Struct('32s32s12s12s12s')
+
+class Snapshot:
+    def __init__(self, path, blocks, size, tip_offset, tip, count):
+        self.path = path
+        # Number of blocks covered and the byte length of those blocks
+        self.blocks = blocks
+        self.size = size
+        self.tip_offset = tip_offset
+        self.tip = tip
+        self.count = count
+
+    @classmethod
+    def read(cls, path):
+        """Read a snapshot's header, or return None if it is not one"""
+        try:
+            with open(path, 'rb') as f:
+                header = f.read(HEADER.size)
+        except OSError:
+            return None
+        if len(header) != HEADER.size:
+            return None
+        magic, version, blocks, size, tip_offset, tip, count = HEADER.unpack(header)
+        if magic != MAGIC or version != VERSION:
+            return None
+        return cls(path, blocks, size, tip_offset, tip, count)
+
+    def matches(self, blockchain):
+        """Is the snapshot's prefix still the start of the chain?"""
+        try:
+            return blockchain.hash_at(self.tip_offset) == self.tip
+        except (IndexError, struct.error):
+            return False
+
+    def items(self):
+        """Return {evidence_id: (case_id, state, owner, creator)}"""
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        if len(data) != HEADER.size + ITEM.size * self.count:
+            raise ValueError(f"Truncated snapshot {self.path}")
+        return {fields[0]: fields[1:] for fields in ITEM.iter_unpack(memoryview(data)[HEADER.size:])}
+
+def snapshot_paths(blockchain):
+    """Return (blocks, path) of the snapshot files of a chain, newest first"""
+    directory = os.path.dirname(os.path.abspath(blockchain.filename))
+    prefix = os.path.basename(blockchain.filename) + SNAPSHOT_SUFFIX
+    paths = []
+    for name in os.listdir(directory):
+        if name.startswith(prefix) and name[len(prefix):].isdigit():
+            paths.append((int(name[len(prefix):]), os.path.join(directory, name)))
+    paths.sort(reverse=True)
+    return paths
+
+def latest_snapshot(blockchain, max_blocks=None):
+    """Return the newest snapshot that matches the chain, covering at most
+    max_blocks blocks, or None. Snapshots of another prefix are removed."""
+    for blocks, path in snapshot_paths(blockchain):
+        if max_blocks is not None and blocks > max_blocks:
+            continue
+        snapshot = Snapshot.read(path)
+        if snapshot is not None and snapshot.size > blockchain.file_size:
+            # Written after this process loaded the chain
+            continue
+        if snapshot is not None and snapshot.matches(blockchain):
+            return snapshot
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+    return None
+
+def replay(blockchain, items, index, offset, stop=None):
+    """Apply blocks[index:stop] to items, starting at the given file offset"""
+    for i, offset, block in blockchain.walk(index, offset):
+        if stop is not None and i >= stop:
+            break
+        if i == 0:
+            # The genesis block is not an item
+            continue
+        items[block.evidence_id] = (block.case_id, block.state, block.owner, block.creator)
+
+@timed('snapshots.item_states')
+def item_states(blockchain, stop=None):
+    """Return the state of every item after blocks[:stop] (the whole chain
+    by default), from the newest usable snapshot plus the blocks after it.
+
+    The result maps the encrypted item ID to (case, state, owner, creator),
+    all as stored in the chain (encrypted, padded).
+    """
+    snapshot = latest_snapshot(blockchain, stop)
+    if snapshot is None:
+        items = {}
+        index = 0
+        offset = 0
+    else:
+        items = snapshot.items()
+        index = snapshot.blocks
+        offset = snapshot.size
+    replay(blockchain, items, index, offset, stop)
+    return items
+
+@timed('snapshots.write')
+def write_snapshot(blockchain, items, blocks):
+    """Write a snapshot of the first blocks blocks with the given item
+    states"""
+    tip_offset = blockchain.offsets[blocks - 1]
+    path = blockchain.filename + SNAPSHOT_SUFFIX + str(blocks)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, blocks, tip_offset + blockchain.record_length(tip_offset),
+                            tip_offset, blockchain.hash_at(tip_offset), len(items)))
+        f.write(b"".join(ITEM.pack(evidence_id, *fields) for evidence_id, fields in sorted(items.items())))
+    os.replace(tmp_path, path)
+    return path
+
+def prune(blockchain):
+    for blocks, path in snapshot_paths(blockchain)[KEEP:]:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+def take_snapshot(blockchain, blocks):
+    """Snapshot the first blocks blocks: the newest usable snapshot plus
+    the blocks after it"""
+    try:
+        write_snapshot(blockchain, item_states(blockchain, blocks), blocks)
+        prune(blockchain)
+    except Exception as e:
+        print(f"Warning: could not update the snapshots sidecar: {e}", file=sys.stderr)
+
+def on_append(blockchain, first):
+    """Write a new snapshot once INTERVAL blocks were appended since the
+    newest usable one.
+
+    A snapshot only covers blocks that later commits cannot change, so it
+    is built and written after the write lock is released, and other
+    writers do not wait for it. Of several commits in one transaction
+    only the last is snapshotted.
+    """
+    if INTERVAL <= 0:
+        return
+    snapshot = latest_snapshot(blockchain)
+    covered = snapshot.blocks if snapshot else 0
+    blocks = len(blockchain.blocks)
+    if blocks - covered < INTERVAL:
+        return
+    blockchain.after_unlock('snapshots', lambda: take_snapshot(blockchain, blocks))
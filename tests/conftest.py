@@ -0,0 +1,36 @@
+import os
+import subprocess
+import sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+CASE_ID = 'c84e339e-5c0e-4f3e-8b55-2c5d1f5b0f4a'
+CREATOR_PASSWORD = 'C67C'
+POLICE_PASSWORD = 'P80P'
+
+def bchoc(*args):
+    """Run a bchoc command in its own process, as from the shell"""
+    return subprocess.run([sys.executable, os.path.join(ROOT, 'main.py'), *map(str, args)],
+                          capture_output=True, text=True)
+
+def add_items(tmp_path, item_ids, case_id=CASE_ID):
+    """Add items with one bulk intake"""
+    intake = tmp_path / 'intake.csv'
+    intake.write_text("case_id,item_id,creator\n" + "".join(f"{case_id},{i},tester\n" for i in item_ids))
+    result = bchoc('add', '--from-file', intake, '-p', CREATOR_PASSWORD)
+    assert result.returncode == 0, result.stderr
+    return result
+
+@pytest.fixture
+def chain(tmp_path, monkeypatch):
+    """Path of a fresh chain file, made the one commands work on"""
+    for key in list(os.environ):
+        if key.startswith('BCHOC_'):
+            monkeypatch.delenv(key)
+    path = tmp_path / 'chain.bin'
+    monkeypatch.setenv('BCHOC_FILE_PATH', str(path))
+    result = bchoc('init')
+    assert result.returncode == 0, result.stderr
+    return path
@@ -0,0 +1,37 @@
+from blockchain import Blockchain, load_segments
+from archive import ArchivedRecords
+from conftest import bchoc, add_items
+
+def archived_chain(chain, tmp_path, monkeypatch):
+    """Seal a segment every 5 blocks and archive the sealed segments"""
+    monkeypatch.setenv('BCHOC_SEGMENT_BLOCKS', '5')
+    for first in range(1, 16, 5):
+        add_items(tmp_path, range(first, first + 5))
+    result = bchoc('archive', '--frame-blocks', 2)
+    assert result.returncode == 0, result.stdout + result.stderr
+    blockchain = Blockchain(str(chain))
+    assert blockchain.segments and all(segment.archived for segment in blockchain.segments)
+    return blockchain
+
+def test_closed_chain_reopens_archives_when_read(chain, tmp_path, monkeypatch):
+    blockchain = archived_chain(chain, tmp_path, monkeypatch)
+    expected = [block.calculate_hash() for block in blockchain.blocks]
+    records = blockchain.segments[0].records
+    assert isinstance(records, ArchivedRecords)
+
+    blockchain.close()
+    assert records._file.closed
+    assert [block.calculate_hash() for block in blockchain.blocks] == expected
+    blockchain.close()
+
+def test_dropped_segments_are_closed(chain, tmp_path, monkeypatch):
+    blockchain = archived_chain(chain, tmp_path, monkeypatch)
+    segment = blockchain.segments[0]
+    records = segment.records
+
+    # A segment whose footer no longer matches is loaded afresh
+    segment.count += 1
+    segments = load_segments(str(chain), blockchain.segments)
+    assert segments[0] is not segment
+    assert records._file.closed
+    assert segments[1] is blockchain.segments[1]
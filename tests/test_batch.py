@@ -0,0 +1,47 @@
+from conftest import POLICE_PASSWORD, CREATOR_PASSWORD, bchoc, add_items
+
+def last_state(item_id):
+    history = bchoc('show', 'history', '-i', item_id, '-r', '-n', 1, '-p', CREATOR_PASSWORD).stdout
+    return history.split("Action: ")[1].split()[0]
+
+def test_failing_action_rolls_back_the_whole_batch(chain, tmp_path):
+    add_items(tmp_path, [1, 2, 3])
+    before = chain.read_bytes()
+    actions = tmp_path / 'actions.csv'
+    actions.write_text("item,action,password,reason\n"
+                       f"1,checkout,{POLICE_PASSWORD},\n"
+                       f"2,checkout,{POLICE_PASSWORD},\n"
+                       # Not checked out, so it cannot be checked in
+                       f"3,checkin,{POLICE_PASSWORD},\n"
+                       f"1,checkin,{POLICE_PASSWORD},\n")
+
+    result = bchoc('batch', actions)
+    assert result.returncode == 1
+    assert "Line 4: checkin 3: Error:" in result.stdout
+    assert "Line 2: checkout 1: not applied" in result.stdout
+    assert chain.read_bytes() == before
+    assert last_state(1) == 'CHECKEDIN'
+    assert bchoc('verify').returncode == 0
+
+def test_batch_applies_every_action_in_one_commit(chain, tmp_path):
+    add_items(tmp_path, [1, 2])
+    actions = tmp_path / 'actions.jsonl'
+    actions.write_text(f'{{"item": 1, "action": "checkout", "password": "{POLICE_PASSWORD}"}}\n'
+                       f'{{"item": 1, "action": "checkin", "password": "{POLICE_PASSWORD}"}}\n'
+                       f'{{"item": 2, "action": "remove", "password": "{CREATOR_PASSWORD}", "reason": "DISPOSED"}}\n')
+
+    result = bchoc('batch', actions)
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert "Applied 3 actions" in result.stdout
+    assert last_state(1) == 'CHECKEDIN'
+    assert last_state(2) == 'DISPOSED'
+    assert bchoc('verify').returncode == 0
+
+def test_batch_without_actions_is_an_error(chain, tmp_path):
+    before = chain.read_bytes()
+    actions = tmp_path / 'actions.csv'
+    actions.write_text("item,action,password\n")
+    result = bchoc('batch', actions)
+    assert result.returncode == 1
+    assert "has no actions" in result.stderr
+    assert chain.read_bytes() == before
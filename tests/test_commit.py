@@ -0,0 +1,70 @@
+import os
+import subprocess
+import sys
+from blockchain import Blockchain, COMMIT_SUFFIX, COMMIT_STATE
+from conftest import ROOT, CASE_ID, CREATOR_PASSWORD, bchoc, add_items
+
+# Commits items 100.. in a separate process whose write of the records
+# stops after the given fraction of them, as if the process died there
+CRASHING_COMMIT = """
+import os, sys
+sys.path.insert(0, {root!r})
+import blockchain
+from block import Block
+chain = blockchain.Blockchain({path!r})
+blocks = [Block(case_id={case_id!r}, evidence_id=100 + i, state=b"CHECKEDIN", creator=b"tester")
+          for i in range({count})]
+real_write = os.write
+def write(fd, data):
+    real_write(fd, bytes(data)[:int(len(data) * {fraction})])
+    os._exit(9)
+os.write = write
+chain.add_blocks(blocks)
+"""
+
+def crash_commit(path, count, fraction):
+    code = CRASHING_COMMIT.format(root=ROOT, path=str(path), case_id=CASE_ID, count=count, fraction=fraction)
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True)
+    assert result.returncode == 9, result.stderr
+
+def test_interrupted_commit_is_dropped_as_a_whole(chain, tmp_path):
+    add_items(tmp_path, [1, 2])
+    size = os.path.getsize(chain)
+    blocks = len(Blockchain(str(chain)).blocks)
+
+    # Several complete records of the 5 are in the file
+    crash_commit(chain, 5, 0.7)
+    assert os.path.getsize(chain) > size + 3 * 144
+
+    assert len(Blockchain(str(chain)).blocks) == blocks
+    assert bchoc('verify').returncode == 0
+    assert "100" not in bchoc('show', 'items', '-c', CASE_ID).stdout
+
+def test_next_commit_truncates_interrupted_commit(chain, tmp_path):
+    add_items(tmp_path, [1])
+    crash_commit(chain, 3, 0.5)
+
+    result = bchoc('add', '-c', CASE_ID, '-i', 100, '-g', 'tester', '-p', CREATOR_PASSWORD)
+    assert result.returncode == 0, result.stderr
+    assert len(Blockchain(str(chain)).blocks) == 3
+    assert bchoc('verify', '--full').returncode == 0
+    # The interrupted blocks are gone: item 101 can still be added
+    assert bchoc('add', '-c', CASE_ID, '-i', 101, '-g', 'tester', '-p', CREATOR_PASSWORD).returncode == 0
+
+def test_torn_record_is_dropped(chain, tmp_path):
+    add_items(tmp_path, [1])
+    crash_commit(chain, 1, 0.5)
+    assert len(Blockchain(str(chain)).blocks) == 2
+    assert bchoc('verify').returncode == 0
+
+def test_commit_completed_before_journal_cleared_is_kept(chain, tmp_path):
+    add_items(tmp_path, [1])
+    add_items(tmp_path, [2, 3])
+    # As if the writer died after writing the last commit's records but
+    # before clearing its range
+    start = Blockchain(str(chain)).offsets[2]
+    stat = os.stat(chain)
+    (tmp_path / ('chain.bin' + COMMIT_SUFFIX)).write_bytes(
+        COMMIT_STATE.pack(stat.st_dev, stat.st_ino, start, stat.st_size))
+    assert len(Blockchain(str(chain)).blocks) == 4
+    assert bchoc('verify').returncode == 0
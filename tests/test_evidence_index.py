@@ -0,0 +1,134 @@
+import os
+import shutil
+import subprocess
+import sys
+import time
+from blockchain import Blockchain
+from evidence_index import EvidenceIndex, INDEX_SUFFIX, case_key, find_evidence_item, item_blocks
+from conftest import ROOT, CASE_ID, CREATOR_PASSWORD, POLICE_PASSWORD, bchoc, add_items
+
+OTHER_CASE = '0f0e0d0c-0b0a-4908-8706-050403020100'
+
+def open_index(chain):
+    blockchain = Blockchain(str(chain))
+    return blockchain, EvidenceIndex.open(blockchain)
+
+def summary(chain):
+    """Rollups of every case by UUID: (items, checked in, checked out, removed)"""
+    blockchain, index = open_index(chain)
+    with index:
+        rows = index.case_summary()
+    keys = {case_key(case): case for case in (CASE_ID, OTHER_CASE)}
+    return {keys[case]: tuple(counts) for case, *counts in rows}
+
+def test_lookup_after_appends(chain, tmp_path):
+    add_items(tmp_path, [1, 2, 3])
+    assert bchoc('checkout', '-i', 2, '-p', POLICE_PASSWORD).returncode == 0
+
+    blockchain, index = open_index(chain)
+    with index:
+        assert index.lookup(2) == (case_key(CASE_ID), 'CHECKEDOUT', blockchain.offsets[-1])
+        assert index.lookup(1) == (case_key(CASE_ID), 'CHECKEDIN', blockchain.offsets[1])
+        assert index.lookup(99) is None
+        assert index.offsets(2) == [blockchain.offsets[2], blockchain.offsets[4]]
+    assert [block.state.rstrip(b"\0") for block in item_blocks(blockchain, 2)] == [b"CHECKEDIN", b"CHECKEDOUT"]
+    assert find_evidence_item(blockchain, 3).state.rstrip(b"\0") == b"CHECKEDIN"
+    assert find_evidence_item(blockchain, 99) is None
+
+def test_case_rollups(chain, tmp_path):
+    add_items(tmp_path, [1, 2, 3])
+    add_items(tmp_path, [10, 11], case_id=OTHER_CASE)
+    assert bchoc('checkout', '-i', 1, '-p', POLICE_PASSWORD).returncode == 0
+    assert bchoc('checkout', '-i', 10, '-p', POLICE_PASSWORD).returncode == 0
+    assert bchoc('checkin', '-i', 10, '-p', POLICE_PASSWORD).returncode == 0
+    assert bchoc('remove', '-i', 3, '-y', 'DISPOSED', '-p', CREATOR_PASSWORD).returncode == 0
+
+    assert summary(chain) == {CASE_ID: (3, 1, 1, 1), OTHER_CASE: (2, 2, 0, 0)}
+
+def test_truncated_chain_rebuilds_index(chain, tmp_path):
+    add_items(tmp_path, [1, 2])
+    size = os.path.getsize(chain)
+    add_items(tmp_path, [3, 4])
+    assert summary(chain) == {CASE_ID: (4, 4, 0, 0)}
+
+    os.truncate(chain, size)
+    blockchain, index = open_index(chain)
+    with index:
+        assert index.lookup(3) is None
+        assert index.lookup(2) is not None
+    assert summary(chain) == {CASE_ID: (2, 2, 0, 0)}
+
+def test_rewritten_chain_rebuilds_index(chain, tmp_path):
+    add_items(tmp_path, [1, 2])
+    other = tmp_path / 'other'
+    other.mkdir()
+    original = os.environ['BCHOC_FILE_PATH']
+    os.environ['BCHOC_FILE_PATH'] = str(other / 'chain.bin')
+    try:
+        assert bchoc('init').returncode == 0
+        add_items(other, [7, 8], case_id=OTHER_CASE)
+    finally:
+        os.environ['BCHOC_FILE_PATH'] = original
+    assert os.path.getsize(other / 'chain.bin') == os.path.getsize(chain)
+
+    # Same size, different blocks: only the tip hash tells them apart
+    shutil.copyfile(other / 'chain.bin', chain)
+    blockchain, index = open_index(chain)
+    with index:
+        assert index.lookup(1) is None
+        assert index.lookup(7)[0] == case_key(OTHER_CASE)
+    assert summary(chain) == {OTHER_CASE: (2, 2, 0, 0)}
+
+def test_apply_twice_does_not_count_twice(chain, tmp_path):
+    add_items(tmp_path, [1, 2])
+    stale = tmp_path / 'stale.idx'
+    shutil.copyfile(str(chain) + INDEX_SUFFIX, stale)
+    add_items(tmp_path, [3])
+    assert bchoc('checkout', '-i', 1, '-p', POLICE_PASSWORD).returncode == 0
+    expected = summary(chain)
+
+    # Two refreshers of the same stale index apply the same blocks
+    shutil.copyfile(stale, str(chain) + INDEX_SUFFIX)
+    blockchain = Blockchain(str(chain))
+    first = len(blockchain.blocks) - 2
+    with EvidenceIndex(blockchain) as one, EvidenceIndex(blockchain) as other:
+        one._apply(first)
+        other._apply(first)
+        one._apply(first)
+    assert summary(chain) == expected
+
+# Brings the index up to date once the start file appears, so that the
+# refreshers start together
+REFRESH = """
+import os, sys, time
+sys.path.insert(0, {root!r})
+from blockchain import Blockchain
+from evidence_index import EvidenceIndex
+blockchain = Blockchain({path!r})
+while not os.path.exists({start!r}):
+    time.sleep(0.001)
+EvidenceIndex.open(blockchain).close()
+"""
+
+def test_concurrent_refreshes_do_not_count_twice(chain, tmp_path):
+    add_items(tmp_path, [1, 2])
+    stale = tmp_path / 'stale.idx'
+    shutil.copyfile(str(chain) + INDEX_SUFFIX, stale)
+    # Enough blocks that every refresher reads the stale rows before the
+    # first one writes, unless the refreshes are serialized
+    add_items(tmp_path, range(3, 3000))
+    actions = tmp_path / 'actions.csv'
+    actions.write_text("item,action,password\n" + "".join(f"{i},checkout,{POLICE_PASSWORD}\n"
+                                                          for i in range(1, 1000)))
+    assert bchoc('batch', actions).returncode == 0
+    expected = summary(chain)
+
+    for attempt in range(3):
+        shutil.copyfile(stale, str(chain) + INDEX_SUFFIX)
+        start = tmp_path / f'start.{attempt}'
+        code = REFRESH.format(root=ROOT, path=str(chain), start=str(start))
+        refreshers = [subprocess.Popen([sys.executable, '-c', code]) for _ in range(6)]
+        time.sleep(0.5)
+        start.touch()
+        assert all(refresher.wait() == 0 for refresher in refreshers)
+        assert summary(chain) == expected
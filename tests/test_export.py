@@ -0,0 +1,88 @@
+import ast
+import csv
+import json
+import uuid
+from array import array
+import pytest
+from blockchain import Blockchain
+from export import COLUMNS
+from conftest import CASE_ID, CREATOR_PASSWORD, POLICE_PASSWORD, bchoc, add_items
+
+OTHER_CASE = '0f0e0d0c-0b0a-4908-8706-050403020100'
+
+def read_npy(path):
+    """Header dict and data bytes of a .npy file, without NumPy"""
+    data = path.read_bytes()
+    assert data[:6] == b'\x93NUMPY'
+    header_length = int.from_bytes(data[8:10], 'little')
+    header = ast.literal_eval(data[10:10 + header_length].decode('latin-1'))
+    return header, data[10 + header_length:]
+
+@pytest.fixture
+def items(chain, tmp_path):
+    add_items(tmp_path, [1, 2, 3])
+    add_items(tmp_path, [40, 50], case_id=OTHER_CASE)
+    assert bchoc('checkout', '-i', 2, '-p', POLICE_PASSWORD).returncode == 0
+    # (case, item, state) of every block after the genesis block
+    return [(CASE_ID, 1, 'CHECKEDIN'), (CASE_ID, 2, 'CHECKEDIN'), (CASE_ID, 3, 'CHECKEDIN'),
+            (OTHER_CASE, 40, 'CHECKEDIN'), (OTHER_CASE, 50, 'CHECKEDIN'), (CASE_ID, 2, 'CHECKEDOUT')]
+
+def export_rows(file_format, tmp_path, *options):
+    output = tmp_path / f'export.{file_format}'
+    result = bchoc('export', '--format', file_format, '-o', output, *options)
+    assert result.returncode == 0, result.stdout + result.stderr
+    with open(output, newline='') as f:
+        if file_format == 'csv':
+            return list(csv.DictReader(f))
+        return [json.loads(line) for line in f]
+
+@pytest.mark.parametrize('file_format', ['csv', 'jsonl'])
+def test_text_export_round_trip(chain, tmp_path, items, file_format):
+    rows = export_rows(file_format, tmp_path, '-p', CREATOR_PASSWORD)
+    blockchain = Blockchain(str(chain))
+    assert len(rows) == len(blockchain.blocks)
+    assert list(rows[0]) == COLUMNS
+    assert rows[0]['state'] == 'INITIAL'
+    assert [(row['case'], int(row['item']), row['state']) for row in rows[1:]] == items
+    for row, offset, block in zip(rows, blockchain.offsets, blockchain.blocks):
+        assert int(row['offset']) == offset
+        assert float(row['timestamp']) == block.timestamp
+        assert row['creator'] == block.creator.rstrip(b"\0").decode()
+    assert rows[-1]['owner'] == 'POLICE'
+
+def test_csv_and_jsonl_exports_agree(chain, tmp_path, items):
+    as_text = lambda rows: [{key: str(value) for key, value in row.items()} for row in rows]
+    assert as_text(export_rows('csv', tmp_path)) == as_text(export_rows('jsonl', tmp_path))
+
+def test_export_without_password_keeps_ciphertexts(chain, tmp_path, items):
+    rows = export_rows('csv', tmp_path)
+    blockchain = Blockchain(str(chain))
+    for row, block in zip(rows[1:], blockchain.blocks[1:]):
+        assert row['case'] == bytes.fromhex(block.case_id.decode()).hex()
+        assert row['item'] == bytes.fromhex(block.evidence_id.decode()).hex()
+
+def test_npy_export_round_trip(chain, tmp_path, items):
+    output = tmp_path / 'columns'
+    result = bchoc('export', '-o', output, '-p', CREATOR_PASSWORD)
+    assert result.returncode == 0, result.stdout + result.stderr
+    meta = json.loads((output / 'columns.json').read_text())
+    blockchain = Blockchain(str(chain))
+    count = len(blockchain.blocks)
+    assert meta['blocks'] == count and meta['decrypted']
+
+    columns = {}
+    for name in COLUMNS:
+        header, data = read_npy(output / f'{name}.npy')
+        assert header['shape'] == (count,)
+        assert not header['fortran_order']
+        columns[name] = data
+    assert list(array('Q', columns['offset'])) == list(blockchain.offsets)
+    assert list(array('d', columns['timestamp'])) == [block.timestamp for block in blockchain.blocks]
+    cases = [str(uuid.UUID(bytes=columns['case'][i:i + 16])) for i in range(16, 16 * count, 16)]
+    states = [meta['state'][code] for code in columns['state'][1:]]
+    assert list(zip(cases, array('I', columns['item'])[1:], states)) == items
+    assert [meta['owner'][code] for code in columns['owner']][-1] == 'POLICE'
+
+    # The text export of the same chain carries the same values
+    rows = export_rows('csv', tmp_path, '-p', CREATOR_PASSWORD)
+    assert [row['state'] for row in rows] == [meta['state'][code] for code in columns['state']]
@@ -0,0 +1,58 @@
+import json
+import pytest
+from blockchain import Blockchain
+from merkle import MERKLE_SUFFIX, leaf_hash, node_hash, verify_inclusion, open_tree, _split
+from conftest import bchoc, add_items, POLICE_PASSWORD
+
+# Tree sizes around the powers of two, where the shape of the tree changes
+TREE_SIZES = [1, 2, 3, 4, 5, 7, 8, 9, 15, 16, 17, 31, 32, 33, 40]
+
+def reference_root(leaves):
+    """RFC 6962 Merkle tree hash, computed from scratch"""
+    if len(leaves) == 1:
+        return leaves[0]
+    k = _split(len(leaves))
+    return node_hash(reference_root(leaves[:k]), reference_root(leaves[k:]))
+
+@pytest.fixture
+def leaves(chain, tmp_path):
+    add_items(tmp_path, range(1, max(TREE_SIZES)))
+    blockchain = Blockchain(str(chain))
+    assert len(blockchain.blocks) == max(TREE_SIZES)
+    return [leaf_hash(block.calculate_hash()) for block in blockchain.blocks]
+
+@pytest.mark.parametrize('tree_size', TREE_SIZES)
+def test_roots_and_inclusion_proofs(chain, leaves, tree_size):
+    tree = open_tree(Blockchain(str(chain)))
+    root = tree.root(tree_size)
+    assert root == reference_root(leaves[:tree_size])
+    for index in range(tree_size):
+        path = tree.inclusion_path(index, tree_size)
+        assert verify_inclusion(index, tree_size, leaves[index], path, root)
+        # The proof binds the leaf to its position and to the root
+        assert not verify_inclusion(index, tree_size, leaves[(index + 1) % len(leaves)], path, root)
+        if tree_size > 1:
+            assert not verify_inclusion((index + 1) % tree_size, tree_size, leaves[index], path, root)
+
+def test_tree_extended_by_appends_matches_rebuilt_tree(chain, tmp_path, leaves):
+    add_items(tmp_path, range(100, 105))
+    blockchain = Blockchain(str(chain))
+    extended = open_tree(blockchain)
+    roots = [extended.root(n) for n in TREE_SIZES + [len(blockchain.blocks)]]
+
+    (tmp_path / ('chain.bin' + MERKLE_SUFFIX)).unlink()
+    rebuilt = open_tree(Blockchain(str(chain)))
+    assert [rebuilt.root(n) for n in TREE_SIZES + [len(blockchain.blocks)]] == roots
+
+def test_prove_and_check_proof(chain, tmp_path, leaves):
+    assert bchoc('checkout', '-i', 7, '-p', POLICE_PASSWORD).returncode == 0
+    root = bchoc('prove', '--root').stdout
+    root_hex = root.split("Root: ")[1].strip()
+    proofs = tmp_path / 'proofs.json'
+    assert bchoc('prove', '-i', 7, '-o', proofs).returncode == 0
+    assert len(json.loads(proofs.read_text())['proofs']) == 2
+
+    result = bchoc('check-proof', proofs, '--root', root_hex)
+    assert result.returncode == 0, result.stdout
+    other_root = reference_root(leaves).hex()
+    assert bchoc('check-proof', proofs, '--root', other_root).returncode == 1
@@ -0,0 +1,76 @@
+import os
+import socket
+import stat
+import subprocess
+import sys
+import threading
+import pytest
+from client import socket_path
+from conftest import ROOT, CASE_ID, CREATOR_PASSWORD, bchoc
+
+def serve_once(path, reply=b""):
+    """Listen on path, read one request, send reply and hang up"""
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(1)
+
+    def handle():
+        connection, _ = listener.accept()
+        with connection:
+            connection.makefile('rb').readline()
+            connection.sendall(reply)
+        listener.close()
+    thread = threading.Thread(target=handle)
+    thread.start()
+    return thread
+
+def test_command_is_not_rerun_when_server_hangs_up(chain):
+    before = chain.read_bytes()
+    thread = serve_once(socket_path(str(chain)))
+    result = bchoc('add', '-c', CASE_ID, '-i', 1, '-g', 'tester', '-p', CREATOR_PASSWORD)
+    thread.join()
+    assert result.returncode == 1
+    assert "server closed the connection" in result.stderr
+    assert chain.read_bytes() == before
+
+def test_output_frames_before_hang_up_are_printed(chain):
+    thread = serve_once(socket_path(str(chain)), b'{"stdout": "partial\\n"}\n')
+    result = bchoc('show', 'cases')
+    thread.join()
+    assert result.returncode == 1
+    assert result.stdout == "partial\n"
+
+def test_stale_socket_runs_command_locally(chain):
+    path = socket_path(str(chain))
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(path)
+    stale.close()
+    result = bchoc('add', '-c', CASE_ID, '-i', 1, '-g', 'tester', '-p', CREATOR_PASSWORD)
+    assert result.returncode == 0, result.stderr
+
+@pytest.fixture
+def server(chain):
+    path = socket_path(str(chain))
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, 'main.py'), 'serve'],
+                               stdout=subprocess.PIPE, text=True)
+    process.stdout.readline()
+    yield path
+    process.terminate()
+    process.wait()
+
+def test_socket_is_private(server):
+    assert stat.S_IMODE(os.stat(server).st_mode) == 0o600
+
+def test_client_cannot_choose_role_passwords(server, chain, monkeypatch):
+    before = chain.read_bytes()
+    monkeypatch.setenv('BCHOC_PASSWORD_CREATOR', 'mine')
+    result = bchoc('add', '-c', CASE_ID, '-i', 1, '-g', 'tester', '-p', 'mine')
+    assert result.returncode == 1
+    assert "another BCHOC_PASSWORD_CREATOR" in result.stderr
+    assert "C67C" not in result.stdout + result.stderr
+    assert chain.read_bytes() == before
+
+    monkeypatch.delenv('BCHOC_PASSWORD_CREATOR')
+    result = bchoc('add', '-c', CASE_ID, '-i', 1, '-g', 'tester', '-p', CREATOR_PASSWORD)
+    assert result.returncode == 0, result.stderr
+    assert "Added item: 1" in result.stdout
@@ -0,0 +1,51 @@
+import fcntl
+import os
+import snapshots
+from blockchain import Blockchain, LOCK_SUFFIX
+from block import Block
+from snapshots import item_states, latest_snapshot, replay
+from conftest import CASE_ID, POLICE_PASSWORD, bchoc, add_items
+
+def replayed_states(blockchain):
+    items = {}
+    replay(blockchain, items, 0, 0)
+    return items
+
+def test_snapshot_matches_replay_from_genesis(chain, tmp_path, monkeypatch):
+    monkeypatch.setenv('BCHOC_SNAPSHOT_INTERVAL', '4')
+    add_items(tmp_path, range(1, 6))
+    assert bchoc('checkout', '-i', 2, '-p', POLICE_PASSWORD).returncode == 0
+    add_items(tmp_path, range(6, 10))
+
+    blockchain = Blockchain(str(chain))
+    snapshot = latest_snapshot(blockchain)
+    assert snapshot.blocks == len(blockchain.blocks) == 11
+    assert snapshot.size == blockchain.size
+    assert snapshot.items() == replayed_states(blockchain)
+    assert item_states(blockchain) == replayed_states(blockchain)
+
+def test_snapshot_is_written_after_the_lock_is_released(chain, monkeypatch):
+    monkeypatch.setattr(snapshots, 'INTERVAL', 3)
+    blockchain = Blockchain(str(chain))
+    lock_states = []
+    write_snapshot = snapshots.write_snapshot
+    def checking_write(blockchain, items, blocks):
+        fd = os.open(blockchain.filename + LOCK_SUFFIX, os.O_RDWR)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            lock_states.append('free')
+        except BlockingIOError:
+            lock_states.append('held')
+        finally:
+            os.close(fd)
+        return write_snapshot(blockchain, items, blocks)
+    monkeypatch.setattr(snapshots, 'write_snapshot', checking_write)
+
+    # Two commits past the interval in one transaction: one snapshot, of both
+    with blockchain.transaction():
+        for item_id in (1, 2):
+            blockchain.add_blocks([Block(case_id=CASE_ID, evidence_id=item_id + 10 * i,
+                                         state=b"CHECKEDIN", creator=b"tester") for i in range(3)])
+        assert latest_snapshot(blockchain) is None
+    assert lock_states == ['free']
+    assert latest_snapshot(blockchain).blocks == 7
@@ -0,0 +1,115 @@
+import json
+import struct
+from block import Block
+import blockchain
+from blockchain import Blockchain, open_blockchain
+import verify
+from verify import CHECKPOINT_SUFFIX
+from conftest import CASE_ID, bchoc, add_items, POLICE_PASSWORD
+
+def checkpoints(chain):
+    with open(str(chain) + CHECKPOINT_SUFFIX) as f:
+        return json.load(f)
+
+def tamper(chain, index):
+    """Change the timestamp of a block in place"""
+    offset = Blockchain(str(chain)).offsets[index]
+    with open(chain, 'r+b') as f:
+        f.seek(offset + Block.TIMESTAMP_OFFSET)
+        f.write(struct.pack('d', 1.0))
+
+def test_checkpoint_is_reused_for_appended_blocks(chain, tmp_path):
+    add_items(tmp_path, range(1, 11))
+    assert bchoc('verify').returncode == 0
+    assert bchoc('checkout', '-i', 3, '-p', POLICE_PASSWORD).returncode == 0
+    assert bchoc('verify').returncode == 0
+    saved = checkpoints(chain)
+    assert [checkpoint['blocks'] for checkpoint in saved] == [11, 12]
+    assert all(checkpoint['parts'] for checkpoint in saved)
+
+def test_block_edited_behind_checkpoint_tip_fails_verify(chain, tmp_path):
+    add_items(tmp_path, range(1, 11))
+    assert bchoc('verify').returncode == 0
+
+    tamper(chain, 5)
+    result = bchoc('verify')
+    assert result.returncode == 1
+    assert "invalid hash chain at block 6" in result.stdout + result.stderr
+
+def test_block_edited_after_incremental_verify_fails_verify(chain, tmp_path):
+    add_items(tmp_path, range(1, 11))
+    assert bchoc('verify').returncode == 0
+    assert bchoc('checkout', '-i', 3, '-p', POLICE_PASSWORD).returncode == 0
+    assert bchoc('verify').returncode == 0
+
+    tamper(chain, 2)
+    assert bchoc('verify').returncode == 1
+
+def test_checkpoint_without_digests_is_not_reused(chain, tmp_path):
+    add_items(tmp_path, range(1, 11))
+    assert bchoc('verify').returncode == 0
+    saved = checkpoints(chain)
+    for checkpoint in saved:
+        del checkpoint['parts']
+    with open(str(chain) + CHECKPOINT_SUFFIX, 'w') as f:
+        json.dump(saved, f)
+
+    tamper(chain, 5)
+    assert bchoc('verify').returncode == 1
+
+def segmented_chain(chain, tmp_path, monkeypatch):
+    """Seal a segment every 5 blocks; returns the loaded chain"""
+    monkeypatch.setenv('BCHOC_SEGMENT_BLOCKS', '5')
+    for first in range(1, 26, 5):
+        add_items(tmp_path, range(first, first + 5))
+    blockchain = Blockchain(str(chain))
+    assert len(blockchain.segments) >= 3
+    return blockchain
+
+def test_sealed_segments_are_not_hashed_again(chain, tmp_path, monkeypatch):
+    blockchain = segmented_chain(chain, tmp_path, monkeypatch)
+    assert bchoc('verify').returncode == 0
+    checkpoint = checkpoints(chain)[-1]
+    assert [part[0] for part in checkpoint['parts']] == [0] + [segment.end for segment in blockchain.segments]
+
+    hashed = []
+    range_digest = verify.range_digest
+    def recording_digest(blockchain, start, end, digest=None):
+        hashed.append((start, end))
+        return range_digest(blockchain, start, end, digest)
+    monkeypatch.setattr(verify, 'range_digest', recording_digest)
+    assert verify.checkpoint_parts(blockchain, checkpoint) is not None
+    assert hashed == [(blockchain.segments[-1].end, checkpoint['size'])]
+
+def test_block_edited_in_sealed_segment_fails_verify(chain, tmp_path, monkeypatch):
+    blockchain = segmented_chain(chain, tmp_path, monkeypatch)
+    assert bchoc('verify').returncode == 0
+    assert bchoc('checkout', '-i', 3, '-p', POLICE_PASSWORD).returncode == 0
+    assert bchoc('verify').returncode == 0
+
+    segment = blockchain.segments[1]
+    with open(segment.path, 'r+b') as f:
+        f.seek(segment.offsets[1] - segment.base + Block.TIMESTAMP_OFFSET)
+        f.write(struct.pack('d', 1.0))
+    result = bchoc('verify')
+    assert result.returncode == 1
+    assert f"invalid hash chain at block {segment.first + 2}" in result.stdout
+
+def test_jobs_must_be_positive(chain):
+    for jobs in (0, -1):
+        result = bchoc('verify', '--jobs', jobs)
+        assert result.returncode == 2
+        assert "--jobs must be at least 1" in result.stderr
+        assert "Traceback" not in result.stderr
+
+def test_in_process_verify_covers_blocks_the_chain_committed(chain, tmp_path, monkeypatch):
+    add_items(tmp_path, [1, 2])
+    # As in the server: the chain stays loaded and commits through it
+    monkeypatch.setattr(blockchain, '_resident', {})
+    resident = open_blockchain(str(chain))
+    resident.add_blocks([Block(case_id=CASE_ID, evidence_id=item_id, state=b"CHECKEDIN", creator=b"tester")
+                         for item_id in (3, 4)])
+    assert open_blockchain(str(chain)) is resident
+
+    assert verify.verify_blockchain()
+    assert checkpoints(chain)[-1]['blocks'] == 5
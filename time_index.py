@@ -0,0 +1,231 @@
+import fcntl
+import os
+import struct
+from bisect import bisect_left, bisect_right
+from contextlib import contextmanager
+from profiling import timed
+
+# Sidecar index of block timestamps, kept next to the chain as <chain>.tsx:
+# one (timestamp, file offset) pair per block, in chain order. Blocks are
+# appended with non-decreasing timestamps, so the blocks of a time window
+# are found by binary search and read straight from their offsets, without
+# scanning or decrypting the rest of the chain.
+#
+# If the clock ever went backwards the pairs are not sorted; the header
+# records that and windows are then found with a linear pass over the
+# pairs instead (still without touching the chain).
+
+TIME_INDEX_SUFFIX = '.tsx'
+# Serializes refreshes; kept apart from the index, which a rebuild replaces
+LOCK_SUFFIX = '.lock'
+
+MAGIC = b'BCTX'
+VERSION = 1
+# magic, version, sorted flag, number of pairs, chain bytes covered, offset
+# of the last block covered, hash of that block
+HEADER = struct.Struct('<4sIIQQQ32s')
+PAIR = struct.Struct('<dQ')
+
+def time_index_path(blockchain):
+    return blockchain.filename + TIME_INDEX_SUFFIX
+
+def parse_time(value):
+    """Parse a --since/--until argument: an ISO 8601 date or time, in the
+    same local time the history output prints (a trailing Z is ignored),
+    or seconds since the epoch"""
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    from datetime import datetime
+
+    if value.endswith('Z'):
+        value = value[:-1]
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        from argparse import ArgumentTypeError
+        raise ArgumentTypeError(
+            f"invalid time {value!r}, expected an ISO 8601 date or time or seconds since the epoch")
+
+class _Timestamps:
+    """Sequence view of the timestamps of the pairs, for bisect"""
+    def __init__(self, fd, count):
+        self.fd = fd
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        return PAIR.unpack(os.pread(self.fd, PAIR.size, HEADER.size + i * PAIR.size))[0]
+
+# Pairs read per system call
+CHUNK = 4096
+
+def _pairs(fd, lo, hi, reverse=False):
+    """Yield the (timestamp, offset) pairs lo..hi-1, backwards if reverse"""
+    if reverse:
+        while hi > lo:
+            start = max(lo, hi - CHUNK)
+            data = os.pread(fd, (hi - start) * PAIR.size, HEADER.size + start * PAIR.size)
+            yield from reversed(list(PAIR.iter_unpack(data)))
+            hi = start
+    else:
+        while lo < hi:
+            stop = min(hi, lo + CHUNK)
+            data = os.pread(fd, (stop - lo) * PAIR.size, HEADER.size + lo * PAIR.size)
+            yield from PAIR.iter_unpack(data)
+            lo = stop
+
+class TimeIndex:
+    def __init__(self, blockchain):
+        self.blockchain = blockchain
+        self.path = time_index_path(blockchain)
+
+    def _header(self, fd=None):
+        if fd is None:
+            try:
+                with open(self.path, 'rb') as f:
+                    return self._header(f.fileno())
+            except OSError:
+                return None
+        header = os.pread(fd, HEADER.size, 0)
+        if len(header) != HEADER.size:
+            return None
+        fields = HEADER.unpack(header)
+        if fields[0] != MAGIC or fields[1] != VERSION:
+            return None
+        return fields[2:]
+
+    @timed('time_index.refresh')
+    def refresh(self):
+        """Bring the index up to date with the chain.
+
+        Pairs are only appended for blocks past the ones covered, as long
+        as the last covered block is still in place; otherwise the index is
+        rebuilt.
+        """
+        blockchain = self.blockchain
+        header = self._header()
+        if header is not None:
+            is_sorted, count, size, tip_offset, tip = header
+            if size > blockchain.file_size and blockchain.stored_size() >= size:
+                # Written after this process loaded the chain
+                return
+            try:
+                matches = count and blockchain.hash_at(tip_offset) == tip
+            except (IndexError, struct.error):
+                matches = False
+            if matches:
+                if size == blockchain.file_size:
+                    return
+                self._append(count, size, tip_offset, is_sorted)
+                return
+        self._append(0, 0, 0, True)
+
+    def _append(self, count, size, tip_offset, is_sorted):
+        blockchain = self.blockchain
+        pairs = []
+        last_timestamp = None
+        if count:
+            with open(self.path, 'rb') as f:
+                f.seek(HEADER.size + (count - 1) * PAIR.size)
+                last_timestamp = PAIR.unpack(f.read(PAIR.size))[0]
+        for index, offset, block in blockchain.walk(count, size):
+            timestamp = block.timestamp
+            if last_timestamp is not None and timestamp < last_timestamp:
+                is_sorted = False
+            last_timestamp = timestamp
+            pairs.append(PAIR.pack(timestamp, offset))
+            tip_offset = offset
+        if not pairs and count:
+            return
+        count += len(pairs)
+        end = tip_offset + blockchain.record_length(tip_offset) if count else 0
+        header = HEADER.pack(MAGIC, VERSION, is_sorted, count, end, tip_offset,
+                             blockchain.hash_at(tip_offset) if count else bytes(32))
+
+        if count == len(pairs):
+            # A rebuild is written aside and renamed into place, so readers
+            # keep reading the index they opened
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(header)
+                f.write(b"".join(pairs))
+            os.replace(tmp_path, self.path)
+            return
+        # Pairs past the ones covered are appended in place: readers only
+        # read as many pairs as the header they read covers
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            start = HEADER.size + (count - len(pairs)) * PAIR.size
+            os.ftruncate(fd, start)
+            os.pwrite(fd, b"".join(pairs), start)
+            # The header goes last: until it is written the new pairs are
+            # not covered and are rewritten by the next refresh
+            os.pwrite(fd, header, 0)
+        finally:
+            os.close(fd)
+
+    def window(self, since=None, until=None, reverse=False):
+        """Yield the offsets of the blocks with since <= timestamp <= until,
+        in chain order (newest first if reverse).
+
+        Pairs are read in chunks as they are consumed, so memory stays
+        constant whatever the size of the window.
+        """
+        try:
+            f = open(self.path, 'rb')
+        except OSError:
+            return
+        with f:
+            fd = f.fileno()
+            header = self._header(fd)
+            if header is None:
+                return
+            is_sorted, count = header[0], header[1]
+            if os.fstat(fd).st_size < HEADER.size + count * PAIR.size:
+                raise ValueError(f"Truncated time index {self.path}")
+            lo, hi = 0, count
+            if is_sorted:
+                timestamps = _Timestamps(fd, count)
+                if since is not None:
+                    lo = bisect_left(timestamps, since)
+                if until is not None:
+                    hi = bisect_right(timestamps, until)
+                since = until = None
+            # Blocks appended after this process loaded the chain are left out
+            end = self.blockchain.file_size
+            for timestamp, offset in _pairs(fd, lo, hi, reverse):
+                if offset >= end:
+                    continue
+                if since is not None and timestamp < since:
+                    continue
+                if until is not None and timestamp > until:
+                    continue
+                yield offset
+
+    @contextmanager
+    def locked(self):
+        """Hold the index's own lock: readers refresh it too, outside the
+        chain's write transaction"""
+        fd = os.open(self.path + LOCK_SUFFIX, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield self
+        finally:
+            os.close(fd)
+
+def on_append(blockchain, first):
+    index = TimeIndex(blockchain)
+    with index.locked():
+        index.refresh()
+
+def blocks_between(blockchain, since=None, until=None, reverse=False):
+    """Yield the offsets of the blocks stamped within [since, until] (all
+    blocks by default), oldest first or newest first if reverse"""
+    index = TimeIndex(blockchain)
+    with index.locked():
+        index.refresh()
+    return index.window(since, until, reverse)
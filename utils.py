@@ -1,13 +1,17 @@
 import os
+from functools import lru_cache
+from types import MappingProxyType
 
+@lru_cache(maxsize=None)
 def get_role_passwords():
-    return {
+    # Read once per process; the table is read-only so it can be shared
+    return MappingProxyType({
         'police': os.getenv('BCHOC_PASSWORD_POLICE', 'P80P'),
         'lawyer': os.getenv('BCHOC_PASSWORD_LAWYER', 'L76L'),
         'analyst': os.getenv('BCHOC_PASSWORD_ANALYST', 'A65A'),
         'executive': os.getenv('BCHOC_PASSWORD_EXECUTIVE', 'E69E'),
         'creator': os.getenv('BCHOC_PASSWORD_CREATOR', 'C67C')
-    }
+    })
 
 def validate_password(password):
     valid_passwords = get_role_passwords().values()
@@ -1,8 +1,361 @@
+import argparse
+import hashlib
+import json
 import os
-from blockchain import Blockchain
-from utils import get_role_passwords
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from block import Block
+from blockchain import Blockchain, open_blockchain
+import ciphers
+from snapshots import latest_snapshot
+from profiling import timed
 
-def verify_blockchain():
+# Successful runs leave checkpoints in this file next to the chain so the
+# next run only has to verify the blocks appended since.
+CHECKPOINT_SUFFIX = '.verify'
+MAX_CHECKPOINTS = int(os.getenv('BCHOC_VERIFY_CHECKPOINTS', '4'))
+
+termStates = [b"DESTROYED", b"DISPOSED", b"RELEASED"]
+valid_states = [b"CHECKEDIN\x00\x00", b"CHECKEDOUT\x00", b"DISPOSED\x00\x00\x00", b"DESTROYED\x00\x00", b"RELEASED\x00\x00\x00"]
+validStates = [state.rstrip(b'\0') for state in valid_states]
+
+# Violations are reported as (block index, check, evidence key); check is
+# the position of the check within a block, so a sorted report lists the
+# problems of each block in the order they used to be checked
+GENESIS, HASH_CHAIN, STATE, REMOVED_TWICE, AFTER_REMOVAL, CHECKIN_TWICE, CHECKOUT_TWICE, \
+    FIELD_LENGTH, DATA_LENGTH, SEGMENT_FOOTER = range(10)
+
+MESSAGES = {
+    GENESIS: "invalid genesis block",
+    HASH_CHAIN: "invalid hash chain at block {index}",
+    STATE: "invalid state at block {index}",
+    REMOVED_TWICE: "evidence item {evidence_id} was removed twice",
+    AFTER_REMOVAL: "evidence item {evidence_id} was checked in or out after being removed",
+    CHECKIN_TWICE: "evidence item {evidence_id} was checked in twice without a checkout",
+    CHECKOUT_TWICE: "evidence item {evidence_id} was checked out twice without a checkin",
+    FIELD_LENGTH: "invalid field length at block {index}",
+    DATA_LENGTH: "invalid data length at block {index}",
+    SEGMENT_FOOTER: "invalid segment footer at block {index}",
+}
+
+def parse_verify_args(args):
+    parser = argparse.ArgumentParser(description='Verify the blockchain')
+    parser.add_argument('--from', dest='start', type=int, help='First block of the window to verify')
+    parser.add_argument('--to', dest='end', type=int, help='Last block of the window to verify')
+    parser.add_argument('--full', action='store_true', help='Ignore checkpoints and verify from genesis')
+    parser.add_argument('--jobs', type=int, help='Verify in this many worker processes')
+    args = parser.parse_args(args)
+    if args.jobs is not None and args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    return args
+
+def checkpoint_path(blockchain):
+    return blockchain.filename + CHECKPOINT_SUFFIX
+
+def load_checkpoints(blockchain):
+    try:
+        with open(checkpoint_path(blockchain)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+def save_checkpoint(blockchain, checkpoint):
+    checkpoints = [cp for cp in load_checkpoints(blockchain) if cp['blocks'] < checkpoint['blocks']]
+    checkpoints.append(checkpoint)
+    tmp_path = checkpoint_path(blockchain) + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(checkpoints[-MAX_CHECKPOINTS:], f)
+    os.replace(tmp_path, checkpoint_path(blockchain))
+
+def range_digest(blockchain, start, end, digest=None):
+    """SHA-256 of the stored bytes of the chain in [start, end); digest,
+    if given, already covers bytes before start"""
+    digest = digest or hashlib.sha256()
+    for piece in blockchain.raw(start, end):
+        digest.update(piece)
+    return digest
+
+def file_identity(path):
+    """Identity of a sealed segment file, or None if it is gone. Its
+    change time moves whenever the file is written, even if the
+    modification time is put back afterwards."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_dev, stat.st_ino, stat.st_size, stat.st_ctime_ns]
+
+def prefix_parts(blockchain, end, known=None):
+    """Digests of the bytes of the chain up to end: one part per sealed
+    segment and one for the unsealed rest, as [start, end, digest,
+    identity of the segment file or None].
+
+    known maps the start of the parts of a checked checkpoint to (end,
+    digest, identity, hash object or None): a sealed segment still
+    stored as it was hashed is not hashed again, and a part already
+    hashed up to some offset is only extended from there.
+    """
+    known = known or {}
+    parts = []
+    start = 0
+    for segment in blockchain.segments:
+        if segment.end > end:
+            break
+        previous = known.get(start)
+        if previous and previous[0] == segment.end and previous[2] is not None:
+            parts.append([start, segment.end, previous[1], previous[2]])
+        else:
+            identity = file_identity(segment.path)
+            digest = extend_part(blockchain, start, segment.end, previous)
+            parts.append([start, segment.end, digest.hexdigest(), identity])
+        start = segment.end
+    if start < end:
+        digest = extend_part(blockchain, start, end, known.get(start))
+        parts.append([start, end, digest.hexdigest(), None])
+    return parts
+
+def extend_part(blockchain, start, end, previous):
+    """Hash [start, end), from the hash object of a known part starting
+    at start if there is one"""
+    if previous and previous[3] is not None and previous[0] <= end:
+        return range_digest(blockchain, previous[0], end, previous[3].copy())
+    return range_digest(blockchain, start, end)
+
+def checkpoint_parts(blockchain, checkpoint):
+    """Return the checked parts of the checkpoint's prefix (see
+    prefix_parts) if the prefix is still the one that was verified, or
+    None.
+
+    The tip block is compared first, which rules out most stale
+    checkpoints cheaply. A part is then trusted without hashing if it
+    covers a sealed segment whose file is still the one hashed; every
+    other part, the unsealed chain file included, is hashed again, so a
+    block edited in place behind the tip is caught. A check costs a hash
+    of the unsealed chain file, not of the whole chain.
+    """
+    if checkpoint['size'] > blockchain.file_size or 'parts' not in checkpoint:
+        return None
+    if blockchain.hash_at(checkpoint['tip_offset']).hex() != checkpoint['tip']:
+        return None
+    sealed = {segment.base: segment for segment in blockchain.segments}
+    known = {}
+    offset = 0
+    for start, end, digest, identity in checkpoint['parts']:
+        if start != offset:
+            return None
+        segment = sealed.get(start)
+        if identity is not None and segment is not None and segment.end == end and \
+                file_identity(segment.path) == identity:
+            known[start] = (end, digest, identity, None)
+        else:
+            identity = file_identity(segment.path) if segment is not None and segment.end == end else None
+            hashed = range_digest(blockchain, start, end)
+            if hashed.hexdigest() != digest:
+                return None
+            known[start] = (end, digest, identity, hashed)
+        offset = end
+    return known if offset == checkpoint['size'] else None
+
+def nearest_checkpoint(blockchain, checkpoints, max_blocks=None):
+    """Return the latest still-valid checkpoint covering at most
+    max_blocks and its checked parts, or (None, None)"""
+    for checkpoint in reversed(checkpoints):
+        if max_blocks is not None and checkpoint['blocks'] > max_blocks:
+            continue
+        parts = checkpoint_parts(blockchain, checkpoint)
+        if parts is not None:
+            return checkpoint, parts
+    return None, None
+
+def verify_genesis(blockchain):
+    genesis_block = blockchain.blocks[0]
+    if not (genesis_block.prev_hash == bytes(32) and
+            genesis_block.state.rstrip(b'\0') == b"INITIAL" and
+            len(genesis_block.state) == 12 and
+            len(genesis_block.creator) == 12 and
+            len(genesis_block.owner) == 12):
+        return [(0, GENESIS, None)]
+    return []
+
+def describe_item(evidence_key):
+    try:
+        return ciphers.decrypt_evidence_id(evidence_key)
+    except ValueError:
+        return None
+
+def check_transition(last_state, current_state):
+    """Return the violated custody rule for an item moving between two
+    states, or None"""
+    #check term state 
+    if last_state in termStates and current_state in termStates:
+        return REMOVED_TWICE
+    # If item was removed cannot trac to other state 
+    if last_state in termStates and current_state in [b"CHECKEDIN", b"CHECKEDOUT"]:
+        return AFTER_REMOVAL
+    # If item is already check in 
+    if last_state == b"CHECKEDIN" and current_state == b"CHECKEDIN":
+        return CHECKIN_TWICE
+    # If item is already check out
+    if last_state == b"CHECKEDOUT" and current_state == b"CHECKEDOUT":
+        return CHECKOUT_TWICE
+    return None
+
+@timed('verify.range')
+def verify_range(chain, start, end, index, first, last):
+    """Verify the blocks stored in bytes [start, end) of the chain.
+
+    end=None runs to the last complete record and last=None to the last
+    block. Blocks before index first only contribute item states (the
+    lead-in of a --from window). Items are tracked by their encrypted ID,
+    which is unique per item.
+
+    Everything that can be decided inside the range is checked here; what
+    depends on earlier blocks is summarized for the caller to stitch:
+    the prev_hash of the first block, the hash of the last block and, per
+    item, its first block and state in the range and its last state.
+    """
+    violations = []
+    items = {}
+    first_prev_hash = None
+    previous_hash = None
+    first_index = index
+    offset = start
+    last_offset = None
+    for record_offset, record in chain.records(start, end):
+        if last is not None and index > last:
+            break
+        current_block = Block.from_buffer(record)
+        prev_hash = current_block.prev_hash
+        if previous_hash is None:
+            first_prev_hash = prev_hash
+        elif index >= first and prev_hash != previous_hash:
+            violations.append((index, HASH_CHAIN, None))
+        previous_hash = hashlib.sha256(record).digest()
+
+        state = current_block.state
+        current_state = state.rstrip(b'\0')
+        if index >= first and current_state not in validStates:
+            violations.append((index, STATE, None))
+        else:
+            evidence_key = current_block.evidence_id
+            item = items.get(evidence_key)
+            if item is None:
+                items[evidence_key] = [index, current_state, current_state]
+            else:
+                if index >= first:
+                    rule = check_transition(item[2], current_state)
+                    if rule is not None:
+                        violations.append((index, rule, evidence_key))
+                item[2] = current_state
+
+        if index >= first:
+            if (len(current_block.creator) != 12 or
+                len(current_block.owner) != 12 or
+                len(state) != 12):
+                violations.append((index, FIELD_LENGTH, None))
+            if len(current_block.data) != current_block.data_length:
+                violations.append((index, DATA_LENGTH, None))
+
+        del current_block
+        last_offset = record_offset
+        offset = record_offset + len(record)
+        index += 1
+    return {
+        'first_index': first_index,
+        'count': index - first_index,
+        'end': offset,
+        'last_offset': last_offset,
+        'first_prev_hash': first_prev_hash,
+        'last_hash': previous_hash,
+        'items': items,
+        'violations': violations,
+    }
+
+def verify_file_range(filename, start, end, index, first, last):
+    """verify_range in a worker process, which maps the chain itself"""
+    return verify_range(Blockchain(filename), start, end, index, first, last)
+
+def split_ranges(blockchain, index, first, last, jobs):
+    """Split blocks index..last into byte ranges, a few per worker"""
+    offsets = blockchain.offsets
+    last = len(offsets) - 1 if last is None else min(last, len(offsets) - 1)
+    if index > last:
+        return []
+    chunk = max(1, -(-(last - index + 1) // (jobs * 4)))
+    ranges = []
+    for a in range(index, last + 1, chunk):
+        b = min(a + chunk, last + 1)
+        end_offset = offsets[b] if b < len(offsets) else blockchain.size
+        ranges.append((blockchain.filename, offsets[a], end_offset, a, first, b - 1))
+    return ranges
+
+@timed('verify.stitch')
+def stitch(results, previous_hash, evidenceState, first):
+    """Join per-range results in block order.
+
+    Checks the hash link and the item transitions that cross from one
+    range into the next and returns (violations, index, hash and offset
+    of the last block, offset after it).
+    """
+    violations = []
+    last_index = None
+    last_offset = None
+    end = None
+    for result in results:
+        if not result['count']:
+            continue
+        if result['first_index'] >= first and result['first_prev_hash'] != previous_hash:
+            violations.append((result['first_index'], HASH_CHAIN, None))
+        for evidence_key, (item_index, first_state, last_state) in result['items'].items():
+            key = evidence_key.decode('latin-1')
+            if key in evidenceState and item_index >= first:
+                rule = check_transition(evidenceState[key].encode('latin-1'), first_state)
+                if rule is not None:
+                    violations.append((item_index, rule, evidence_key))
+            evidenceState[key] = last_state.decode('latin-1')
+        violations.extend(result['violations'])
+        previous_hash = result['last_hash']
+        last_index = result['first_index'] + result['count'] - 1
+        last_offset = result['last_offset']
+        end = result['end']
+    return violations, last_index, previous_hash, last_offset, end
+
+def verify_segments(blockchain, offset, last):
+    """Check the footers of the sealed segments verified in this run: those
+    starting at or after offset, up to block last"""
+    violations = []
+    for segment in blockchain.segments:
+        if segment.base < offset or (last is not None and segment.first > last):
+            continue
+        if not segment.check():
+            violations.append((segment.first, SEGMENT_FOOTER, None))
+    return violations
+
+def report(violations):
+    for index, check, evidence_key in sorted(violations, key=lambda v: (v[0], v[1])):
+        evidence_id = describe_item(evidence_key) if evidence_key is not None else None
+        print("Error: " + MESSAGES[check].format(index=index, evidence_id=evidence_id))
+
+def snapshot_checkpoint(snapshot):
+    """Use a state snapshot like a checkpoint for the lead-in of a window"""
+    return {
+        'blocks': snapshot.blocks,
+        'size': snapshot.size,
+        'tip': snapshot.tip.hex(),
+        'states': {evidence_key.decode('latin-1'): fields[1].rstrip(b'\0').decode('latin-1')
+                   for evidence_key, fields in snapshot.items().items()},
+    }
+
+def starting_point(blockchain, checkpoint):
+    """Return (index, offset, previous hash, states) to resume from"""
+    if checkpoint:
+        return (checkpoint['blocks'], checkpoint['size'],
+                bytes.fromhex(checkpoint['tip']), dict(checkpoint['states']))
+    genesis_block = blockchain.blocks[0]
+    return 1, blockchain.record_length(0), genesis_block.calculate_hash(), {}
+
+@timed('verify.run')
+def verify_blockchain(start=None, end=None, full=False, jobs=None):
     blockchain_file = os.getenv('BCHOC_FILE_PATH', 'blockchain.bin')
     
     if not os.path.exists(blockchain_file):
@@ -10,86 +363,70 @@ def verify_blockchain():
         exit(1)
     
     try:
-        blockchain = Blockchain(blockchain_file)
+        blockchain = open_blockchain(blockchain_file)
+        # Blocks are read from the mapping: map the ones a resident chain
+        # committed itself
+        blockchain.refresh()
         
-        if len(blockchain.blocks) == 0:
+        if not blockchain.blocks:
             print("Error: blockchain is empty")
             exit(1)
         
-        evidenceState = {}  
-        onwerPass = get_role_passwords()['creator']
+        violations = verify_genesis(blockchain)
         
-        termStates = [b"DESTROYED", b"DISPOSED", b"RELEASED"]
+        checkpoints = [] if full else load_checkpoints(blockchain)
+        window = start is not None or end is not None
+        first = max(start or 1, 1)
         
-        # Verify  (genesis block)
-        genesis_block = blockchain.blocks[0]
-        if not (genesis_block.prev_hash == bytes(32) and
-                genesis_block.state.rstrip(b'\0') == b"INITIAL" and
-                len(genesis_block.state) == 12 and
-                len(genesis_block.creator) == 12 and
-                len(genesis_block.owner) == 12):
-            print("Error: invalid genesis block")
-            exit(1)
+        # Resume from the nearest checkpoint at or before the window; blocks
+        # between it and the window only replay the item states
+        checkpoint, parts = nearest_checkpoint(blockchain, checkpoints, first if window else None)
+        if window and not full:
+            # Blocks before a window are not verified, so a state snapshot
+            # closer to it than any checkpoint shortens the lead-in
+            snapshot = latest_snapshot(blockchain, first)
+            if snapshot and (checkpoint is None or snapshot.blocks > checkpoint['blocks']):
+                checkpoint = snapshot_checkpoint(snapshot)
+        index, offset, previous_hash, evidenceState = starting_point(blockchain, checkpoint)
         
+        # Without --jobs the whole run is one range verified in-process on
+        # the chain already open; with it, ranges are verified by a process
+        # pool, each worker mapping the file, and stitched
+        if jobs:
+            ranges = split_ranges(blockchain, index, first, end, jobs)
+            with ProcessPoolExecutor(max_workers=jobs) as pool:
+                results = list(pool.map(verify_file_range, *zip(*ranges))) if ranges else []
+        else:
+            results = [verify_range(blockchain, offset, blockchain.file_size, index, first, end)]
         
-        for i in range(1, len(blockchain.blocks)):
-            current_block = blockchain.blocks[i]
-            previous_block = blockchain.blocks[i-1]
-            
-            
-            if current_block.prev_hash != previous_block.calculate_hash():
-                print(f"Error: invalid hash chain at block {i}")
-                exit(1)
-            
-            
-            valid_states = [b"CHECKEDIN\x00\x00", b"CHECKEDOUT\x00", b"DISPOSED\x00\x00\x00", b"DESTROYED\x00\x00", b"RELEASED\x00\x00\x00"]
-            if current_block.state.rstrip(b'\0') not in [state.rstrip(b'\0') for state in valid_states]:
-                print(f"Error: invalid state at block {i}")
-                exit(1)
-            
-           
-            decrypted_values = current_block.get_decrypted_values(onwerPass)
-            evidence_id = decrypted_values['evidence_id']
-            current_state = current_block.state.rstrip(b'\0')
-            
-           
-            if evidence_id in evidenceState:
-                last_state = evidenceState[evidence_id]
-                
-              #check term state 
-                if last_state in termStates and current_state in termStates:
-                    print(f"Error: evidence item {evidence_id} was removed twice")
-                    exit(1)
-                
-                # If item was removed cannot trac to other state 
-                if last_state in termStates and current_state in [b"CHECKEDIN", b"CHECKEDOUT"]:
-                    print(f"Error: evidence item {evidence_id} was checked in or out after being removed")
-                    exit(1)
-                
-                # If item is already check in 
-                if last_state == b"CHECKEDIN" and current_state == b"CHECKEDIN":
-                    print(f"Error: evidence item {evidence_id} was checked in twice without a checkout")
-                    exit(1)
-                
-                # If item is already check out
-                if last_state == b"CHECKEDOUT" and current_state == b"CHECKEDOUT":
-                    print(f"Error: evidence item {evidence_id} was checked out twice without a checkin")
-                    exit(1)
-            
-         
-            evidenceState[evidence_id] = current_state
-            
-          
-            if (len(current_block.creator) != 12 or
-                len(current_block.owner) != 12 or
-                len(current_block.state) != 12):
-                print(f"Error: invalid field length at block {i}")
-                exit(1)
-            
-         
-            if len(current_block.data) != current_block.data_length:
-                print(f"Error: invalid data length at block {i}")
+        range_violations, last_index, previous_hash, last_offset, block_end = \
+            stitch(results, previous_hash, evidenceState, first)
+        violations.extend(range_violations)
+        violations.extend(verify_segments(blockchain, offset, end))
+        
+        if violations:
+            report(violations)
+            exit(1)
+        
+        if window:
+            if last_index is None or last_index < first:
+                print(f"Error: block {first} does not exist")
                 exit(1)
+            print(f"Blockchain verification passed for blocks {first} to {last_index}")
+            return True
+        
+        if last_index is not None:
+            # The checkpoint binds the whole verified prefix: the parts
+            # of the checkpoint resumed from are reused or extended over
+            # the blocks verified in this run
+            save_checkpoint(blockchain, {
+                'blocks': last_index + 1,
+                'size': block_end,
+                'tip_offset': last_offset,
+                'tip': previous_hash.hex(),
+                'parts': prefix_parts(blockchain, block_end, parts),
+                'states': evidenceState,
+            })
         
         print("Blockchain verification passed")
         return True
@@ -99,7 +436,8 @@ def verify_blockchain():
         exit(1)
 
 def run():
-    verify_blockchain()
+    args = parse_verify_args(sys.argv[2:])
+    verify_blockchain(args.start, args.end, args.full, args.jobs)
 
 if __name__ == "__main__":
-    run()
\ No newline at end of file
+    run()